@@ -22,7 +22,7 @@ from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from accounts.backends import EmailOrUsernameModelBackend
 from accounts.form import CustomLoginForm, PasswordChangeForm, ProfileForm, RegisterForm, CompleteProfileForm, AgentCompanyForm
 from accounts.models import Profile, AgentCompany, CompanyContact
-from houses.models import Activity
+from houses.activity import record_activity
 
 # accounts/views.py
 def custom_login(request):
@@ -331,7 +331,7 @@ def edit_profile(request):
         if form.is_valid():
             form.save()
             # Create activity for house deletion
-            Activity.objects.create(
+            record_activity(
                 user=user,
                 activity_type='edit_profile',
                 description=f"You have edited your profile.",
@@ -384,7 +384,7 @@ def edit_company(request):
                 if email.strip():
                     CompanyContact.objects.create(company=company, contact_type='email', value=email.strip())
 
-            Activity.objects.create(
+            record_activity(
                 user=request.user,
                 activity_type='edit_company_profile',
                 description=f"You have edited company profile.",
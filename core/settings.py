@@ -129,6 +129,13 @@ MEDIA_HOUSE_PATH = BASE_DIR / 'media' / 'house'
 if not MEDIA_HOUSE_PATH.exists():
     MEDIA_HOUSE_PATH.mkdir(exist_ok=True)
 
+# Stream every upload straight to a temp file, image checks then read only the headers from disk
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+# Resized house image copies (houses/images.py) - built in a process pool after upload
+HOUSE_IMAGE_WORKERS = int(os.environ.get('HOUSE_IMAGE_WORKERS', 2))
+HOUSE_IMAGE_DERIVATIVES_SYNC = False
+
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -151,6 +158,14 @@ RECAPTCHA_PUBLIC_KEY = os.environ.get('RECAPTCHA_PUBLIC_KEY', '')
 RECAPTCHA_SITE_KEY = os.environ.get('RECAPTCHA_SITE_KEY', '')
 RECAPTCHA_SECRET_KEY = os.environ.get('RECAPTCHA_SECRET_KEY', '')
 RECAPTCHA_REQUIRED_SCORE = 0.85
+# total seconds a review submission may wait on siteverify
+RECAPTCHA_TIMEOUT = float(os.environ.get('RECAPTCHA_TIMEOUT', 3))
+RECAPTCHA_CLIENT = 'houses.recaptcha.RecaptchaClient'
+
+# buffer Activity rows and write them in batches off the request path (houses.activity)
+ACTIVITY_WRITE_BEHIND = True
+# raw Activity rows older than this are rolled up into daily summaries every night
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', 90))
 
 # Another API key
 ANOTHER_API_KEY = os.environ.get('ANOTHER_API_KEY', 'AQ.Ab8RN6J-R-cDhJqWCWzqWPaPDh0XaCi4DtMfpW6Qw3NkqHYY8Q')
@@ -193,3 +208,23 @@ MPESA_PASSKEY = os.environ.get("MPESA_PASSKEY", '')
 MPESA_CALLBACK_URL = os.environ.get("MPESA_CALLBACK_URL", '')
 MPESA_OAUTH_URL = os.environ.get("MPESA_OAUTH_URL", '')
 MPESA_STK_PUSH_URL = os.environ.get("MPESA_STK_PUSH_URL", '')
+MPESA_STK_QUERY_URL = os.environ.get("MPESA_STK_QUERY_URL", '')
+# shared by all workers on the host, defaults to a file in the temp dir (payments.tokens)
+MPESA_TOKEN_CACHE_PATH = os.environ.get('MPESA_TOKEN_CACHE_PATH', '')
+# STK pushes are sent from a thread pool after the request returns (payments.dispatch)
+MPESA_DISPATCH_WORKERS = int(os.environ.get('MPESA_DISPATCH_WORKERS', 8))
+MPESA_DISPATCH_SYNC = False
+# payments still 'processing' this long lost their push (e.g. to a restart) and are failed
+MPESA_DISPATCH_STALE_MINUTES = 5
+# how long the processing page's long poll is held open (payments.notify), each holds a
+# gunicorn thread (gunicorn.conf.py) for that long
+PAYMENT_LONG_POLL_SECONDS = 10
+# pending payments without a callback this long are asked about (payments.reconcile)
+MPESA_RECONCILE_AFTER_MINUTES = 10
+# ...and failed if M-Pesa still has no result for them this long after
+MPESA_RECONCILE_GIVE_UP_HOURS = 24
+MPESA_RECONCILE_WORKERS = int(os.environ.get('MPESA_RECONCILE_WORKERS', 16))
+# background jobs (payments.scheduler) run in one process per host, the one holding this lock;
+# turn SCHEDULER_ENABLED off on every host but one
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_LOCK_PATH = os.environ.get('SCHEDULER_LOCK_PATH', '')
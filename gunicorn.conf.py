@@ -0,0 +1,23 @@
+"""
+Gunicorn settings, picked up by `gunicorn core.wsgi` from the project root.
+
+The payment processing page long-polls payment/wait/<id>/, which holds its
+request for up to PAYMENT_LONG_POLL_SECONDS. Threaded workers keep a waiting
+payer to one thread instead of a whole worker process.
+
+Every worker imports the app, but only one process per host runs the
+background jobs (payments.scheduler holds a lock file for that). Running the
+app on more than one host, set SCHEDULER_ENABLED=false on all but one.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'core.wsgi:application'
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# longer than the long poll, so a held request is never taken for a hung worker
+timeout = 60
+graceful_timeout = 30
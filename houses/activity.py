@@ -0,0 +1,207 @@
+"""
+Write-behind activity log.
+
+record_activity() doesn't INSERT anything in the request: once the current
+transaction commits (so rolled back work leaves no trace) the Activity is put
+in a buffer, and a background thread writes the buffer out with one
+bulk_create every FLUSH_INTERVAL seconds, or as soon as BATCH_SIZE entries are
+waiting. The buffer never holds more than MAX_BUFFERED entries - a request
+that finds it full flushes it itself. Whatever is left is flushed when the
+process exits.
+
+With settings.ACTIVITY_WRITE_BEHIND off every activity is saved on the spot.
+
+Retention
+---------
+compact_activity() runs nightly from payments.scheduler: activities older than
+settings.ACTIVITY_RETENTION_DAYS are rolled up into one ActivityDailySummary
+per user, house, type and day, then deleted in batches. The dashboard only
+ever shows the latest few, so the raw table just has to cover recent history.
+"""
+import atexit
+import datetime
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+MAX_BUFFERED = 1000
+FLUSH_INTERVAL = 2
+
+
+class ActivityRecorder:
+    def __init__(self, batch_size=BATCH_SIZE, max_buffered=MAX_BUFFERED, interval=FLUSH_INTERVAL, background=True):
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.interval = interval
+        self.background = background
+
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        # one flush at a time, so entries are written in the order they came
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, activity):
+        with self._lock:
+            self._buffer.append(activity)
+            pending = len(self._buffer)
+        if not self.background or pending >= self.max_buffered:
+            if pending >= self.batch_size:
+                self.flush()
+            return
+        self._start()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """ Write everything buffered so far, returns how many were written """
+        from houses.models import Activity, House
+
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if not batch:
+                return 0
+            try:
+                # a house deleted since took its activities with it, don't bring them back
+                house_ids = {activity.house_id for activity in batch if activity.house_id}
+                if house_ids:
+                    existing = set(House.objects.filter(id__in=house_ids).values_list('id', flat=True))
+                    batch = [activity for activity in batch if not activity.house_id or activity.house_id in existing]
+                Activity.objects.bulk_create(batch, batch_size=self.batch_size)
+                return len(batch)
+            except Exception:
+                logger.exception("Could not write %s activities", len(batch))
+                return 0
+
+    def _start(self):
+        if self._thread is not None or self._stopped:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='activity-recorder', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+    def close(self):
+        """ Stop the background thread and write what's left """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = ActivityRecorder()
+            atexit.register(_recorder.close)
+        return _recorder
+
+
+def record_activity(activity_type, user=None, house=None, description=None):
+    """ Log an Activity without making the request wait for the INSERT """
+    from houses.models import Activity
+
+    # ids only: the buffer shouldn't keep model instances alive, and a house may be gone by the flush
+    activity = Activity(
+        user_id=user.pk if user else None,
+        activity_type=activity_type,
+        house_id=house.pk if house else None,
+        description=description,
+        created_at=timezone.now(),
+    )
+    if not getattr(settings, 'ACTIVITY_WRITE_BEHIND', True):
+        activity.save()
+        return
+    transaction.on_commit(lambda: get_recorder().add(activity))
+
+
+COMPACT_BATCH_SIZE = 1000
+
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def _compact_day(day, batch_size):
+    from houses.models import Activity, ActivityDailySummary
+
+    start, end = _start_of_day(day), _start_of_day(day + datetime.timedelta(days=1))
+    activities = Activity.objects.filter(created_at__gte=start, created_at__lt=end).order_by()
+
+    groups = activities.values('user_id', 'house_id', 'activity_type').annotate(
+        count=Count('id'), first_at=Min('created_at'), last_at=Max('created_at'),
+    )
+    existing = {
+        (summary.user_id, summary.house_id, summary.activity_type): summary
+        for summary in ActivityDailySummary.objects.filter(day=day)
+    }
+    created, updated = [], []
+    for group in groups:
+        summary = existing.get((group['user_id'], group['house_id'], group['activity_type']))
+        if summary is None:
+            created.append(ActivityDailySummary(day=day, **group))
+        else:
+            summary.count += group['count']
+            summary.first_at = min(summary.first_at, group['first_at'])
+            summary.last_at = max(summary.last_at, group['last_at'])
+            updated.append(summary)
+    ActivityDailySummary.objects.bulk_create(created)
+    ActivityDailySummary.objects.bulk_update(updated, ['count', 'first_at', 'last_at'])
+
+    removed = 0
+    while ids := list(activities.values_list('id', flat=True)[:batch_size]):
+        removed += Activity.objects.filter(id__in=ids).delete()[0]
+    return removed, len(created) + len(updated)
+
+
+def compact_activity(retention_days=None, batch_size=COMPACT_BATCH_SIZE):
+    """
+    Roll up and delete activities from before the retention window, a day at a
+    time, each day in its own transaction. Returns (activities removed, summaries written).
+    """
+    from houses.models import Activity
+
+    if retention_days is None:
+        retention_days = settings.ACTIVITY_RETENTION_DAYS
+    cutoff = _start_of_day(timezone.localdate() - datetime.timedelta(days=retention_days))
+
+    removed = summaries = 0
+    while True:
+        oldest = Activity.objects.filter(created_at__lt=cutoff).order_by('created_at').values_list('created_at', flat=True).first()
+        if oldest is None:
+            break
+        with transaction.atomic():
+            day_removed, day_summaries = _compact_day(timezone.localdate(oldest), batch_size)
+        removed += day_removed
+        summaries += day_summaries
+    if removed:
+        logger.info("Compacted %s activities into %s daily summaries", removed, summaries)
+    return removed, summaries
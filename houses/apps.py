@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class HousesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'houses'
+
+    def ready(self):
+        from houses import signals  # noqa: F401
+        from houses.search import install_search_index
+        post_migrate.connect(install_search_index, sender=self)
@@ -0,0 +1,159 @@
+"""
+Caches for the public listing pages: rendered cards and whole anonymous pages.
+
+Listing cards
+-------------
+A card's HTML only changes when the house is saved (updated_at), its cover
+image changes or gets new renditions (cover id + updated_at), it gets a
+review, or the "Posted ... ago" text moves on - all of these are part of the
+key, so entries never have to be invalidated, they just stop being asked for
+and expire.
+
+Listing pages fetch every card of the page in one get_many and only render
+the misses. Hits and misses are counted in the cache itself so the numbers
+add up across worker processes.
+
+Anonymous home pages
+--------------------
+Whole home feed pages for visitors who are not logged in, keyed on the
+normalized filter parameters. Every key includes a feed version that is
+bumped whenever a listing appears in, leaves or changes inside the public
+feed, so a cached page is never older than the last such change.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.timesince import timesince
+
+CARD_TEMPLATE = 'partials/house_part.html'
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+CARD_HITS_KEY = 'houses:card:hits'
+CARD_MISSES_KEY = 'houses:card:misses'
+
+
+def card_cache_key(house):
+    cover = house.cover_image
+    version = '|'.join([
+        house.updated_at.isoformat(),
+        f'{cover.id}:{cover.updated_at.isoformat()}' if cover else '-',
+        timesince(house.date_posted),
+        # review stats are updated without touching updated_at
+        f'{house.review_count}:{house.rating_sum}',
+    ])
+    return f'houses:card:{house.id}:{hashlib.md5(version.encode()).hexdigest()}'
+
+
+def _count(key, amount):
+    if not amount:
+        return
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # first use, or the counter was evicted
+        if not cache.add(key, amount, None):
+            cache.incr(key, amount)
+
+
+def render_cards(houses):
+    """
+    Set house.card_html on every house, from the cache where possible.
+
+    houses should come with select_related('cover_image').
+    """
+    houses = list(houses)
+    keys = {house.id: card_cache_key(house) for house in houses}
+    cached = cache.get_many(keys.values())
+
+    rendered = {}
+    for house in houses:
+        key = keys[house.id]
+        if key in cached:
+            house.card_html = cached[key]
+        else:
+            house.card_html = rendered[key] = render_to_string(CARD_TEMPLATE, {'house': house})
+
+    if rendered:
+        cache.set_many(rendered, CARD_CACHE_TIMEOUT)
+    _count(CARD_HITS_KEY, len(houses) - len(rendered))
+    _count(CARD_MISSES_KEY, len(rendered))
+    return houses
+
+
+def card_cache_stats():
+    counts = cache.get_many([CARD_HITS_KEY, CARD_MISSES_KEY])
+    hits = counts.get(CARD_HITS_KEY, 0)
+    misses = counts.get(CARD_MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+    }
+
+
+def reset_card_cache_stats():
+    cache.delete_many([CARD_HITS_KEY, CARD_MISSES_KEY])
+
+
+HOME_PAGE_CACHE_TIMEOUT = 60 * 5
+# the GET parameters home() reads; a request with anything else is not cached
+HOME_PAGE_PARAMS = ['search', 'sort', 'house_type', 'min_rent', 'max_rent', 'cursor', 'page']
+FEED_VERSION_KEY = 'houses:feed:version'
+
+
+def feed_version():
+    version = cache.get(FEED_VERSION_KEY)
+    if version is None:
+        # start from the clock, not 1, so an evicted counter can't bring back old pages
+        cache.add(FEED_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(FEED_VERSION_KEY)
+    return version
+
+
+def bump_feed_version():
+    """ Call when a house enters, leaves or changes within the public feed """
+    try:
+        cache.incr(FEED_VERSION_KEY)
+    except ValueError:
+        cache.set(FEED_VERSION_KEY, time.time_ns(), None)
+
+
+def _has_pending_messages(request):
+    return 'messages' in request.COOKIES or bool(request.session.get('_messages'))
+
+
+def anonymous_page_key(request, name):
+    """ Cache key for this request's page, None when the page must not come from the cache """
+    if request.method != 'GET' or request.user.is_authenticated or _has_pending_messages(request):
+        return None
+
+    params = {}
+    for param, values in request.GET.lists():
+        if param not in HOME_PAGE_PARAMS:
+            return None
+        value = values[-1].strip()
+        if value:
+            params[param] = value
+
+    normalized = '&'.join(f'{param}={params[param]}' for param in sorted(params))
+    return f'houses:page:{name}:{feed_version()}:{hashlib.md5(normalized.encode()).hexdigest()}'
+
+
+def cached_page(key):
+    content = cache.get(key) if key else None
+    if content is None:
+        return None
+    response = HttpResponse(content)
+    response['X-Page-Cache'] = 'hit'
+    return response
+
+
+def store_page(key, response):
+    """ Keep a rendered page, unless it sets cookies or isn't a plain 200 """
+    if key and response.status_code == 200 and not response.cookies:
+        cache.set(key, response.content, HOME_PAGE_CACHE_TIMEOUT)
+        response['X-Page-Cache'] = 'miss'
+    return response
@@ -0,0 +1,101 @@
+"""
+Facet counts for the listing filters.
+
+For the current search, how many listings each house type and each rent band
+would return - all from one aggregate query with a filtered COUNT per facet
+value. As usual for facets, the type counts respect the chosen rent range and
+the rent counts respect the chosen type, but neither respects its own filter,
+so the other options stay visible.
+"""
+import hashlib
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+FACET_CACHE_TIMEOUT = 60
+RENT_STEP = Decimal('0.01')
+
+# (key, label, min rent, max rent) - half-open, from the min up to but not including the max,
+# so a rent on a boundary falls in exactly one band
+RENT_BUCKETS = [
+    ('under_5k', 'Under KES 5,000', None, 5000),
+    ('5k_10k', 'KES 5,000 - 10,000', 5000, 10000),
+    ('10k_20k', 'KES 10,000 - 20,000', 10000, 20000),
+    ('20k_50k', 'KES 20,000 - 50,000', 20000, 50000),
+    ('over_50k', 'Over KES 50,000', 50000, None),
+]
+
+
+def _rent_q(min_rent, max_rent):
+    condition = Q()
+    if min_rent not in (None, ''):
+        condition &= Q(rent__gte=Decimal(min_rent))
+    if max_rent not in (None, ''):
+        condition &= Q(rent__lte=Decimal(max_rent))
+    return condition
+
+
+def _bucket_q(low, high):
+    condition = Q()
+    if low is not None:
+        condition &= Q(rent__gte=low)
+    if high is not None:
+        condition &= Q(rent__lt=high)
+    return condition
+
+
+def _filter_max(high):
+    # the min_rent/max_rent filter is inclusive and rent has two decimal places,
+    # so picking a band filters up to the last cent below its max
+    return None if high is None else Decimal(high) - RENT_STEP
+
+
+def _count(condition):
+    return Count('id', filter=condition) if condition else Count('id')
+
+
+def facet_counts(houses, house_type='', min_rent='', max_rent='', use_cache=False):
+    """
+    {'house_types': [(value, label, count)], 'rent_buckets': [{key, label, min, max, count}], 'total': n}
+
+    houses is the queryset *before* the house type and rent filters are applied.
+    With use_cache the result is kept for FACET_CACHE_TIMEOUT seconds, meant for
+    the unfiltered feed that most visitors land on.
+    """
+    from houses.models import House
+
+    try:
+        rent_q = _rent_q(min_rent, max_rent)
+    except InvalidOperation:
+        rent_q = Q()
+    type_q = Q(house_type=house_type) if house_type else Q()
+
+    aggregates = {'total': _count(type_q & rent_q)}
+    for value, _ in House.HOUSE_TYPES:
+        aggregates[f'type_{value}'] = _count(Q(house_type=value) & rent_q)
+    for key, _, low, high in RENT_BUCKETS:
+        aggregates[f'rent_{key}'] = _count(_bucket_q(low, high) & type_q)
+
+    houses = houses.order_by()
+    cache_key = None
+    if use_cache:
+        cache_key = 'houses:facets:' + hashlib.md5(
+            f'{houses.query}|{house_type}|{min_rent}|{max_rent}'.encode()
+        ).hexdigest()
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    counts = houses.aggregate(**aggregates)
+    facets = {
+        'house_types': [(value, label, counts[f'type_{value}']) for value, label in House.HOUSE_TYPES],
+        'rent_buckets': [
+            {'key': key, 'label': label, 'min': low, 'max': _filter_max(high), 'count': counts[f'rent_{key}']}
+            for key, label, low, high in RENT_BUCKETS
+        ],
+        'total': counts['total'],
+    }
+    if cache_key:
+        cache.set(cache_key, facets, FACET_CACHE_TIMEOUT)
+    return facets
@@ -0,0 +1,170 @@
+"""
+Geohash grid over House.latitude / longitude.
+
+Every listing with coordinates stores its geohash, an indexed string where a
+shared prefix means a shared grid cell. A radius or bounding-box search covers
+the area with a handful of cells, reads each run of cells with an index range
+scan and only computes exact distances for the rows those ranges return.
+"""
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+GEOHASH_PRECISION = 9  # ~5m cells, finer than anyone pins a house
+
+# a search area is covered by at most this many cells
+MAX_COVER_CELLS = 32
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    latitude, longitude = float(latitude), float(longitude)
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True  # even bits split longitude, odd bits latitude
+
+    while len(geohash) < precision:
+        value, value_range = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def cell_size(precision):
+    """ (height, width) of a cell in degrees """
+    lng_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def cover(min_lat, min_lng, max_lat, max_lng, max_cells=MAX_COVER_CELLS, max_precision=GEOHASH_PRECISION):
+    """ Sorted geohash prefixes whose cells together contain the bounding box. """
+    min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+    min_lng, max_lng = max(min_lng, -180.0), min(max_lng, 180.0)
+
+    for precision in range(max_precision, 0, -1):
+        height, width = cell_size(precision)
+        rows = range(int((min_lat + 90) // height), int((max_lat + 90) // height) + 1)
+        columns = range(int((min_lng + 180) // width), int((max_lng + 180) // width) + 1)
+        if len(rows) * len(columns) <= max_cells or precision == 1:
+            break
+
+    cells = set()
+    for row in rows:
+        for column in columns:
+            # encode the cell centre, clamped so the last row/column stays on the map
+            latitude = min(-90 + (row + 0.5) * height, 90.0 - height / 2)
+            longitude = min(-180 + (column + 0.5) * width, 180.0 - width / 2)
+            cells.add(encode(latitude, longitude, precision))
+    return sorted(cells)
+
+
+def _successor(prefix):
+    """ The next cell of the same precision in geohash order, None after 'zzz...' """
+    for position in range(len(prefix) - 1, -1, -1):
+        index = BASE32.index(prefix[position])
+        if index < len(BASE32) - 1:
+            return prefix[:position] + BASE32[index + 1] + BASE32[0] * (len(prefix) - position - 1)
+    return None
+
+
+def _next_prefix(prefix):
+    """ The shortest string after every geohash starting with prefix, None past 'zzz...' """
+    for position in range(len(prefix) - 1, -1, -1):
+        index = BASE32.index(prefix[position])
+        if index < len(BASE32) - 1:
+            return prefix[:position] + BASE32[index + 1]
+    return None
+
+
+def cover_ranges(prefixes):
+    """
+    Merge sorted, same-length prefixes into [low, high) geohash ranges.
+
+    Neighbouring cells are often consecutive in geohash order, so a cover of
+    32 cells is usually only a few ranges. The upper bound is the next prefix
+    ('kzf' -> 'kzg', 'kzz' -> 'm'), which holds under any collation that sorts
+    digits before letters; it is None for a range running to the end of 'zzz...'.
+    """
+    ranges = []
+    for prefix in prefixes:
+        if ranges and _successor(ranges[-1][1]) == prefix:
+            ranges[-1][1] = prefix
+        else:
+            ranges.append([prefix, prefix])
+    return [(low, _next_prefix(high)) for low, high in ranges]
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """ (min_lat, min_lng, max_lat, max_lng) around a point """
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    # longitude degrees shrink towards the poles
+    lng_delta = lat_delta / max(math.cos(math.radians(latitude)), 0.01)
+    return latitude - lat_delta, longitude - lng_delta, latitude + lat_delta, longitude + lng_delta
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (float(lat1), float(lng1), float(lat2), float(lng2)))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def range_scans(queryset, field, ranges, *fields):
+    """
+    UNION ALL of one indexed range scan of field per [low, high) range, high None for no upper bound.
+
+    A single WHERE with the ranges OR-ed together makes SQLite scan the whole
+    index, separate SELECTs each get an index range search.
+    """
+    scans = [
+        queryset.filter(**{f'{field}__gte': low}, **({f'{field}__lt': high} if high is not None else {})).values_list(*fields)
+        for low, high in ranges
+    ]
+    return scans[0].union(*scans[1:], all=True) if len(scans) > 1 else scans[0]
+
+
+def _range_scans(houses, min_lat, min_lng, max_lat, max_lng, *fields):
+    box = houses.order_by().filter(
+        latitude__gte=min_lat, latitude__lte=max_lat,
+        longitude__gte=min_lng, longitude__lte=max_lng,
+    )
+    return range_scans(box, 'geohash', cover_ranges(cover(min_lat, min_lng, max_lat, max_lng)), *fields)
+
+
+def within_bbox(houses, min_lat, min_lng, max_lat, max_lng):
+    """ Houses inside the box, found through the geohash index (unordered, callers sort). """
+    return houses.order_by().filter(id__in=_range_scans(houses, min_lat, min_lng, max_lat, max_lng, 'id'))
+
+
+def nearby(houses, latitude, longitude, radius_km, limit):
+    """
+    [(house_id, distance_km)] within radius_km of the point, closest first.
+
+    Only ids and coordinates of the candidates are read (straight from the
+    geohash index); callers fetch the few rows they actually show.
+    """
+    candidates = _range_scans(houses, *bounding_box(latitude, longitude, radius_km), 'id', 'latitude', 'longitude')
+    matches = []
+    for house_id, house_lat, house_lng in candidates:
+        distance = haversine_km(latitude, longitude, house_lat, house_lng)
+        if distance <= radius_km:
+            matches.append((distance, house_id))
+    matches.sort()
+    return [(house_id, distance) for distance, house_id in matches[:limit]]
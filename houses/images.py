@@ -0,0 +1,196 @@
+"""
+Upload validation and resized derivatives of house images.
+
+Uploads are checked from their temp files by reading only the image header.
+Every original gets card / gallery / full renditions in WebP and JPEG. The
+resizing happens in a process pool once the upload transaction commits, so
+post_house and edit_house return as soon as the originals are stored. Until a
+rendition exists, templates fall back to the original file.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from houses.caching import bump_feed_version
+
+logger = logging.getLogger(__name__)
+
+# rendition name -> maximum width in pixels
+RENDITIONS = {
+    'card': 480,
+    'gallery': 960,
+    'full': 1600,
+}
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+DERIVATIVES_DIR = 'house/derivatives'
+
+# upload limits
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_IMAGE_DIMENSION = 10000
+ALLOWED_IMAGE_FORMATS = {'JPEG', 'MPO', 'PNG', 'WEBP', 'GIF'}
+
+_pool = None
+
+
+def check_image_header(upload):
+    """
+    Error message for a bad upload, None if it looks like a usable image.
+
+    Image.open() only parses the header, so this reads a few KB from the temp
+    file no matter how large the photo is - the pixels are never decoded.
+    """
+    if upload.size > MAX_IMAGE_BYTES:
+        return f"Image {upload.name} is too large. Maximum size is 20MB."
+
+    try:
+        upload.seek(0)
+        with Image.open(upload) as image:
+            width, height = image.size
+            image_format = image.format
+    except Exception:
+        return f"Invalid image file: {upload.name}. Please upload valid images only."
+    finally:
+        upload.seek(0)
+
+    if image_format not in ALLOWED_IMAGE_FORMATS:
+        return f"Invalid image file: {upload.name}. Please upload valid images only."
+    if width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION:
+        return f"Image {upload.name} dimensions are too large."
+    return None
+
+
+def validate_uploaded_images(uploads):
+    """
+    Check every upload in turn, returns the first error message or None.
+
+    A header read takes a fraction of a millisecond, so a thread pool would
+    only add overhead for the handful of photos one form can post.
+    """
+    for upload in uploads:
+        error = check_image_header(upload)
+        if error:
+            return error
+    return None
+
+
+def render_derivatives(source_path, media_root, stem):
+    """
+    Write every rendition of source_path under media_root/DERIVATIVES_DIR.
+
+    Runs inside the worker process, so it only touches Pillow and the
+    filesystem - no Django models or database connections.
+    """
+    output_dir = Path(media_root) / DERIVATIVES_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    renditions = {}
+    with Image.open(source_path) as original:
+        # let the JPEG decoder downscale while decoding instead of loading the full 20MB bitmap
+        largest = max(RENDITIONS.values())
+        original.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+        for name, max_width in sorted(RENDITIONS.items(), key=lambda item: -item[1]):
+            if image.width > max_width:
+                height = round(image.height * max_width / image.width)
+                image = image.resize((max_width, height), Image.LANCZOS)
+
+            rendition = {'width': image.width, 'height': image.height}
+            for extension, (pil_format, options) in FORMATS.items():
+                relative_path = f"{DERIVATIVES_DIR}/{stem}-{name}.{extension}"
+                image.save(Path(media_root) / relative_path, pil_format, **options)
+                rendition[extension] = relative_path
+            renditions[name] = rendition
+
+    return renditions
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the web worker has open sockets and threads we must not copy
+        _pool = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'HOUSE_IMAGE_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _pool
+
+
+def shutdown_pool():
+    """Wait for queued resizing (and its callbacks) to finish"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def _stem(image):
+    return f"{image.id}-{Path(image.image.name).stem}"
+
+
+def _save_renditions(image_id, renditions):
+    from houses.models import HouseImage
+    # bump updated_at so the card cache picks up the new renditions
+    if HouseImage.objects.filter(id=image_id).update(renditions=renditions, updated_at=timezone.now()):
+        # and the feed version so cached pages pick up the new srcset
+        bump_feed_version()
+
+
+def _on_done(image_id, future):
+    try:
+        _save_renditions(image_id, future.result())
+    except Exception:
+        logger.exception("Failed to build derivatives for house image %s", image_id)
+    finally:
+        # callbacks run on the pool's manager thread, don't leave its connection open
+        connections.close_all()
+
+
+def build_derivatives(image_ids):
+    """Submit resizing for the given HouseImage ids to the pool, returns the futures"""
+    from houses.models import HouseImage
+
+    futures = []
+    for image in HouseImage.objects.filter(id__in=image_ids).only('id', 'image'):
+        source_path = default_storage.path(image.image.name)
+        if not os.path.exists(source_path):
+            continue
+
+        if getattr(settings, 'HOUSE_IMAGE_DERIVATIVES_SYNC', False):
+            try:
+                _save_renditions(image.id, render_derivatives(source_path, str(settings.MEDIA_ROOT), _stem(image)))
+            except Exception:
+                logger.exception("Failed to build derivatives for house image %s", image.id)
+            continue
+
+        future = get_pool().submit(render_derivatives, source_path, str(settings.MEDIA_ROOT), _stem(image))
+        future.add_done_callback(lambda f, image_id=image.id: _on_done(image_id, f))
+        futures.append(future)
+    return futures
+
+
+def schedule_derivatives(image_ids):
+    """Resize once the surrounding transaction commits, off the request path"""
+    image_ids = list(image_ids)
+    if image_ids:
+        transaction.on_commit(lambda: build_derivatives(image_ids))
+
+
+def delete_derivatives(image):
+    for rendition in (image.renditions or {}).values():
+        for extension in FORMATS:
+            if rendition.get(extension):
+                default_storage.delete(rendition[extension])
@@ -0,0 +1,98 @@
+import io
+import os
+import resource
+import time
+import tracemalloc
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from houses.images import validate_uploaded_images
+
+
+def make_upload(index, size_mb, width, height, image_format):
+    """
+    A size_mb upload streamed into a temp file. JPEGs are a small real image
+    padded with trailing bytes; PNGs are uncompressed noise, so verify() has to
+    read every byte of them.
+    """
+    header = io.BytesIO()
+    if image_format == 'png':
+        side = int((size_mb * 1024 * 1024 / 3) ** 0.5)
+        Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(header, 'PNG', compress_level=0)
+    else:
+        Image.new('RGB', (width, height), (index * 15 % 255, 120, 80)).save(header, 'JPEG')
+
+    upload = TemporaryUploadedFile(f'photo-{index}.{image_format}', f'image/{image_format}', 0, None)
+    upload.write(header.getvalue())
+    chunk = b'\0' * (1024 * 1024)
+    remaining = size_mb * 1024 * 1024 - len(header.getvalue())
+    while remaining > 0:
+        upload.write(chunk[:remaining])
+        remaining -= len(chunk)
+    upload.size = upload.tell()
+    upload.seek(0)
+    return upload
+
+
+def legacy_validation(uploads):
+    """What post_house used to do: open + verify() every file, one after another"""
+    for upload in uploads:
+        image = Image.open(upload)
+        image.verify()
+        upload.seek(0)
+        width, height = image.size
+        if width > 10000 or height > 10000:
+            return "too large"
+    return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark time and peak memory of validating a post_house upload batch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=15)
+        parser.add_argument('--size-mb', type=int, default=20)
+        parser.add_argument('--width', type=int, default=4000)
+        parser.add_argument('--height', type=int, default=3000)
+        parser.add_argument('--rounds', type=int, default=5)
+        parser.add_argument('--format', choices=['jpeg', 'png'], default='jpeg')
+
+    def measure(self, label, validator, uploads, rounds):
+        timings = []
+        peak = 0
+        for _ in range(rounds):
+            tracemalloc.start()
+            started = time.perf_counter()
+            validator(uploads)
+            timings.append(time.perf_counter() - started)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            for upload in uploads:
+                upload.seek(0)
+
+        timings.sort()
+        self.stdout.write(
+            f"{label:<10} median {timings[len(timings) // 2] * 1000:8.1f} ms   "
+            f"max {timings[-1] * 1000:8.1f} ms   peak traced memory {peak / 1024:8.1f} KB"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Creating {options['images']} x {options['size_mb']}MB {options['format'].upper()} files in temp files..."
+        )
+        uploads = [
+            make_upload(index, options['size_mb'], options['width'], options['height'], options['format'])
+            for index in range(options['images'])
+        ]
+
+        try:
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.measure('streaming', validate_uploaded_images, uploads, options['rounds'])
+            self.measure('legacy', legacy_validation, uploads, options['rounds'])
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.stdout.write(f"max RSS grew by {(rss_after - rss_before) / 1024:.1f} MB during the run")
+        finally:
+            for upload in uploads:
+                upload.close()
@@ -0,0 +1,29 @@
+from concurrent.futures import wait
+
+from django.core.management.base import BaseCommand
+
+from houses.images import build_derivatives, shutdown_pool
+from houses.models import HouseImage
+
+
+class Command(BaseCommand):
+    help = "Build card/gallery/full WebP and JPEG renditions for house images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Rebuild images that already have renditions")
+        parser.add_argument('--batch-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        images = HouseImage.objects.order_by('id')
+        if not options['all']:
+            images = images.filter(renditions={})
+
+        ids = list(images.values_list('id', flat=True))
+        batch_size = options['batch_size']
+        for start in range(0, len(ids), batch_size):
+            wait(build_derivatives(ids[start:start + batch_size]))
+            self.stdout.write(f"Processed {min(start + batch_size, len(ids))}/{len(ids)} images")
+
+        # renditions are saved by the pool's callbacks, let them finish before exiting
+        shutdown_pool()
+        self.stdout.write(self.style.SUCCESS("Done"))
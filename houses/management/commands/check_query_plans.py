@@ -0,0 +1,107 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from houses import geo
+from houses.models import Activity, House
+from houses.pagination import KEYSET_ORDERINGS, KeysetPaginator
+from payments.models import Payment
+from reviews.models import Review
+
+PRIMARY_KEY_MARKERS = ['PRIMARY KEY', '_pkey', 'PRIMARY']
+
+
+def public_feed(sort):
+    houses = House.objects.filter(is_active=True, payment_status='paid')
+    return houses.order_by(*KEYSET_ORDERINGS[sort])[:6]
+
+
+def public_feed_next_page():
+    houses = House.objects.filter(is_active=True, payment_status='paid')
+    paginator = KeysetPaginator(houses, 5, '-date_posted')
+    after = paginator._after(paginator.ordering, [timezone.now(), 1])
+    return houses.filter(after).order_by(*paginator.ordering)[:6]
+
+
+def dashboard(sort):
+    return House.objects.filter(owner_id=1).order_by(*KEYSET_ORDERINGS[sort])[:6]
+
+
+def nearby_bedsitters():
+    houses = House.objects.filter(is_active=True, payment_status='paid', house_type='bedsitter')
+    return geo.within_bbox(houses, *geo.bounding_box(-1.2921, 36.8219, 2))
+
+
+def review_page():
+    reviews = Review.objects.filter(house_id=1)
+    paginator = KeysetPaginator(reviews, 10, '-created_at')
+    after = paginator._after(paginator.ordering, [timezone.now(), 1])
+    return reviews.filter(after).order_by(*paginator.ordering)[:11]
+
+
+def query_shapes():
+    """ (name, queryset, markers) - the plan must mention at least one marker. """
+    return [
+        ('home: newest first', public_feed('-date_posted'), ['house_public_date_idx']),
+        ('home: oldest first', public_feed('date_posted'), ['house_public_date_idx']),
+        ('home: next page', public_feed_next_page(), ['house_public_date_idx']),
+        ('home: rent low-high', public_feed('rent'), ['house_public_rent_idx']),
+        ('home: rent high-low', public_feed('-rent'), ['house_public_rent_idx']),
+        ('home: title', public_feed('title'), ['house_public_title_idx']),
+        ('dashboard: newest first', dashboard('-date_posted'), ['house_owner_date_idx']),
+        ('dashboard: rent', dashboard('rent'), ['house_owner_rent_idx']),
+        ('dashboard: title', dashboard('-title'), ['house_owner_title_idx']),
+        ('nearby: bedsitters within 2km', nearby_bedsitters(), ['house_public_geohash_idx']),
+        ('house_detail', House.objects.filter(id=1, is_active=True), PRIMARY_KEY_MARKERS),
+        ('house reviews: next page', review_page(), ['review_house_created_idx']),
+        (
+            'dashboard: recent activity',
+            Activity.objects.filter(user_id=1).select_related('house').order_by('-created_at')[:5],
+            ['activity_user_created_idx']
+        ),
+        ('activity compaction scan', Activity.objects.filter(created_at__lt=timezone.now()).order_by('created_at')[:1], ['activity_created_idx']),
+        ('mpesa callback lookup', Payment.objects.filter(checkout_request_id='ws_CO_1'), ['payment_checkout_idx']),
+        (
+            'stuck payment reconciliation',
+            Payment.objects.filter(status='pending', created_at__lt=timezone.now()).exclude(checkout_request_id='').order_by(),
+            ['payment_pending_created_idx']
+        ),
+        (
+            'stale STK dispatch sweep',
+            Payment.objects.filter(status='processing', dispatched_at__lt=timezone.now()).order_by(),
+            ['payment_dispatched_idx']
+        ),
+        ('payment history', Payment.objects.filter(user_id=1).order_by('-created_at'), ['payment_user_created_idx']),
+        (
+            'payment expiry scan',
+            Payment.objects.filter(is_verified=True, payment_date__lte=timezone.now() - timedelta(days=547)),
+            ['payment_verified_date_idx']
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Run EXPLAIN on the listing, dashboard, detail and payment queries and check they use their indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help="Print the full plan for every query")
+
+    def handle(self, *args, **options):
+        failures = []
+
+        for name, queryset, markers in query_shapes():
+            plan = queryset.explain()
+            used = [marker for marker in markers if marker in plan]
+
+            if used:
+                self.stdout.write(self.style.SUCCESS(f"OK    {name} ({used[0]})"))
+            else:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f"FAIL  {name}: expected one of {', '.join(markers)}"))
+
+            if options['verbose_plans'] or not used:
+                self.stdout.write(f"      {plan.replace(chr(10), chr(10) + '      ')}")
+
+        if failures:
+            raise CommandError(f"{len(failures)} query plan(s) are not using the expected index")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from houses.activity import compact_activity
+
+
+class Command(BaseCommand):
+    help = "Roll activities older than ACTIVITY_RETENTION_DAYS into daily summaries and delete them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Keep this many days of raw activity instead of the setting")
+
+    def handle(self, *args, **options):
+        removed, summaries = compact_activity(options['days'])
+        self.stdout.write(self.style.SUCCESS(f"Compacted {removed} activities into {summaries} daily summaries"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from houses import mapgrid
+
+
+class Command(BaseCommand):
+    help = "Recompute the map cluster grid from the active, paid listings"
+
+    def handle(self, *args, **options):
+        cells = mapgrid.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt map grid: {cells} cells over {mapgrid.MAP_GRID_LEVELS} levels"))
@@ -0,0 +1,145 @@
+"""
+Precomputed marker clusters for the listings map.
+
+MapGridCell keeps a count and coordinate sums of the public listings in every
+geohash cell of length 1..MAP_GRID_LEVELS, so a map request reads at most a
+few hundred small rows no matter how many listings there are. Cells are
+adjusted in place whenever a listing appears on or disappears from the map
+(payment confirmed, payment expired, moved, deleted); rebuild() recomputes the
+whole grid from the houses table.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Substr
+
+from houses import geo
+
+MAP_GRID_LEVELS = 8
+
+# from this zoom on individual listings are shown instead of clusters
+MAP_MARKER_ZOOM = 16
+
+MAP_POINT_FIELDS = {'is_active', 'payment_status', 'geohash', 'latitude', 'longitude'}
+
+# the house was loaded without its map fields, so its previous position is not known
+UNKNOWN_MAP_POINT = object()
+
+
+def map_point(house):
+    """ (geohash, latitude, longitude) of a listing shown on the map, else None """
+    if not (house.is_active and house.payment_status == 'paid' and house.geohash):
+        return None
+    return house.geohash, float(house.latitude), float(house.longitude)
+
+
+def zoom_to_level(zoom):
+    """
+    Deepest grid level whose cells are at least ~64px wide at this map zoom.
+
+    A web-mercator world is 256 * 2**zoom px wide, a geohash cell of length n
+    spans 360 / 2**ceil(5n / 2) degrees of longitude.
+    """
+    level = 1
+    for candidate in range(1, MAP_GRID_LEVELS + 1):
+        if -(-candidate * 5 // 2) <= zoom + 2:
+            level = candidate
+    return level
+
+
+def adjust(point, delta):
+    """ Add (delta=1) or remove (delta=-1) one listing at point on every level """
+    from houses.models import MapGridCell
+
+    geohash, latitude, longitude = point
+    cells = [geohash[:level] for level in range(1, MAP_GRID_LEVELS + 1)]
+    with transaction.atomic():
+        if delta > 0:
+            MapGridCell.objects.bulk_create(
+                [MapGridCell(level=len(cell), cell=cell) for cell in cells], ignore_conflicts=True
+            )
+        MapGridCell.objects.filter(cell__in=cells).update(
+            count=F('count') + delta,
+            sum_lat=F('sum_lat') + delta * latitude,
+            sum_lng=F('sum_lng') + delta * longitude,
+        )
+        if delta < 0:
+            MapGridCell.objects.filter(cell__in=cells, count__lte=0).delete()
+
+
+def remove(points):
+    """ Take many listings off the map at once, in a handful of queries however many there are """
+    from houses.models import MapGridCell
+
+    deltas = {}
+    for geohash, latitude, longitude in points:
+        for level in range(1, MAP_GRID_LEVELS + 1):
+            delta = deltas.setdefault(geohash[:level], [0, 0.0, 0.0])
+            delta[0] += 1
+            delta[1] += latitude
+            delta[2] += longitude
+    if not deltas:
+        return
+    with transaction.atomic():
+        cells = list(MapGridCell.objects.select_for_update().filter(cell__in=list(deltas)))
+        for cell in cells:
+            count, sum_lat, sum_lng = deltas[cell.cell]
+            cell.count -= count
+            cell.sum_lat -= sum_lat
+            cell.sum_lng -= sum_lng
+        MapGridCell.objects.bulk_update(
+            [cell for cell in cells if cell.count > 0], ['count', 'sum_lat', 'sum_lng'], batch_size=500
+        )
+        MapGridCell.objects.filter(id__in=[cell.id for cell in cells if cell.count <= 0]).delete()
+
+
+def move(before, after):
+    """ A listing went from map point before to after (either may be None) """
+    if before == after:
+        return
+    if before is not None:
+        adjust(before, -1)
+    if after is not None:
+        adjust(after, 1)
+
+
+@transaction.atomic
+def rebuild():
+    """ Recompute every cell from the houses table, returns the number of cells """
+    from houses.models import House, MapGridCell
+
+    visible = House.objects.filter(is_active=True, payment_status='paid').exclude(geohash='').order_by()
+    MapGridCell.objects.all().delete()
+    total = 0
+    for level in range(1, MAP_GRID_LEVELS + 1):
+        rows = visible.annotate(cell=Substr('geohash', 1, level)).values('cell').annotate(
+            count=Count('id'), sum_lat=Sum('latitude'), sum_lng=Sum('longitude')
+        )
+        cells = [
+            MapGridCell(level=level, cell=row['cell'], count=row['count'],
+                        sum_lat=float(row['sum_lat']), sum_lng=float(row['sum_lng']))
+            for row in rows
+        ]
+        MapGridCell.objects.bulk_create(cells, batch_size=2000)
+        total += len(cells)
+    return total
+
+
+def clusters(min_lat, min_lng, max_lat, max_lng, level):
+    """ [{cell, count, latitude, longitude}] for the grid cells of level inside the box """
+    from houses.models import MapGridCell
+
+    prefixes = geo.cover(min_lat, min_lng, max_lat, max_lng, max_precision=level)
+    cells = geo.range_scans(
+        MapGridCell.objects.filter(level=level).order_by(), 'cell', geo.cover_ranges(prefixes),
+        'cell', 'count', 'sum_lat', 'sum_lng'
+    )
+    results = []
+    for cell, count, sum_lat, sum_lng in cells:
+        if count > 0:
+            results.append({
+                'cell': cell,
+                'count': count,
+                'latitude': round(sum_lat / count, 6),
+                'longitude': round(sum_lng / count, 6),
+            })
+    return results
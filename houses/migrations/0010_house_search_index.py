@@ -0,0 +1,26 @@
+from django.db import migrations
+
+from houses.search import get_search_backend
+
+
+def create_search_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        get_search_backend(schema_editor.connection).install(cursor)
+
+
+def drop_search_index(apps, schema_editor):
+    backend = get_search_backend(schema_editor.connection)
+    if hasattr(backend, 'uninstall'):
+        with schema_editor.connection.cursor() as cursor:
+            backend.uninstall(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0009_remove_house_listing_fee_paid'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0010_house_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(condition=models.Q(('is_active', True), ('payment_status', 'paid')), fields=['-date_posted', '-id'], name='house_public_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(condition=models.Q(('is_active', True), ('payment_status', 'paid')), fields=['rent', 'id'], name='house_public_rent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(condition=models.Q(('is_active', True), ('payment_status', 'paid')), fields=['title', 'id'], name='house_public_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(fields=['owner', '-date_posted', '-id'], name='house_owner_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(fields=['owner', 'rent', 'id'], name='house_owner_rent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(fields=['owner', 'title', 'id'], name='house_owner_title_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def set_cover_images(apps, schema_editor):
+    House = apps.get_model('houses', 'House')
+    HouseImage = apps.get_model('houses', 'HouseImage')
+    newest = HouseImage.objects.filter(house=OuterRef('pk')).order_by('-created_at', '-updated_at')
+    House.objects.update(cover_image=Subquery(newest.values('pk')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0011_house_house_public_date_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='house',
+            name='cover_image',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='houses.houseimage'),
+        ),
+        migrations.RunPython(set_cover_images, migrations.RunPython.noop),
+    ]
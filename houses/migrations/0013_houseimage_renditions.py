@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0012_house_cover_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='houseimage',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+from houses.geo import encode
+
+
+def set_geohashes(apps, schema_editor):
+    House = apps.get_model('houses', 'House')
+    houses = list(House.objects.filter(latitude__isnull=False, longitude__isnull=False).only('id', 'latitude', 'longitude'))
+    for house in houses:
+        house.geohash = encode(house.latitude, house.longitude)
+    House.objects.bulk_update(houses, ['geohash'], batch_size=2000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0013_houseimage_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='house',
+            name='geohash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=12),
+        ),
+        migrations.RunPython(set_geohashes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(condition=models.Q(('is_active', True), ('payment_status', 'paid')), fields=['geohash', 'house_type', 'latitude', 'longitude'], name='house_public_geohash_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:38
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Substr
+
+MAP_GRID_LEVELS = 8
+
+
+def build_grid(apps, schema_editor):
+    House = apps.get_model('houses', 'House')
+    MapGridCell = apps.get_model('houses', 'MapGridCell')
+    visible = House.objects.filter(is_active=True, payment_status='paid').exclude(geohash='').order_by()
+    for level in range(1, MAP_GRID_LEVELS + 1):
+        rows = visible.annotate(cell=Substr('geohash', 1, level)).values('cell').annotate(
+            count=Count('id'), sum_lat=Sum('latitude'), sum_lng=Sum('longitude')
+        )
+        MapGridCell.objects.bulk_create([
+            MapGridCell(level=level, cell=row['cell'], count=row['count'],
+                        sum_lat=float(row['sum_lat']), sum_lng=float(row['sum_lng']))
+            for row in rows
+        ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0014_house_geohash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapGridCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('cell', models.CharField(max_length=12, unique=True)),
+                ('count', models.IntegerField(default=0)),
+                ('sum_lat', models.FloatField(default=0)),
+                ('sum_lng', models.FloatField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['level', 'cell'], name='mapgridcell_level_cell_idx')],
+            },
+        ),
+        migrations.RunPython(build_grid, migrations.RunPython.noop),
+    ]
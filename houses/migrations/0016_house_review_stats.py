@@ -0,0 +1,67 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:46
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def set_review_stats(apps, schema_editor):
+    House = apps.get_model('houses', 'House')
+    Review = apps.get_model('reviews', 'Review')
+
+    def per_house(aggregate):
+        rows = Review.objects.filter(house=OuterRef('pk')).order_by().values('house').annotate(value=aggregate)
+        return Coalesce(Subquery(rows.values('value')), Value(0), output_field=IntegerField())
+
+    House.objects.update(
+        review_count=per_house(Count('id')),
+        rating_sum=per_house(Sum('rating')),
+        **{f'rating_{stars}_count': per_house(Count('id', filter=Q(rating=stars))) for stars in range(1, 6)}
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0015_mapgridcell'),
+        ('reviews', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='house',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(set_review_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0017_activity_created_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityDailySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('activity_type', models.CharField(max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('first_at', models.DateTimeField()),
+                ('last_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Activity daily summary',
+                'verbose_name_plural': 'Activity daily summaries',
+                'ordering': ['-day'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', '-created_at'], name='activity_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['created_at'], name='activity_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='activitydailysummary',
+            name='house',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='activity_summaries', to='houses.house'),
+        ),
+        migrations.AddField(
+            model_name='activitydailysummary',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='activity_summaries', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='activitydailysummary',
+            index=models.Index(fields=['user', '-day'], name='activitysummary_user_day_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activitydailysummary',
+            index=models.Index(fields=['day'], name='activitysummary_day_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:21
+
+from django.db import migrations, models
+
+
+def number_terms(apps, schema_editor):
+    # keep the order they were shown in so far, newest first
+    HouseTerm = apps.get_model('houses', 'HouseTerm')
+    terms = HouseTerm.objects.order_by('house_id', '-created_at', '-updated_at', 'id')
+    numbered = []
+    house_id = position = None
+    for term in terms.only('id', 'house_id').iterator(chunk_size=2000):
+        position = position + 1 if term.house_id == house_id else 0
+        house_id = term.house_id
+        term.position = position
+        numbered.append(term)
+    HouseTerm.objects.bulk_update(numbered, ['position'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0018_activity_retention'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='houseterm',
+            options={'ordering': ['position', 'id'], 'verbose_name': 'House term', 'verbose_name_plural': 'House terms'},
+        ),
+        migrations.AddField(
+            model_name='houseterm',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(number_terms, migrations.RunPython.noop),
+    ]
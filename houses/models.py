@@ -1,5 +1,11 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.utils import timezone
+
+from houses.caching import bump_feed_version
+from houses.geo import encode as encode_geohash
+from houses.mapgrid import MAP_POINT_FIELDS, UNKNOWN_MAP_POINT, map_point
 
 # Create your models here.
 class House(models.Model):
@@ -22,6 +28,8 @@ class House(models.Model):
     location = models.CharField(max_length=400, help_text="e.g. Ongata Rongai, Kajiado")
     latitude = models.DecimalField(max_digits=10, decimal_places=6, null=True, blank=True)
     longitude = models.DecimalField(max_digits=10, decimal_places=6, null=True, blank=True)
+    # geohash of latitude/longitude, kept in sync by save() for radius and map searches
+    geohash = models.CharField(max_length=12, blank=True, default='', editable=False)
 
     # pricing and terms
     rent = models.DecimalField(max_digits=10, decimal_places=2, help_text="Monthly rent in KES")
@@ -45,7 +53,26 @@ class House(models.Model):
     date_posted = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # review statistics, kept up to date by the reviews app signals
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+
+    # denormalized images.first() so listing cards don't query images per house
+    cover_image = models.ForeignKey('HouseImage', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
     def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+        else:
+            self.geohash = ''
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'geohash'}
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -55,32 +82,156 @@ class House(models.Model):
         verbose_name = "House Listing"
         verbose_name_plural = "House Listings"
         ordering = ['-date_posted']
+        indexes = [
+            # public feed: only active + paid listings, one index per sort option
+            models.Index(fields=['-date_posted', '-id'], condition=models.Q(is_active=True, payment_status='paid'), name='house_public_date_idx'),
+            models.Index(fields=['rent', 'id'], condition=models.Q(is_active=True, payment_status='paid'), name='house_public_rent_idx'),
+            models.Index(fields=['title', 'id'], condition=models.Q(is_active=True, payment_status='paid'), name='house_public_title_idx'),
+            # covers the nearby search: range on geohash, type and coordinates read from the index
+            models.Index(fields=['geohash', 'house_type', 'latitude', 'longitude'], condition=models.Q(is_active=True, payment_status='paid'), name='house_public_geohash_idx'),
+            # owner dashboard
+            models.Index(fields=['owner', '-date_posted', '-id'], name='house_owner_date_idx'),
+            models.Index(fields=['owner', 'rent', 'id'], name='house_owner_rent_idx'),
+            models.Index(fields=['owner', 'title', 'id'], name='house_owner_title_idx'),
+        ]
 
     
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember where the listing was on the map, signals diff against it after save()
+        instance._loaded_map_point = map_point(instance) if MAP_POINT_FIELDS.issubset(field_names) else UNKNOWN_MAP_POINT
+        instance._loaded_public = instance.can_be_viewed() if {'is_active', 'payment_status'}.issubset(field_names) else None
+        return instance
+
     def can_be_viewed(self):
         """Check if house can be viewed by public"""
         return self.is_active and self.payment_status == 'paid'
 
+    @property
+    def average_rating(self):
+        """Mean star rating, None without reviews"""
+        if not self.review_count:
+            return None
+        return round(self.rating_sum / self.review_count, 1)
+
+    @property
+    def rating_histogram(self):
+        """[(stars, count, percent)] from 5 stars down to 1"""
+        histogram = []
+        for stars in range(5, 0, -1):
+            count = getattr(self, f'rating_{stars}_count')
+            percent = round(count * 100 / self.review_count) if self.review_count else 0
+            histogram.append((stars, count, percent))
+        return histogram
+
+    def set_terms(self, term_texts):
+        """Make the house's terms match term_texts in order, writing only the lines that changed or moved"""
+        unchanged = {}
+        for term in self.terms.all():
+            unchanged.setdefault(term.term, []).append(term)
+
+        new_terms = []
+        moved_terms = []
+        for position, text in enumerate(term_texts):
+            if unchanged.get(text):
+                term = unchanged[text].pop(0)
+                if term.position != position:
+                    term.position = position
+                    moved_terms.append(term)
+            else:
+                new_terms.append(HouseTerm(house=self, term=text, position=position))
+
+        stale_ids = [term.id for terms in unchanged.values() for term in terms]
+        with transaction.atomic():
+            if stale_ids:
+                HouseTerm.objects.filter(id__in=stale_ids).delete()
+            if moved_terms:
+                HouseTerm.objects.bulk_update(moved_terms, ['position'])
+            if new_terms:
+                HouseTerm.objects.bulk_create(new_terms)
+
+    def refresh_cover_image(self):
+        """Point cover_image at the newest image, call after adding or deleting images"""
+        self.cover_image = self.images.first()
+        House.objects.filter(pk=self.pk).update(cover_image=self.cover_image)
+        if self.can_be_viewed():
+            bump_feed_version()
+
 
 class HouseImage(models.Model):
     house = models.ForeignKey(House,on_delete=models.CASCADE, related_name="images")
     image = models.ImageField(upload_to='house/images/')
+    # resized copies built by houses.images, e.g. {"card": {"width": 480, "height": 360, "webp": "...", "jpeg": "..."}}
+    renditions = models.JSONField(default=dict, blank=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"Images for {self.house.title}"
 
+    def rendition_url(self, name, extension='jpeg'):
+        """URL of a resized copy, or the original until it has been generated"""
+        path = self.renditions.get(name, {}).get(extension)
+        return default_storage.url(path) if path else self.image.url
+
+    def srcset(self, extension):
+        return ", ".join(
+            f"{default_storage.url(rendition[extension])} {rendition['width']}w"
+            for rendition in sorted(self.renditions.values(), key=lambda r: r['width'])
+            if rendition.get(extension)
+        )
+
+    @property
+    def card_url(self):
+        return self.rendition_url('card')
+
+    @property
+    def gallery_url(self):
+        return self.rendition_url('gallery')
+
+    @property
+    def full_url(self):
+        return self.rendition_url('full')
+
+    @property
+    def webp_srcset(self):
+        return self.srcset('webp')
+
+    @property
+    def jpeg_srcset(self):
+        return self.srcset('jpeg')
+
     class Meta:
         verbose_name = "House image"
         verbose_name_plural = "House images"
         ordering = ['-created_at','-updated_at']
 
 
+class MapGridCell(models.Model):
+    """ Number of public listings in one geohash cell, one row per cell per zoom level """
+    level = models.PositiveSmallIntegerField()
+    cell = models.CharField(max_length=12, unique=True)
+    count = models.IntegerField(default=0)
+    # sum of coordinates, the marker goes at the average of the listings in the cell
+    sum_lat = models.FloatField(default=0)
+    sum_lng = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['level', 'cell'], name='mapgridcell_level_cell_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.cell}: {self.count}"
+
+
 class HouseTerm(models.Model):
     house = models.ForeignKey(House, on_delete=models.CASCADE, related_name="terms")
     term = models.TextField(max_length=2000, help_text="e.g. No pets, 1 month deposit")
+    # line number in the terms the owner entered
+    position = models.PositiveIntegerField(default=0)
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -90,7 +241,7 @@ class HouseTerm(models.Model):
     class Meta:
         verbose_name = "House term"
         verbose_name_plural = "House terms"
-        ordering = ['-created_at','-updated_at']
+        ordering = ['position', 'id']
 
 class Activity(models.Model):
     ACTIVITY_TYPES = [
@@ -110,14 +261,44 @@ class Activity(models.Model):
     activity_type = models.CharField(choices=ACTIVITY_TYPES, max_length=20)
     house = models.ForeignKey(House, on_delete=models.CASCADE, related_name='activities', null=True, blank=True)
     description = models.TextField(blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set when the activity happens, not when houses.activity gets round to writing it
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         verbose_name = "Activity"
         verbose_name_plural = "Activities"
         ordering = ['-created_at']
+        indexes = [
+            # the dashboard feed: a user's latest activities
+            models.Index(fields=['user', '-created_at'], name='activity_user_created_idx'),
+            # compaction walks the table oldest first
+            models.Index(fields=['created_at'], name='activity_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.get_activity_type_display()} - {self.created_at}"
+
+
+class ActivityDailySummary(models.Model):
+    """ What's left of a day's activities once they're past ACTIVITY_RETENTION_DAYS - see houses.activity """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='activity_summaries')
+    house = models.ForeignKey(House, on_delete=models.CASCADE, null=True, blank=True, related_name='activity_summaries')
+    day = models.DateField()
+    activity_type = models.CharField(max_length=20)
+    count = models.PositiveIntegerField(default=0)
+    first_at = models.DateTimeField()
+    last_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = "Activity daily summary"
+        verbose_name_plural = "Activity daily summaries"
+        ordering = ['-day']
+        indexes = [
+            models.Index(fields=['user', '-day'], name='activitysummary_user_day_idx'),
+            models.Index(fields=['day'], name='activitysummary_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} - {self.activity_type} x {self.count}"
     
 
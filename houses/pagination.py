@@ -0,0 +1,166 @@
+"""
+Keyset (cursor) pagination for the listing feeds.
+
+Instead of COUNT + OFFSET, each page remembers the sort key of its first and
+last row and the next page is fetched with a WHERE on that key, so page 500
+costs the same as page 1.
+"""
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+
+# sort option -> keyset ordering, id breaks ties so the key is unique
+KEYSET_ORDERINGS = {
+    'date_posted': ['date_posted', 'id'],
+    '-date_posted': ['-date_posted', '-id'],
+    'rent': ['rent', 'id'],
+    '-rent': ['-rent', '-id'],
+    'title': ['title', 'id'],
+    '-title': ['-title', '-id'],
+    'search_rank': ['search_rank', 'id'],
+    # reviews of a house, newest first
+    '-created_at': ['-created_at', '-id'],
+}
+
+COUNT_CACHE_TIMEOUT = 60
+
+
+class KeysetPage:
+    def __init__(self, object_list, sort, has_next, has_previous, ordering):
+        self.object_list = object_list
+        self.sort = sort
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+        self.ordering = ordering
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+    def _cursor(self, obj, direction):
+        values = [_serialize(getattr(obj, field.lstrip('-'))) for field in self.ordering]
+        payload = json.dumps({'s': self.sort, 'd': direction, 'v': values}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def next_cursor(self):
+        if not self.has_next_page or not self.object_list:
+            return None
+        return self._cursor(self.object_list[-1], 'n')
+
+    def previous_cursor(self):
+        if not self.has_previous_page or not self.object_list:
+            return None
+        return self._cursor(self.object_list[0], 'p')
+
+
+class KeysetPaginator:
+    """
+    Paginate a queryset by one of the KEYSET_ORDERINGS.
+
+    paginator = KeysetPaginator(houses, 5, '-date_posted')
+    page = paginator.page(request.GET.get('cursor'))
+    """
+
+    def __init__(self, queryset, per_page, sort):
+        if sort not in KEYSET_ORDERINGS:
+            raise ValueError(f"Unsupported keyset sort: {sort}")
+        self.queryset = queryset
+        self.per_page = per_page
+        self.sort = sort
+        self.ordering = KEYSET_ORDERINGS[sort]
+
+    def page(self, cursor=None):
+        decoded = self.decode_cursor(cursor)
+        if decoded is None:
+            rows = list(self.queryset.order_by(*self.ordering)[:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page], self.sort, len(rows) > self.per_page, False, self.ordering)
+
+        direction, values = decoded
+        if direction == 'n':
+            rows = list(
+                self.queryset.filter(self._after(self.ordering, values)).order_by(*self.ordering)[:self.per_page + 1]
+            )
+            return KeysetPage(rows[:self.per_page], self.sort, len(rows) > self.per_page, True, self.ordering)
+
+        # walking backwards: flip the ordering, then put the rows back in display order
+        reversed_ordering = [_flip(field) for field in self.ordering]
+        rows = list(
+            self.queryset.filter(self._after(reversed_ordering, values)).order_by(*reversed_ordering)[:self.per_page + 1]
+        )
+        has_previous = len(rows) > self.per_page
+        rows = rows[:self.per_page][::-1]
+        return KeysetPage(rows, self.sort, True, has_previous, self.ordering)
+
+    def decode_cursor(self, cursor):
+        """ Returns (direction, values) or None for a missing/invalid/stale cursor. """
+        if not cursor:
+            return None
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            data = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+            if data['s'] != self.sort or data['d'] not in ('n', 'p') or len(data['v']) != len(self.ordering):
+                return None
+            values = [self._to_python(field, value) for field, value in zip(self.ordering, data['v'])]
+        except (ValueError, KeyError, TypeError):
+            return None
+        return data['d'], values
+
+    def _to_python(self, field, value):
+        name = field.lstrip('-')
+        try:
+            return self.queryset.model._meta.get_field(name).to_python(value)
+        except FieldDoesNotExist:
+            # annotations such as search_rank
+            return int(value)
+
+    def _after(self, ordering, values):
+        """ Rows strictly after values in ordering, e.g. (a < x) OR (a = x AND id < y). """
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+
+def cached_count(queryset, timeout=COUNT_CACHE_TIMEOUT):
+    """ COUNT(*) for a queryset, cached by its SQL so the feed hot path doesn't count on every request. """
+    queryset = queryset.order_by()
+    key = 'houses:count:' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def _flip(field):
+    return field[1:] if field.startswith('-') else f'-{field}'
+
+
+def _serialize(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, int):
+        return value
+    return str(value)
@@ -0,0 +1,162 @@
+"""
+reCAPTCHA verification for the review form.
+
+RecaptchaClient keeps one pooled HTTPS session to Google for the whole
+process and gives every verification a hard time budget, so a slow siteverify
+can hold a web worker for RECAPTCHA_TIMEOUT seconds at most. After
+CIRCUIT_FAILURE_THRESHOLD failures in a row the circuit opens and reviews are
+turned away immediately for CIRCUIT_RESET_AFTER seconds instead of every
+worker waiting on Google; then one request is let through to test the water.
+
+The client class comes from settings.RECAPTCHA_CLIENT, tests swap in
+StubRecaptchaClient.
+"""
+import json
+import logging
+import threading
+import time
+
+import requests
+import urllib3
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
+
+CONNECT_TIMEOUT = 1.0
+POOL_SIZE = 10
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_AFTER = 30
+
+
+def _result(success, score=None, error=None, unavailable=False):
+    return {'success': success, 'score': score, 'error': error, 'unavailable': unavailable}
+
+
+class RecaptchaClient:
+    def __init__(self, secret=None, url=VERIFY_URL, budget=None,
+                 failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_after=CIRCUIT_RESET_AFTER):
+        self.secret = settings.RECAPTCHA_SECRET_KEY if secret is None else secret
+        self.url = url
+        self.budget = budget if budget is not None else getattr(settings, 'RECAPTCHA_TIMEOUT', 3.0)
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+
+        self.session = requests.Session()
+        # no retries: there is no time for them inside the budget
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def verify(self, token, remote_ip=None):
+        """ {'success', 'score', 'error', 'unavailable'} - unavailable means Google couldn't be asked """
+        if not self._allow_request():
+            return _result(False, error='circuit open', unavailable=True)
+
+        deadline = time.monotonic() + self.budget
+        # connecting plus waiting for the headers fits in the budget
+        connect_timeout = min(CONNECT_TIMEOUT, self.budget / 2)
+        try:
+            with self.session.post(
+                self.url,
+                data={'secret': self.secret, 'response': token, 'remoteip': remote_ip},
+                timeout=(connect_timeout, self.budget - connect_timeout),
+                stream=True,
+            ) as response:
+                response.raise_for_status()
+                # each socket read may only wait for what is left of the budget
+                body = b''
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise requests.Timeout("reCAPTCHA verification exceeded its time budget")
+                    connection = response.raw.connection
+                    if connection is not None and connection.sock is not None:
+                        connection.sock.settimeout(remaining)
+                    chunk = response.raw.read1(1024, decode_content=True)
+                    if not chunk:
+                        break
+                    body += chunk
+            data = json.loads(body)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, ValueError) as e:
+            logger.warning("reCAPTCHA verification failed: %s", e)
+            self._record(success=False)
+            return _result(False, error=str(e), unavailable=True)
+
+        self._record(success=True)
+        if not data.get('success'):
+            return _result(False, error=', '.join(data.get('error-codes', [])) or 'rejected')
+        return _result(True, score=data.get('score', 0))
+
+    def _allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after or self._trial_running:
+                return False
+            # half open: let one request through to see if Google is back
+            self._trial_running = True
+            return True
+
+    def _record(self, success):
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.error("reCAPTCHA circuit opened after %s failures", self._failures)
+                self._opened_at = time.monotonic()
+
+    @property
+    def circuit_open(self):
+        return self._opened_at is not None
+
+
+class StubRecaptchaClient:
+    """ Local stand-in: every token passes with score 1.0 except 'fail' (rejected) and 'down' (unavailable) """
+
+    def __init__(self, **kwargs):
+        self.calls = []
+
+    def verify(self, token, remote_ip=None):
+        self.calls.append(token)
+        if token == 'fail':
+            return _result(False, error='rejected')
+        if token == 'down':
+            return _result(False, error='stubbed outage', unavailable=True)
+        return _result(True, score=1.0)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_recaptcha_client():
+    """ The process-wide client, so its connection pool and circuit are shared by all requests """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = import_string(getattr(settings, 'RECAPTCHA_CLIENT', 'houses.recaptcha.RecaptchaClient'))()
+        return _client
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    global _client
+    if setting.startswith('RECAPTCHA_'):
+        _client = None
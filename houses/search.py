@@ -0,0 +1,182 @@
+"""
+Full-text search for house listings.
+
+SQLite keeps an FTS5 index (houses_house_fts) in sync with houses_house through
+triggers, PostgreSQL uses a GIN index over a tsvector expression. Any other
+backend falls back to the old icontains filter.
+"""
+import re
+
+from django.db import connection, connections
+from django.db.models import Case, IntegerField, Q, Value, When
+
+# Only the best N matches are returned so search cost stays flat as the table grows
+SEARCH_RESULT_LIMIT = 500
+
+SEARCH_COLUMNS = ['title', 'description', 'location', 'house_type', 'floor_number', 'rent']
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())[:10]
+
+
+class FallbackSearchBackend:
+    """ Backends without a full-text index: LIKE over every searchable column. """
+
+    def install(self, cursor):
+        pass
+
+    def ranked_ids(self, query, limit, within=None):
+        return None
+
+
+class SQLiteSearchBackend:
+    table = 'houses_house_fts'
+
+    # bm25 weights, same order as SEARCH_COLUMNS
+    weights = '10.0, 1.0, 5.0, 5.0, 2.0, 2.0'
+
+    def install(self, cursor):
+        columns = ', '.join(SEARCH_COLUMNS)
+        new_values = ', '.join(f'new.{col}' for col in SEARCH_COLUMNS)
+        old_values = ', '.join(f'old.{col}' for col in SEARCH_COLUMNS)
+
+        cursor.execute(f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '{self.table}'")
+        created = cursor.fetchone() is None
+
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+            f"{columns}, content='houses_house', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2')"
+        )
+        # Triggers are dropped whenever Django rebuilds houses_house, so they are re-created after every migrate
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_ai AFTER INSERT ON houses_house BEGIN "
+            f"INSERT INTO {self.table}(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_ad AFTER DELETE ON houses_house BEGIN "
+            f"INSERT INTO {self.table}({self.table}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_au AFTER UPDATE OF {columns} ON houses_house BEGIN "
+            f"INSERT INTO {self.table}({self.table}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {self.table}(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        )
+        if created:
+            self.rebuild(cursor)
+
+    def uninstall(self, cursor):
+        for suffix in ['ai', 'ad', 'au']:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {self.table}_{suffix}")
+        cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def rebuild(self, cursor):
+        cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')")
+
+    def ranked_ids(self, query, limit, within=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # every word must match, each as a prefix ("bed" finds "bedsitter")
+        params = [' '.join(f'"{token}"*' for token in tokens)]
+        within_sql, within_params = _within_sql('rowid', within)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s {within_sql}"
+                f"ORDER BY bm25({self.table}, {self.weights}) LIMIT %s",
+                params + within_params + [limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend:
+    index = 'houses_house_search_idx'
+
+    # Must stay identical to the indexed expression or the GIN index is not used
+    document = (
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(location, '') || ' ' || coalesce(house_type, '')), 'B') || "
+        "setweight(to_tsvector('simple', coalesce(floor_number, '') || ' ' || rent::text), 'C') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'D')"
+    )
+
+    def install(self, cursor):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.index} ON houses_house USING GIN (({self.document}))")
+
+    def uninstall(self, cursor):
+        cursor.execute(f"DROP INDEX IF EXISTS {self.index}")
+
+    def rebuild(self, cursor):
+        cursor.execute(f"REINDEX INDEX {self.index}")
+
+    def ranked_ids(self, query, limit, within=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        tsquery = ' & '.join(f'{token}:*' for token in tokens)
+        within_sql, within_params = _within_sql('id', within)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id FROM houses_house WHERE ({self.document}) @@ to_tsquery('simple', %s) {within_sql}"
+                f"ORDER BY ts_rank(({self.document}), to_tsquery('simple', %s)) DESC LIMIT %s",
+                [tsquery] + within_params + [tsquery, limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def _within_sql(column, houses):
+    """ 'AND column IN (...)' restricting matches to a House queryset, so the limit applies after its filters """
+    if houses is None:
+        return '', []
+    sql, params = houses.order_by().values('id').query.sql_with_params()
+    return f"AND {column} IN ({sql}) ", list(params)
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend(conn=None):
+    vendor = (conn or connection).vendor
+    return SEARCH_BACKENDS.get(vendor, FallbackSearchBackend)()
+
+
+def install_search_index(using=None, **kwargs):
+    """ post_migrate hook: make sure the index (and on SQLite its triggers) exist. """
+    conn = connections[using or 'default']
+    if 'houses_house' not in conn.introspection.table_names():
+        return
+    with conn.cursor() as cursor:
+        get_search_backend(conn).install(cursor)
+
+
+def search_houses(houses, query):
+    """
+    Filter a House queryset down to listings matching query.
+
+    Matches are annotated with search_rank (0 = most relevant) so callers can
+    order_by('search_rank') when no explicit sort was requested. Ranking and the
+    SEARCH_RESULT_LIMIT cap only consider the houses in the queryset, so filter
+    it (public, one owner's) before searching.
+    """
+    ids = get_search_backend().ranked_ids(query, SEARCH_RESULT_LIMIT, within=houses)
+
+    if ids is None:
+        return houses.filter(
+            Q(title__icontains=query) | Q(description__icontains=query) | Q(location__icontains=query) |
+            Q(house_type__icontains=query) | Q(rent__icontains=query) | Q(floor_number__icontains=query)
+        ).annotate(search_rank=Value(0, output_field=IntegerField()))
+
+    if not ids:
+        return houses.none().annotate(search_rank=Value(0, output_field=IntegerField()))
+
+    rank = Case(
+        *[When(id=pk, then=Value(position)) for position, pk in enumerate(ids)],
+        output_field=IntegerField()
+    )
+    return houses.filter(id__in=ids).annotate(search_rank=rank)
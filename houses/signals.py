@@ -0,0 +1,55 @@
+from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.dispatch import receiver
+
+from houses import mapgrid
+from houses.caching import bump_feed_version
+from houses.images import delete_derivatives
+from houses.models import House, HouseImage
+
+
+@receiver(post_save, sender=House)
+def update_map_grid(sender, instance, created, raw=False, **kwargs):
+    """ Keep the map clusters in step with listings being paid for, expired, moved or hidden """
+    if raw:
+        return
+    before = None if created else getattr(instance, '_loaded_map_point', mapgrid.UNKNOWN_MAP_POINT)
+    if before is mapgrid.UNKNOWN_MAP_POINT:
+        # partially loaded instance, rebuild_map_grid catches anything missed here
+        return
+    after = mapgrid.map_point(instance)
+    mapgrid.move(before, after)
+    instance._loaded_map_point = after
+
+
+@receiver(post_delete, sender=House)
+def remove_from_map_grid(sender, instance, **kwargs):
+    point = getattr(instance, '_loaded_map_point', mapgrid.UNKNOWN_MAP_POINT)
+    if point is mapgrid.UNKNOWN_MAP_POINT:
+        point = mapgrid.map_point(instance)
+    mapgrid.move(point, None)
+
+
+@receiver(post_save, sender=House)
+def invalidate_feed_pages(sender, instance, created, raw=False, **kwargs):
+    """ Cached anonymous pages go stale when a listing enters, leaves or changes inside the public feed """
+    if raw:
+        return
+    was_public = False if created else getattr(instance, '_loaded_public', None)
+    is_public = instance.can_be_viewed()
+    # None: loaded without its status fields, assume it may have been public
+    if was_public is not False or is_public:
+        bump_feed_version()
+    instance._loaded_public = is_public
+
+
+@receiver(post_delete, sender=House)
+def invalidate_feed_pages_on_delete(sender, instance, **kwargs):
+    if getattr(instance, '_loaded_public', None) is not False or instance.can_be_viewed():
+        bump_feed_version()
+
+
+@receiver(post_delete, sender=HouseImage)
+def delete_image_derivatives(sender, instance, **kwargs):
+    """ Resized copies go with their image, also when the whole house is deleted """
+    transaction.on_commit(lambda: delete_derivatives(instance))
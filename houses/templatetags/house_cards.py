@@ -0,0 +1,19 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from houses.caching import render_cards
+
+register = template.Library()
+
+
+@register.simple_tag
+def house_card(house):
+    """
+    The rendered listing card for house.
+
+    Views pre-render a whole page with render_cards(); anything else falls back to
+    a cache lookup for this one card.
+    """
+    if not hasattr(house, 'card_html'):
+        render_cards([house])
+    return mark_safe(house.card_html)
@@ -1,3 +1,770 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from houses import activity, geo, mapgrid, search
+from houses.activity import compact_activity
+from houses.caching import card_cache_stats, render_cards
+from houses.facets import facet_counts
+from houses.images import build_derivatives, validate_uploaded_images
+from houses.pagination import KEYSET_ORDERINGS
+from houses.models import Activity, ActivityDailySummary, House, HouseImage, HouseTerm, MapGridCell
+from houses.recaptcha import RecaptchaClient
+from houses.search import FallbackSearchBackend, search_houses
+from houses.stats import owner_listing_stats
+from payments.models import Payment
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+# 1x1 transparent GIF
+GIF = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+def create_house(owner, **kwargs):
+    fields = {
+        'title': 'Cozy bedsitter',
+        'house_type': 'bedsitter',
+        'description': 'Near the stage',
+        'location': 'Ongata Rongai, Kajiado',
+        'rent': 8000,
+        'deposit': 8000,
+        'house_number': 'A5',
+        'owner': owner,
+        'is_active': True,
+        'payment_status': 'paid',
+    }
+    fields.update(kwargs)
+    return House.objects.create(**fields)
+
+
+def add_image(house, name='house.gif'):
+    image = HouseImage.objects.create(house=house, image=SimpleUploadedFile(name, GIF, content_type='image/gif'))
+    house.refresh_cover_image()
+    return image
+
+
+class QueryPlanTests(TestCase):
+    def test_listing_queries_use_their_indexes(self):
+        out = StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertNotIn('FAIL', out.getvalue())
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.titled = create_house(self.owner, title='Balcony studio', house_type='studio', description='Quiet court')
+        self.described = create_house(self.owner, title='Corner room', house_type='single', description='Has a balcony')
+
+    def titles(self, query, houses=None):
+        matches = search_houses(houses or House.objects.all(), query).order_by('search_rank')
+        return [house.title for house in matches]
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        self.assertEqual(self.titles('court'), ['Balcony studio'])
+        self.titled.description = 'Gated estate'
+        self.titled.save()
+        self.assertEqual(self.titles('court'), [])
+        self.assertEqual(self.titles('gated'), ['Balcony studio'])
+        self.titled.delete()
+        self.assertEqual(self.titles('gated'), [])
+
+    def test_prefix_matching_and_relevance_order(self):
+        # a title match outranks a description match
+        self.assertEqual(self.titles('balc'), ['Balcony studio', 'Corner room'])
+        self.assertEqual(self.titles('balcony corn'), ['Corner room'])
+
+    def test_private_matches_do_not_crowd_out_public_ones(self):
+        House.objects.bulk_create([
+            House(title='Unpaid balcony flat', house_type='studio', description='-', location='Rongai', rent=1,
+                  deposit=1, house_number=str(number), owner=self.owner, is_active=False, payment_status='unpaid')
+            for number in range(search.SEARCH_RESULT_LIMIT + 100)
+        ])
+        response = self.client.get(reverse('home'), {'search': 'balcony'})
+        self.assertEqual({house.title for house in response.context['houses']}, {'Balcony studio', 'Corner room'})
+
+    def test_fallback_backend(self):
+        with mock.patch('houses.search.get_search_backend', return_value=FallbackSearchBackend()):
+            self.assertEqual(set(self.titles('balcony')), {'Balcony studio', 'Corner room'})
+            self.assertEqual(self.titles('court', House.objects.filter(house_type='single')), [])
+
+
+class FeedPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        posted = timezone.now()
+        for number in range(13):
+            house = create_house(self.owner, title=f'Balcony flat {number % 4}', rent=5000 + 1000 * (number % 3))
+            # three houses to a timestamp, so the id tie-break carries the order
+            House.objects.filter(id=house.id).update(date_posted=posted - timedelta(days=number // 3))
+        self.client.force_login(self.owner)
+
+    def walk(self, url, params):
+        """ Ids page by page to the end and back again """
+        forward, pages = [], []
+        cursor = None
+        while True:
+            page = self.client.get(url, {**params, 'cursor': cursor} if cursor else params).context['houses']
+            pages.append([house.id for house in page])
+            forward += pages[-1]
+            cursor = page.next_cursor()
+            if cursor is None:
+                break
+        backward = [pages[-1]]
+        cursor = page.previous_cursor()
+        while cursor:
+            page = self.client.get(url, {**params, 'cursor': cursor}).context['houses']
+            backward.append([house.id for house in page])
+            cursor = page.previous_cursor()
+        self.assertEqual(backward[::-1], pages)
+        return forward
+
+    def test_every_sort_walks_both_ways(self):
+        for sort in ['date_posted', '-date_posted', 'rent', '-rent', 'title', '-title']:
+            with self.subTest(sort=sort):
+                expected = list(House.objects.order_by(*KEYSET_ORDERINGS[sort]).values_list('id', flat=True))
+                self.assertEqual(self.walk(reverse('home'), {'sort': sort}), expected)
+                self.assertEqual(self.walk(reverse('dashboard'), {'sort': sort}), expected)
+
+    def test_search_rank_walks_both_ways(self):
+        expected = list(search_houses(House.objects.all(), 'balcony').order_by('search_rank', 'id').values_list('id', flat=True))
+        self.assertEqual(len(expected), 13)
+        self.assertEqual(self.walk(reverse('home'), {'search': 'balcony'}), expected)
+        self.assertEqual(self.walk(reverse('dashboard'), {'search': 'balcony'}), expected)
+
+    def test_stale_or_malformed_cursor_starts_over(self):
+        first = [house.id for house in self.client.get(reverse('home'), {'sort': 'title'}).context['houses']]
+        rent_cursor = self.client.get(reverse('home'), {'sort': 'rent'}).context['houses'].next_cursor()
+        for cursor in [rent_cursor, 'not-a-cursor', 'eyJzIjoidGl0bGUifQ']:
+            response = self.client.get(reverse('home'), {'sort': 'title', 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([house.id for house in response.context['houses']], first)
+
+    def test_warm_count_is_not_recounted(self):
+        self.client.get(reverse('home'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['house_count'], 13)
+        self.assertFalse([query['sql'] for query in queries if 'COUNT(*)' in query['sql']])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class CoverImageTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', 'landlord@example.com', 'pass12345')
+
+    def home_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_cover_image_follows_newest_image(self):
+        house = create_house(self.owner)
+        first = add_image(house, 'first.gif')
+        second = add_image(house, 'second.gif')
+        self.assertEqual(house.cover_image, second)
+
+        second.delete()
+        house.refresh_cover_image()
+        house.refresh_from_db()
+        self.assertEqual(house.cover_image, first)
+
+    def test_home_query_count_does_not_grow_with_cards(self):
+        add_image(create_house(self.owner))
+        one_card = self.home_queries()
+
+        for _ in range(4):
+            add_image(create_house(self.owner))
+        five_cards = self.home_queries()
+
+        self.assertEqual(one_card, five_cards)
+        # the page of houses (cover images joined in), the total and the facet counts - both cached afterwards
+        self.assertEqual(five_cards, 3)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, HOUSE_IMAGE_DERIVATIVES_SYNC=True)
+class ImageDerivativeTests(TestCase):
+    def test_renditions_are_resized_and_used_in_srcset(self):
+        house = create_house(User.objects.create_user('landlord', 'landlord@example.com', 'pass12345'))
+        photo = BytesIO()
+        Image.new('RGB', (3000, 2000), 'green').save(photo, 'JPEG')
+        image = HouseImage.objects.create(house=house, image=SimpleUploadedFile('big.jpg', photo.getvalue()))
+
+        build_derivatives([image.id])
+        image.refresh_from_db()
+
+        self.assertEqual(image.renditions['card']['width'], 480)
+        self.assertEqual(image.renditions['full']['height'], 1067)
+        self.assertIn('-card.webp 480w', image.webp_srcset)
+        self.assertTrue(image.card_url.endswith('-card.jpeg'))
+
+    def test_new_renditions_refresh_cached_pages(self):
+        cache.clear()
+        house = create_house(User.objects.create_user('landlord', 'landlord@example.com', 'pass12345'))
+        image = add_image(house)
+        self.client.get(reverse('home'))
+        self.assertEqual(self.client.get(reverse('home'))['X-Page-Cache'], 'hit')
+
+        build_derivatives([image.id])
+        response = self.client.get(reverse('home'))
+        self.assertNotEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, '-card.webp')
+
+    def test_renditions_are_removed_with_the_house(self):
+        owner = User.objects.create_user('landlord', 'landlord@example.com', 'pass12345')
+        house = create_house(owner)
+        image = add_image(house)
+        build_derivatives([image.id])
+        image.refresh_from_db()
+        paths = [rendition[extension] for rendition in image.renditions.values() for extension in ('webp', 'jpeg')]
+        self.assertTrue(all(default_storage.exists(path) for path in paths))
+
+        self.client.force_login(owner)
+        with self.settings(ACTIVITY_WRITE_BEHIND=False), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('delete_house', args=[house.id]))
+        self.assertFalse(House.objects.filter(id=house.id).exists())
+        self.assertFalse(any(default_storage.exists(path) for path in paths))
+
+
+class UploadValidationTests(TestCase):
+    def upload(self, name, content):
+        return SimpleUploadedFile(name, content, content_type='image/jpeg')
+
+    def test_valid_images_pass(self):
+        uploads = [self.upload(f'{index}.gif', GIF) for index in range(5)]
+        self.assertIsNone(validate_uploaded_images(uploads))
+
+    def test_first_bad_file_is_reported(self):
+        uploads = [self.upload('ok.gif', GIF), self.upload('fake.jpg', b'not an image at all')]
+        self.assertEqual(
+            validate_uploaded_images(uploads),
+            "Invalid image file: fake.jpg. Please upload valid images only."
+        )
+
+    def test_size_is_checked_before_reading(self):
+        big = self.upload('big.jpg', b'not an image at all')
+        big.size = 21 * 1024 * 1024
+        self.assertEqual(
+            validate_uploaded_images([self.upload('ok.gif', GIF), big]),
+            "Image big.jpg is too large. Maximum size is 20MB."
+        )
+
+    def test_dimensions_are_read_from_the_header(self):
+        huge = BytesIO()
+        Image.new('1', (12000, 10)).save(huge, 'PNG')
+        self.assertEqual(
+            validate_uploaded_images([self.upload('wide.png', huge.getvalue())]),
+            "Image wide.png dimensions are too large."
+        )
+
+
+class HouseTermTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.house = create_house(self.owner)
+        HouseTerm.objects.bulk_create([
+            HouseTerm(house=self.house, term=term, position=position)
+            for position, term in enumerate(['No pets', 'Rent due 5th'])
+        ])
+
+    def test_set_terms_only_writes_changed_lines(self):
+        kept = HouseTerm.objects.get(term='No pets')
+        with CaptureQueriesContext(connection) as queries:
+            self.house.set_terms(['No pets', 'Water included'])
+
+        self.assertEqual(sorted(self.house.terms.values_list('term', flat=True)), ['No pets', 'Water included'])
+        self.assertTrue(HouseTerm.objects.filter(id=kept.id).exists())
+        self.assertEqual(sum('INSERT' in query['sql'] for query in queries.captured_queries), 1)
+
+    def test_set_terms_keeps_the_submitted_order(self):
+        self.house.set_terms(['Water included', 'No pets', 'Rent due 10th', 'Rent due 5th'])
+        self.assertEqual(
+            list(self.house.terms.values_list('term', flat=True)),
+            ['Water included', 'No pets', 'Rent due 10th', 'Rent due 5th'],
+        )
+        # editing one line leaves it where it was
+        self.house.set_terms(['Water included', 'No cats', 'Rent due 10th', 'Rent due 5th'])
+        self.assertEqual(
+            list(self.house.terms.values_list('term', flat=True)),
+            ['Water included', 'No cats', 'Rent due 10th', 'Rent due 5th'],
+        )
+
+    def test_set_terms_keeps_duplicates(self):
+        self.house.set_terms(['No pets', 'No pets'])
+        self.assertEqual(self.house.terms.filter(term='No pets').count(), 2)
+        self.assertFalse(self.house.terms.filter(term='Rent due 5th').exists())
+
+
+class GeoSearchTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        # around Nairobi CBD (-1.2921, 36.8219)
+        self.close = create_house(self.owner, latitude='-1.293000', longitude='36.822000')
+        self.further = create_house(self.owner, latitude='-1.300000', longitude='36.830000')
+        self.other_type = create_house(self.owner, latitude='-1.292500', longitude='36.821500', house_type='studio')
+        self.far_away = create_house(self.owner, latitude='-4.043500', longitude='39.668200')
+        self.unpaid = create_house(self.owner, latitude='-1.292200', longitude='36.821900', payment_status='unpaid')
+
+    def test_geohash_is_kept_in_sync(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744), 'u4pruydqq')
+        self.assertTrue(self.close.geohash.startswith('kzf0'))
+        self.close.latitude = None
+        self.close.save()
+        self.assertEqual(House.objects.get(id=self.close.id).geohash, '')
+
+    def test_radius_search_is_ordered_by_distance(self):
+        response = self.client.get(reverse('nearby_houses'), {'lat': -1.2921, 'lng': 36.8219, 'radius': 2, 'house_type': 'bedsitter'})
+        results = response.json()['results']
+        self.assertEqual([house['id'] for house in results], [self.close.id, self.further.id])
+        self.assertLess(results[0]['distance_km'], results[1]['distance_km'])
+
+    def test_bbox_search(self):
+        response = self.client.get(reverse('nearby_houses'), {'bbox': '36.80,-1.31,36.84,-1.28'})
+        ids = {house['id'] for house in response.json()['results']}
+        self.assertEqual(ids, {self.close.id, self.further.id, self.other_type.id})
+
+    def test_cover_ranges_end_at_the_next_prefix(self):
+        self.assertEqual(geo.cover_ranges(['kzf0', 'kzf1', 'kzfz', 'kzg0']), [('kzf0', 'kzf2'), ('kzfz', 'kzg1')])
+        self.assertEqual(geo.cover_ranges(['kzzz']), [('kzzz', 'm')])
+        self.assertEqual(geo.cover_ranges(['zzzy', 'zzzz']), [('zzzy', None)])
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get(reverse('nearby_houses'), {'lat': 'x', 'lng': 36.8}).status_code, 400)
+        for params in [{'lat': -1.3, 'lng': 36.8, 'radius': 'nan'}, {'lat': 'inf', 'lng': 36.8},
+                       {'lat': -1.3, 'lng': '-inf'}, {'bbox': 'nan,nan,nan,nan'}, {'bbox': '36.8,-1.3,inf,-1.2'}]:
+            self.assertEqual(self.client.get(reverse('nearby_houses'), params).status_code, 400, params)
+
+
+class MapGridTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.listed = create_house(self.owner, latitude='-1.293000', longitude='36.822000')
+        self.unpaid = create_house(
+            self.owner, latitude='-1.300000', longitude='36.830000', is_active=False, payment_status='pending'
+        )
+
+    def grid(self):
+        return dict(MapGridCell.objects.values_list('cell', 'count'))
+
+    def test_grid_follows_payment_and_expiry(self):
+        self.assertEqual(self.grid()['kzf'], 1)
+
+        # what mpesa_callback does once the payment is confirmed
+        house = House.objects.get(id=self.unpaid.id)
+        house.payment_status = 'paid'
+        house.is_active = True
+        house.save()
+        self.assertEqual(self.grid()['kzf'], 2)
+
+        # what expire_old_payments does
+        house = House.objects.get(id=self.listed.id)
+        house.is_active = False
+        house.payment_status = 'unpaid'
+        house.save()
+        house.save()
+        self.assertEqual(self.grid()['kzf'], 1)
+        self.assertNotIn(self.listed.geohash[:8], self.grid())
+
+        House.objects.get(id=self.unpaid.id).delete()
+        self.assertEqual(self.grid(), {})
+
+    def test_rebuild_matches_incremental_updates(self):
+        create_house(self.owner, latitude='-4.043500', longitude='39.668200')
+        incremental = list(MapGridCell.objects.order_by('cell').values_list('cell', 'count', 'sum_lat'))
+        call_command('rebuild_map_grid', stdout=StringIO())
+        rebuilt = list(MapGridCell.objects.order_by('cell').values_list('cell', 'count', 'sum_lat'))
+        self.assertEqual(len(incremental), len(rebuilt))
+        for (cell, count, sum_lat), expected in zip(incremental, rebuilt):
+            self.assertEqual((cell, count), expected[:2])
+            self.assertAlmostEqual(sum_lat, expected[2])
+
+    def test_clusters_endpoint_bad_or_huge_boxes(self):
+        url = reverse('map_clusters')
+        self.assertEqual(self.client.get(url, {'bbox': 'nan,nan,nan,nan', 'zoom': 5}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'bbox': '200,95,300,99', 'zoom': 5}).status_code, 400)
+        data = self.client.get(url, {'bbox': '-1e300,-1e300,1e300,1e300', 'zoom': 1}).json()
+        self.assertEqual(sum(cluster['count'] for cluster in data['clusters']), 1)
+
+    def test_clusters_endpoint(self):
+        create_house(self.owner, latitude='-1.294000', longitude='36.823000')
+        response = self.client.get(reverse('map_clusters'), {'bbox': '36.0,-2.0,37.5,-0.5', 'zoom': 8})
+        data = response.json()
+        self.assertEqual(data['level'], mapgrid.zoom_to_level(8))
+        self.assertEqual(sum(cluster['count'] for cluster in data['clusters']), 2)
+
+        response = self.client.get(reverse('map_clusters'), {'bbox': '36.81,-1.30,36.83,-1.28', 'zoom': 17})
+        self.assertEqual(len(response.json()['markers']), 2)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        create_house(self.owner, rent=4000)
+        create_house(self.owner, rent=8000)
+        create_house(self.owner, rent=15000, house_type='studio')
+        create_house(self.owner, rent=15000, house_type='studio', is_active=False)
+
+    def test_counts_come_from_one_query(self):
+        houses = House.objects.filter(is_active=True, payment_status='paid')
+        with self.assertNumQueries(1):
+            facets = facet_counts(houses, house_type='bedsitter', min_rent='5000')
+
+        types = {value: count for value, _, count in facets['house_types']}
+        rents = {bucket['key']: bucket['count'] for bucket in facets['rent_buckets']}
+        # type counts respect the rent filter, rent counts respect the type filter
+        self.assertEqual((types['bedsitter'], types['studio']), (1, 1))
+        self.assertEqual((rents['under_5k'], rents['5k_10k'], rents['10k_20k']), (1, 1, 0))
+        self.assertEqual(facets['total'], 1)
+
+    def test_boundary_rents_fall_in_one_band(self):
+        create_house(self.owner, rent=5000)
+        create_house(self.owner, rent=10000)
+        houses = House.objects.filter(is_active=True, payment_status='paid')
+        facets = facet_counts(houses)
+
+        rents = {bucket['key']: bucket['count'] for bucket in facets['rent_buckets']}
+        self.assertEqual((rents['under_5k'], rents['5k_10k'], rents['10k_20k']), (1, 2, 2))
+        self.assertEqual(sum(rents.values()), facets['total'])
+
+        # picking a band lists the houses it counted
+        band = next(bucket for bucket in facets['rent_buckets'] if bucket['key'] == '5k_10k')
+        response = self.client.get(reverse('home'), {'min_rent': band['min'], 'max_rent': band['max']})
+        self.assertEqual(len(response.context['houses']), 2)
+
+    def test_unfiltered_feed_is_cached(self):
+        # logged in, so the whole-page cache is not involved
+        self.client.force_login(self.owner)
+        self.client.get(reverse('home'))
+        # the total and the facets come from the cache, only the page of houses is queried
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+        self.assertContains(response, 'Studio Apartment (1)')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class CardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.house = create_house(self.owner, title='Sunny bedsitter')
+        add_image(self.house)
+
+    def card(self):
+        house = House.objects.select_related('cover_image').get(id=self.house.id)
+        return render_cards([house])[0].card_html
+
+    def test_cards_are_reused_until_the_house_changes(self):
+        self.assertIn('Sunny bedsitter', self.card())
+        self.card()
+        self.assertEqual(card_cache_stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+        self.house.title = 'Renovated bedsitter'
+        self.house.save()
+        self.assertIn('Renovated bedsitter', self.card())
+
+        # a new cover image also changes the card
+        add_image(self.house, 'new-cover.gif')
+        self.assertIn('new-cover', self.card())
+        self.assertEqual(card_cache_stats()['misses'], 3)
+
+    def test_home_page_uses_cached_cards(self):
+        self.client.force_login(self.owner)
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, 'Sunny bedsitter')
+        self.assertEqual(card_cache_stats()['hits'], 1)
+
+    def test_stats_are_staff_only(self):
+        staff = User.objects.create_user('staff', password='pass', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(reverse('cache_stats')).json()['card_cache']['misses'], 0)
+
+
+class AnonymousPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.house = create_house(self.owner, title='Sunny bedsitter')
+
+    def test_repeat_visits_skip_the_database(self):
+        self.client.get(reverse('home'), {'sort': 'rent', 'house_type': ''})
+        with self.assertNumQueries(0):
+            # same page: parameter order and empty values don't matter
+            response = self.client.get(reverse('home') + '?search=&sort=rent')
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, 'Sunny bedsitter')
+
+    def test_visibility_changes_invalidate(self):
+        self.client.get(reverse('home'))
+
+        # what mpesa_callback does for a newly paid listing
+        new = create_house(self.owner, title='Fresh listing', is_active=False, payment_status='pending')
+        self.assertEqual(self.client.get(reverse('home'))['X-Page-Cache'], 'hit')
+        new = House.objects.get(id=new.id)
+        new.is_active, new.payment_status = True, 'paid'
+        new.save()
+        self.assertContains(self.client.get(reverse('home')), 'Fresh listing')
+
+        # what expire_old_payments does
+        house = House.objects.get(id=self.house.id)
+        house.is_active, house.payment_status = False, 'unpaid'
+        house.save()
+        self.assertNotContains(self.client.get(reverse('home')), 'Sunny bedsitter')
+
+        House.objects.get(id=new.id).delete()
+        self.assertNotContains(self.client.get(reverse('home')), 'Fresh listing')
+
+    def test_logged_in_and_unknown_params_are_not_cached(self):
+        self.client.get(reverse('home'), {'status': 'pending'})
+        self.assertNotIn('X-Page-Cache', self.client.get(reverse('home'), {'status': 'pending'}))
+        self.client.force_login(self.owner)
+        self.assertNotIn('X-Page-Cache', self.client.get(reverse('home')))
+
+
+class SlowSiteverify(BaseHTTPRequestHandler):
+    """ Answers like siteverify after `delay` seconds, dribbling the body out """
+    delay = 0
+    # seconds before the headers, and between them and the body
+    headers_after = 0
+    stall = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"success": true, "score": 0.9}'
+        time.sleep(self.headers_after)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.flush()
+            time.sleep(self.stall)
+            for byte in range(len(body)):
+                time.sleep(self.delay / len(body))
+                self.wfile.write(body[byte:byte + 1])
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, which is what the tests want
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class RecaptchaClientTests(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SlowSiteverify)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        SlowSiteverify.delay = SlowSiteverify.headers_after = SlowSiteverify.stall = 0
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_verify(self):
+        SlowSiteverify.delay = 0
+        result = RecaptchaClient(secret='s', url=self.url).verify('token')
+        self.assertEqual(result, {'success': True, 'score': 0.9, 'error': None, 'unavailable': False})
+
+    def test_slow_answer_is_cut_off_at_the_budget(self):
+        # every read is quick, only the whole answer is slow
+        SlowSiteverify.delay = 2
+        client = RecaptchaClient(secret='s', url=self.url, budget=0.3)
+        started = time.monotonic()
+        result = client.verify('token')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(result['unavailable'])
+
+    def test_stalled_body_is_cut_off_at_the_budget(self):
+        # headers late in the budget, then nothing
+        SlowSiteverify.headers_after = 0.4
+        SlowSiteverify.stall = 2
+        client = RecaptchaClient(secret='s', url=self.url, budget=0.5)
+        started = time.monotonic()
+        result = client.verify('token')
+        self.assertLess(time.monotonic() - started, 0.7)
+        self.assertTrue(result['unavailable'])
+
+    def test_circuit_opens_after_repeated_failures(self):
+        SlowSiteverify.delay = 1
+        client = RecaptchaClient(secret='s', url=self.url, budget=0.1, failure_threshold=2, reset_after=60)
+        client.verify('token')
+        client.verify('token')
+        self.assertTrue(client.circuit_open)
+
+        started = time.monotonic()
+        self.assertEqual(client.verify('token')['error'], 'circuit open')
+        self.assertLess(time.monotonic() - started, 0.05)
+
+        # after reset_after one trial goes through and closes it again
+        SlowSiteverify.delay = 0
+        client.reset_after = 0
+        self.assertTrue(client.verify('token')['success'])
+        self.assertFalse(client.circuit_open)
+
+
+@override_settings(RECAPTCHA_CLIENT='houses.recaptcha.StubRecaptchaClient')
+class ReviewCaptchaTests(TestCase):
+    def setUp(self):
+        self.house = create_house(User.objects.create_user('landlord', password='pass'))
+
+    def post_review(self, token):
+        return self.client.post(reverse('house_detail', args=[self.house.id]), {
+            'review': '1', 'g-recaptcha-response': token,
+            'name': 'Wanjiru', 'email': 'w@example.com', 'rating': 4, 'comment': 'Quiet and clean',
+        })
+
+    def test_verified_review_is_saved(self):
+        self.post_review('ok')
+        self.assertEqual(self.house.reviews.count(), 1)
+
+    def test_rejected_or_unverifiable_review_is_not_saved(self):
+        response = self.post_review('fail')
+        self.assertIn('CAPTCHA failed', str(list(response.wsgi_request._messages)))
+        response = self.post_review('down')
+        self.assertIn('Error verifying CAPTCHA', str(list(response.wsgi_request._messages)))
+        self.assertEqual(self.house.reviews.count(), 0)
+
+
+class ActivityRecorderTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('landlord', password='pass')
+        self.recorder = activity.ActivityRecorder(batch_size=3, background=False)
+
+    def make(self, **kwargs):
+        return Activity(user=self.user, activity_type='house_posted', **kwargs)
+
+    def test_written_in_batches(self):
+        self.recorder.add(self.make())
+        self.recorder.add(self.make())
+        self.assertEqual(Activity.objects.count(), 0)
+        with self.assertNumQueries(1):
+            self.recorder.add(self.make())
+        self.assertEqual(Activity.objects.count(), 3)
+        self.assertEqual(len(self.recorder), 0)
+
+    def test_buffered_until_commit_and_flushed_on_close(self):
+        activity._recorder, previous = self.recorder, activity._recorder
+        self.addCleanup(setattr, activity, '_recorder', previous)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            activity.record_activity('house_posted', user=self.user, description='You added a house')
+        self.assertEqual(len(self.recorder), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(self.recorder), 1)
+
+        self.recorder.close()
+        self.assertEqual(Activity.objects.get().description, 'You added a house')
+
+    def test_activity_of_a_deleted_house_does_not_sink_the_batch(self):
+        house = create_house(self.user)
+        self.recorder.add(self.make(house_id=house.id))
+        self.recorder.add(self.make(description='kept'))
+        house.delete()
+        self.assertEqual(self.recorder.flush(), 1)
+        self.assertEqual(Activity.objects.get().description, 'kept')
+
+    def test_views_leave_the_insert_to_the_recorder(self):
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('delete_house', args=[create_house(self.user).id]))
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(Activity.objects.count(), 0)
+
+        with self.settings(ACTIVITY_WRITE_BEHIND=False):
+            self.client.post(reverse('delete_house', args=[create_house(self.user).id]))
+        self.assertEqual(Activity.objects.count(), 1)
+
+
+class ActivityCompactionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('landlord', password='pass')
+        self.house = create_house(self.user)
+        self.old = timezone.now() - timedelta(days=100)
+
+    def log(self, when, activity_type='house_updated', **kwargs):
+        return Activity.objects.create(user=self.user, house=self.house, activity_type=activity_type, created_at=when, **kwargs)
+
+    def test_old_activity_is_rolled_up_and_deleted(self):
+        for minutes in range(3):
+            self.log(self.old + timedelta(minutes=minutes))
+        self.log(self.old, activity_type='house_posted')
+        self.log(self.old - timedelta(days=1))
+        recent = self.log(timezone.now())
+
+        removed, summaries = compact_activity(retention_days=90, batch_size=2)
+
+        self.assertEqual((removed, summaries), (5, 3))
+        self.assertEqual(list(Activity.objects.values_list('id', flat=True)), [recent.id])
+        summary = ActivityDailySummary.objects.get(day=timezone.localdate(self.old), activity_type='house_updated')
+        self.assertEqual((summary.user, summary.house, summary.count), (self.user, self.house, 3))
+        self.assertEqual(summary.last_at - summary.first_at, timedelta(minutes=2))
+
+    def test_late_rows_are_merged_into_the_day(self):
+        self.log(self.old)
+        compact_activity(retention_days=90)
+        self.log(self.old - timedelta(minutes=5))
+        compact_activity(retention_days=90)
+
+        summary = ActivityDailySummary.objects.get()
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(summary.first_at, self.old - timedelta(minutes=5))
+        self.assertFalse(Activity.objects.exists())
+
+
+class DashboardStatsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        create_house(self.owner)
+        create_house(self.owner, is_active=False, payment_status='pending')
+        create_house(self.owner, is_active=False, payment_status='unpaid')
+        expiring = create_house(self.owner)
+        Payment.objects.create(
+            user=self.owner, house=expiring, amount=500, payment_method='mpesa', is_verified=True,
+            expiry_date=timezone.now() + timedelta(days=3),
+        )
+        create_house(User.objects.create_user('someone_else'))
+
+    def test_one_query(self):
+        with self.assertNumQueries(1):
+            stats = owner_listing_stats(House.objects.filter(owner=self.owner))
+        self.assertEqual(stats, {'total': 4, 'approved': 2, 'pending_payment': 1, 'unpaid': 1, 'expiring_soon': 1})
+
+    def test_dashboard_queries_do_not_grow_with_listings(self):
+        self.client.force_login(self.owner)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse('dashboard'))
+        for _ in range(20):
+            create_house(self.owner)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(response.context['stats']['total'], 24)
+        self.assertEqual(response.context['house_count'], 24)
@@ -4,12 +4,15 @@ from django.urls import path
 urlpatterns = [
     path('', views.home, name='home'),  # Homepage
     path('search/', views.search, name='search'),  # Search
+    path('houses/nearby/', views.nearby_houses, name='nearby_houses'),  # JSON radius / bounding box search
+    path('houses/map/', views.map_clusters, name='map_clusters'),  # JSON map markers and clusters
     path('house/<int:id>/', views.house_detail, name='house_detail'),  # Fixed: <int:id>
     path('post-house/', views.post_house, name='post_house'),  # Post new house
     path('house/<int:house_id>/edit/', views.edit_house, name="edit_house"), # edit house 
     path('house/delete/<int:house_id>/', views.delete_house, name='delete_house'),  # Delete house
     path('house/image/<int:image_id>/delete/', views.delete_house_image, name='delete_house_image'),  # Delete house image
     path('contact-support/<int:house_id>/', views.contact_support, name='contact_support'),
+    path('cache-stats/', views.cache_stats, name='cache_stats'),  # listing card cache counters (staff)
     # path('review/<int:house_id>/', views.add_review, name='add_review'),
     path('house/<int:id>/add-review/', views.house_detail, name='add_review'),
     # Dashboard
@@ -1,45 +1,54 @@
+import math
 from decimal import Decimal
 from bs4 import BeautifulSoup
-import requests
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.db.models import Q
 from django.db import transaction
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib import messages
-from PIL import Image
 from django.contrib.auth import get_user_model
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.http import JsonResponse
+from django.urls import reverse
 
 User = get_user_model()
 
+from houses import geo, mapgrid
 from houses.form import HouseEditForm, ReviewForm, HouseForm
+from houses.activity import record_activity
+from houses.caching import anonymous_page_key, cached_page, card_cache_stats, render_cards, store_page
+from houses.facets import facet_counts
+from houses.images import schedule_derivatives, validate_uploaded_images
 from houses.models import Activity, House, HouseImage, HouseTerm
+from houses.pagination import KeysetPaginator, cached_count
+from houses.recaptcha import get_recaptcha_client
+from houses.search import search_houses
+from houses.stats import owner_listing_stats
 
 
 # Create your views here.
 def home(request):
-    houses = House.objects.filter(is_active=True,payment_status='paid').order_by('-date_posted')
+    # anonymous visitors share cached pages until the public feed changes
+    page_key = anonymous_page_key(request, 'home')
+    response = cached_page(page_key)
+    if response is not None:
+        return response
+
+    houses = House.objects.filter(is_active=True,payment_status='paid').select_related('cover_image').order_by('-date_posted')
     
-    # handle search
-    search_query = request.GET.get('search', '')
+    # handle search (full-text index, best matches first)
+    search_query = request.GET.get('search', '').strip()
     if search_query:
-        houses = houses.filter(
-            Q(title__icontains=search_query) | Q(description__icontains=search_query) | Q(location__icontains=search_query) |
-            Q(house_type__icontains=search_query) | Q(rent__icontains=search_query) | Q(floor_number__icontains=search_query)
-        )
+        houses = search_houses(houses, search_query)
 
-    # handle sorting
+    # handle sorting (applied by the keyset paginator)
     sort_options = request.GET.get('sort', '')
     if sort_options in ['date_posted', '-date_posted', 'rent', '-rent', 'title', '-title']:
-        houses = houses.order_by(sort_options)
+        sort_key = sort_options
+    elif search_query:
+        sort_key = 'search_rank'
     else:
-        houses = houses.order_by('-date_posted')
-
-    # handle house type filter
-    house_type_filter = request.GET.get('house_type', '')
-    if house_type_filter:
-        houses = houses.filter(house_type=house_type_filter)
+        sort_key = '-date_posted'
 
     # handle status filter
     status_filter = request.GET.get('status', '')
@@ -48,10 +57,21 @@ def home(request):
     elif status_filter == 'pending':
         houses = houses.filter(is_active=False)
 
-    # handle rent range filter
+    house_type_filter = request.GET.get('house_type', '')
     min_rent = request.GET.get('min_rent', '')
     max_rent = request.GET.get('max_rent', '')
-    
+
+    # counts per house type / rent band for the filter menu, one query (cached for the plain feed)
+    facets = facet_counts(
+        houses, house_type_filter, min_rent, max_rent,
+        use_cache=not (search_query or status_filter or house_type_filter or min_rent or max_rent)
+    )
+
+    # handle house type filter
+    if house_type_filter:
+        houses = houses.filter(house_type=house_type_filter)
+
+    # handle rent range filter
     if min_rent and max_rent:
         houses = houses.filter(rent__gte=Decimal(min_rent), rent__lte=Decimal(max_rent))
 
@@ -60,33 +80,28 @@ def home(request):
     if  max_rent:
         houses = houses.filter(rent__lte=Decimal(max_rent))
     
-    # paginatio - 20 houses per page
-    paginator = Paginator(houses, 5)
-    page = request.GET.get('page', 1)
-
-    try:
-        houses_page = paginator.page(page)
-    except PageNotAnInteger:
-        houses_page = paginator.page(1)
-    except EmptyPage:
-        houses_page = paginator.page(paginator.num_pages)
+    # keyset pagination - no OFFSET scan, the total is cached instead of counted per request
+    paginator = KeysetPaginator(houses, 5, sort_key)
+    houses_page = paginator.page(request.GET.get('cursor'))
+    # cards come from the fragment cache, only changed ones are rendered
+    render_cards(houses_page)
 
-    
     context = {
         'houses': houses_page,
         'paginator': paginator,
         'page_obj': houses_page,
-        'house_count': houses.count(),
+        'house_count': cached_count(houses),
         'is_paginated': houses_page.has_other_pages(),
+        'facets': facets,
     }
 
     # add existing GET parameters to context for pagination links
     get_params = request.GET.copy()
-    if 'page' in get_params:
-        del get_params['page']
+    for param in ['page', 'cursor']:
+        get_params.pop(param, None)
     context['get_params'] = get_params.urlencode()
     
-    return render(request, 'house/index.html', context)
+    return store_page(page_key, render(request, 'house/index.html', context))
 
 def search(request):
     query = request.GET.get('q', '')
@@ -105,13 +120,123 @@ def search(request):
     return render(request, 'house/search.html', {'houses':houses, 'query':query, 'location': location})
 
 
+REVIEWS_PER_PAGE = 10
+
+NEARBY_MAX_RADIUS_KM = 50
+NEARBY_MAX_RESULTS = 100
+
+
+def _house_marker(house, distance=None):
+    data = {
+        'id': house.id,
+        'title': house.title,
+        'house_type': house.house_type,
+        'rent': str(house.rent),
+        'location': house.location,
+        'latitude': float(house.latitude),
+        'longitude': float(house.longitude),
+        'url': reverse('house_detail', args=[house.id]),
+        'image': house.cover_image.card_url if house.cover_image else None,
+    }
+    if distance is not None:
+        data['distance_km'] = round(distance, 3)
+    return data
+
+
+def _finite(value):
+    """ float(value), ValueError for nan and inf as well """
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(value)
+    return number
+
+
+def _parse_bbox(value):
+    """ 'min_lng,min_lat,max_lng,max_lat' (Leaflet's toBBoxString) -> (min_lat, min_lng, max_lat, max_lng) within ±90/±180 """
+    min_lng, min_lat, max_lng, max_lat = [_finite(part) for part in value.split(',')]
+    # clamped to the world, so the geohash cover stays a bounded number of cells
+    min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+    min_lng, max_lng = max(min_lng, -180.0), min(max_lng, 180.0)
+    if min_lat > max_lat or min_lng > max_lng:
+        raise ValueError(value)
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def nearby_houses(request):
+    """
+    JSON search by location.
+
+    ?lat=&lng=&radius=2           listings within radius km, closest first
+    ?bbox=min_lng,min_lat,max_lng,max_lat   listings inside the box
+    house_type, min_rent and max_rent narrow either search.
+    """
+    houses = House.objects.filter(is_active=True, payment_status='paid')
+
+    house_type = request.GET.get('house_type', '')
+    if house_type:
+        houses = houses.filter(house_type=house_type)
+    try:
+        if request.GET.get('min_rent'):
+            houses = houses.filter(rent__gte=Decimal(request.GET['min_rent']))
+        if request.GET.get('max_rent'):
+            houses = houses.filter(rent__lte=Decimal(request.GET['max_rent']))
+        limit = min(max(int(request.GET.get('limit', 20)), 1), NEARBY_MAX_RESULTS)
+
+        if request.GET.get('bbox'):
+            min_lat, min_lng, max_lat, max_lng = _parse_bbox(request.GET['bbox'])
+            results = geo.within_bbox(houses, min_lat, min_lng, max_lat, max_lng).select_related('cover_image')
+            return JsonResponse({'results': [_house_marker(house) for house in results.order_by('-date_posted', '-id')[:limit]]})
+
+        latitude = _finite(request.GET['lat'])
+        longitude = _finite(request.GET['lng'])
+        radius = min(_finite(request.GET.get('radius', 2)), NEARBY_MAX_RADIUS_KM)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or radius <= 0:
+            raise ValueError
+    except (KeyError, ValueError, ArithmeticError):
+        return JsonResponse({'error': 'Pass lat, lng and radius (km) or bbox=min_lng,min_lat,max_lng,max_lat'}, status=400)
+
+    matches = geo.nearby(houses, latitude, longitude, radius, limit)
+    found = House.objects.select_related('cover_image').in_bulk([house_id for house_id, _ in matches])
+    return JsonResponse({
+        'results': [_house_marker(found[house_id], distance) for house_id, distance in matches if house_id in found]
+    })
+
+
+MAP_MAX_MARKERS = 500
+
+
+def map_clusters(request):
+    """
+    JSON markers for the listings map: ?bbox=min_lng,min_lat,max_lng,max_lat&zoom=
+
+    Zoomed out, returns precomputed clusters with counts; from MAP_MARKER_ZOOM
+    on, the individual listings in view.
+    """
+    try:
+        min_lat, min_lng, max_lat, max_lng = _parse_bbox(request.GET['bbox'])
+        zoom = int(request.GET['zoom'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Pass bbox=min_lng,min_lat,max_lng,max_lat and zoom'}, status=400)
+
+    if zoom >= mapgrid.MAP_MARKER_ZOOM:
+        houses = House.objects.filter(is_active=True, payment_status='paid').select_related('cover_image')
+        houses = geo.within_bbox(houses, min_lat, min_lng, max_lat, max_lng).order_by('-date_posted', '-id')
+        return JsonResponse({'zoom': zoom, 'markers': [_house_marker(house) for house in houses[:MAP_MAX_MARKERS]]})
+
+    level = mapgrid.zoom_to_level(zoom)
+    return JsonResponse({'zoom': zoom, 'level': level, 'clusters': mapgrid.clusters(min_lat, min_lng, max_lat, max_lng, level)})
+
+
 def house_detail(request, id):
-    house = get_object_or_404(House, id=id, is_active=True)
+    house = get_object_or_404(
+        House.objects.select_related('cover_image', 'owner__profile').prefetch_related('images'),
+        id=id, is_active=True
+    )
 
     print(f" House : {house} ")
 
-    # reviews = house.reviews.all().order_by('-date_posted')
-    reviews = house.reviews.all().order_by('-created_at')[0:10] # Load first review initially
+    # first page of reviews, the rest come from load_more_reviews by cursor
+    reviews = KeysetPaginator(house.reviews.all(), REVIEWS_PER_PAGE, '-created_at').page()
     
     if request.method == 'POST':
         if 'review' in request.POST:
@@ -122,30 +247,20 @@ def house_detail(request, id):
                 messages.error(request,"Please complete your CAPTCHA!")
                 return redirect('house_detail', id=id)
 
-            # 2. VERIFY WITH GOOGLE
-            verify_url = 'https://www.google.com/recaptcha/api/siteverify'
-            data = { 'secret':settings.RECAPTCHA_SECRET_KEY,
-                     'response': recaptcha_response,
-                     'remoteip': request.META.get("REMOTE_ADDR")
-                    }
+            # 2. VERIFY WITH GOOGLE (pooled client, capped at settings.RECAPTCHA_TIMEOUT seconds)
+            result = get_recaptcha_client().verify(recaptcha_response, request.META.get("REMOTE_ADDR"))
 
-            try:
-                response = requests.post(verify_url, data=data, timeout=10)
-                
-                result = response.json()
-            
-                if not result.get('success'):
-                    messages.error(request, "CAPTCHA failed. Are you a robot?")
-                    return redirect('house_detail', id=id)
+            if result['unavailable']:
+                messages.error(request, "Error verifying CAPTCHA. Please try again.")
+                return redirect('house_detail', id=id)
 
-                # 3. CHECK SCORE threshold
-                score = result.get('score', 0)
-                if score < settings.RECAPTCHA_REQUIRED_SCORE:
-                    messages.error(request, "CAPTCHA score too low. Are you a robot?")
-                    return redirect('house_detail', id=id)
+            if not result['success']:
+                messages.error(request, "CAPTCHA failed. Are you a robot?")
+                return redirect('house_detail', id=id)
 
-            except requests.exceptions.RequestException as e:
-                messages.error(request, "Error verifying CAPTCHA. Please try again.")
+            # 3. CHECK SCORE threshold
+            if result['score'] < settings.RECAPTCHA_REQUIRED_SCORE:
+                messages.error(request, "CAPTCHA score too low. Are you a robot?")
                 return redirect('house_detail', id=id)
 
             review_form = ReviewForm(request.POST)
@@ -155,7 +270,7 @@ def house_detail(request, id):
                 review.house = house
                 review.save()
                 
-                Activity.objects.create(
+                record_activity(
                     user=None,
                     activity_type='added_review',
                     description=f"A review was added to the house: {house.title}",
@@ -186,25 +301,19 @@ def load_dashboard(request):
         owner=request.user
     ).order_by('-date_posted')
 
-    # handle search
-    search_query = request.GET.get('search', '')
+    # handle search (full-text index, ranked within this owner's houses)
+    search_query = request.GET.get('search', '').strip()
     if search_query:
-        houses = houses.filter(
-            Q(title__icontains=search_query) | Q(description__icontains=search_query) | Q(location__icontains=search_query) |
-            Q(house_type__icontains=search_query) | Q(rent__icontains=search_query) | Q(floor_number__icontains=search_query)
-        )
+        houses = search_houses(houses, search_query)
 
-    # handle sorting
+    # handle sorting (applied by the keyset paginator)
     sort_options = request.GET.get('sort', '')
     if sort_options in ['date_posted', '-date_posted', 'rent', '-rent', 'title', '-title']:
-        houses = houses.order_by(sort_options)
+        sort_key = sort_options
+    elif search_query:
+        sort_key = 'search_rank'
     else:
-        houses = houses.order_by('-date_posted')
-
-    # handle house type filter
-    house_type_filter = request.GET.get('house_type', '')
-    if house_type_filter:
-        houses = houses.filter(house_type=house_type_filter)
+        sort_key = '-date_posted'
 
     # handle payment status filter (NEW)
     payment_status_filter = request.GET.get('payment_status', '')
@@ -228,10 +337,18 @@ def load_dashboard(request):
     elif activity_filter == 'inactive':
         houses = houses.filter(is_active=False)
 
-    # handle rent range filter
+    house_type_filter = request.GET.get('house_type', '')
     min_rent = request.GET.get('min_rent', '')
     max_rent = request.GET.get('max_rent', '')
-    
+
+    # counts per house type / rent band for the filter menu, one query
+    facets = facet_counts(houses, house_type_filter, min_rent, max_rent)
+
+    # handle house type filter
+    if house_type_filter:
+        houses = houses.filter(house_type=house_type_filter)
+
+    # handle rent range filter
     if min_rent and max_rent:
         houses = houses.filter(rent__gte=Decimal(min_rent), rent__lte=Decimal(max_rent))
 
@@ -240,21 +357,16 @@ def load_dashboard(request):
     if  max_rent:
         houses = houses.filter(rent__lte=Decimal(max_rent))
 
-    # paginatio - 20 houses per page
-    paginator = Paginator(houses, 5)
-    page = request.GET.get('page', 1)
-
-    try:
-        houses_page = paginator.page(page)
-    except PageNotAnInteger:
-        houses_page = paginator.page(1)
-    except EmptyPage:
-        houses_page = paginator.page(paginator.num_pages)   
+    # keyset pagination - no OFFSET scan
+    paginator = KeysetPaginator(houses, 5, sort_key)
+    houses_page = paginator.page(request.GET.get('cursor'))
 
     # get recent activities 
-    recent_activities = Activity.objects.filter(user=request.user).select_related("house").order_by('-created_at')[:5]
-    total_listed_houses = houses.count()
-    total_approved_houses = houses.filter(is_active=True).count()
+    recent_activities = list(Activity.objects.filter(user=request.user).select_related("house").order_by('-created_at')[:5])
+    # every count the dashboard shows, one query
+    stats = owner_listing_stats(houses)
+    total_listed_houses = stats['total']
+    total_approved_houses = stats['approved']
 
     # Get house types for filter dropdown - ADD THIS LINE
     house_types = House.HOUSE_TYPES
@@ -266,18 +378,20 @@ def load_dashboard(request):
         'recent_activities': recent_activities,
         'total_listed_houses': total_listed_houses,
         'total_approved_houses': total_approved_houses,
+        'stats': stats,
         'house_types': house_types,
+        'facets': facets,
         'paginator': paginator,
         'page_obj': houses_page,
-        'house_count': houses.count(),
+        'house_count': total_listed_houses,
         'is_paginated': houses_page.has_other_pages(),
         'amount': settings.AMOUNT_TO_PAY_PER_HOUSE,
     }
 
     # add existing GET parameters to context for pagination links
     get_params = request.GET.copy()
-    if 'page' in get_params:
-        del get_params['page']
+    for param in ['page', 'cursor']:
+        get_params.pop(param, None)
     context['get_params'] = get_params.urlencode()
 
     return render(request, 'house/dashboard.html', context)
@@ -297,7 +411,7 @@ def delete_house(request, house_id):
         house.delete()
         
         # Create activity for house deletion
-        Activity.objects.create(
+        record_activity(
             user=request.user,
             activity_type='deleted_house',
             description=f"You edited the house: {house_title}",
@@ -337,37 +451,13 @@ def post_house(request):
                         'form': form
                     })
 
-                # Validate each image
-                for img in images:
-                    # Check file size (20MB = 20 * 1024 * 1024 bytes)
-                    if img.size > 20 * 1024 * 1024:
-                        messages.error(request, f"Image {img.name} is too large. Maximum size is 20MB.")
-                        return render(request, 'house/post_house.html', {
-                            'form': form
-                        })
-                    
-                    # Check if it's a valid image using Pillow
-                    try:
-                        # Open image with Pillow to validate
-                        image = Image.open(img)
-                        image.verify()  # Verify it's a valid image
-                        
-                        # Reset file pointer after verification
-                        img.seek(0)
-                        
-                        # Check dimensions (optional)
-                        width, height = image.size
-                        if width > 10000 or height > 10000:
-                            messages.error(request, f"Image {img.name} dimensions are too large.")
-                            return render(request, 'house/post_house.html', {
-                                'form': form
-                            })
-                            
-                    except Exception as e:
-                        messages.error(request, f"Invalid image file: {img.name}. Please upload valid images only.")
-                        return render(request, 'house/post_house.html', {
-                            'form': form
-                        })
+                # Validate images: header + dimensions only, in parallel, first bad file wins
+                error = validate_uploaded_images(images)
+                if error:
+                    messages.error(request, error)
+                    return render(request, 'house/post_house.html', {
+                        'form': form
+                    })
 
                 # 2. CREATE HOUSE WITH COORDINATES
                 house = form.save(commit=False)
@@ -384,12 +474,10 @@ def post_house(request):
                 
                 house.save()
 
-                # 3. SAVE VALIDATED IMAGES
-                for img in images:
-                    HouseImage.objects.create(
-                        house=house, 
-                        image=img
-                    )
+                # 3. SAVE VALIDATED IMAGES in one INSERT (resized copies are built after commit)
+                HouseImage.objects.bulk_create([HouseImage(house=house, image=img) for img in images])
+                house.refresh_cover_image()
+                schedule_derivatives(house.images.values_list('id', flat=True))
 
                 # 4. SAVE RICH TEXT TERMS FROM QUILL
                 terms_content = request.POST.get('terms', '').strip()
@@ -418,18 +506,15 @@ def post_house(request):
                         'form': form
                     })
 
-                # Save each line as a separate HouseTerm
-                for term_text in term_lines:
+                # Save each line as a separate HouseTerm, in one INSERT
+                HouseTerm.objects.bulk_create([
                     # Truncate if longer than 2000 characters
-                    if len(term_text) > 2000:
-                        term_text = term_text[:1997] + "..."
-                    
-                    HouseTerm.objects.create(
-                        house=house,
-                        term=term_text
-                    )
+                    HouseTerm(house=house, position=position,
+                              term=term_text[:1997] + "..." if len(term_text) > 2000 else term_text)
+                    for position, term_text in enumerate(term_lines)
+                ])
 
-                Activity.objects.create(
+                record_activity(
                     user=request.user,
                     activity_type='posted_house',
                     description=f"You added a  house: {house.title}",
@@ -467,9 +552,7 @@ def edit_house(request, house_id):
         messages.error(request, "You can only edit your own houses!")
         return redirect('dashboard')
 
-    terms_html = ""
-    if house.terms.exists():
-        terms_html = "".join([f"<p>{term.term}</p>" for term in house.terms.all()])
+    terms_html = "".join([f"<p>{term.term}</p>" for term in house.terms.all()])
     
     if request.method == 'POST':
         form = HouseEditForm(request.POST, request.FILES, instance=house)
@@ -491,34 +574,35 @@ def edit_house(request, house_id):
                             'terms_html': terms_html,
                         })
                     
-                    for img in new_images:
-                        # Validate image size
-                        if img.size > 20 * 1024 * 1024:  # 20MB
-                            messages.error(request, f"Image {img.name} is too large. Maximum size is 20MB.")
-                            return render(request, 'house/edit_house.html', {
-                                'form': form, 
-                                'house': house, 
-                                'terms_html': terms_html,
-                            })
-                        HouseImage.objects.create(house=house, image=img)
-
-                # Handle updated terms (from Quill editor)
+                    error = validate_uploaded_images(new_images)
+                    if error:
+                        messages.error(request, error)
+                        return render(request, 'house/edit_house.html', {
+                            'form': form, 
+                            'house': house, 
+                            'terms_html': terms_html,
+                        })
+
+                    saved_images = HouseImage.objects.bulk_create([HouseImage(house=house, image=img) for img in new_images])
+                    house.refresh_cover_image()
+                    schedule_derivatives(image.id for image in saved_images if image.id)
+
+                # Handle updated terms (from Quill editor), only changed lines are written
                 new_terms_html = request.POST.get('terms', '')
                 if new_terms_html.strip():
-                    # Delete old terms
-                    house.terms.all().delete()
-                    # Save new terms
                     from django.utils.html import strip_tags
+                    new_terms = []
                     clean_text = strip_tags(new_terms_html).strip()
                     if clean_text:
-                        # Split by paragraphs and create separate terms
+                        # Split by paragraphs into separate terms
                         terms_list = new_terms_html.split('</p><p>')
                         for term_html in terms_list:
                             clean_term = strip_tags(term_html).strip()
                             if clean_term and clean_term not in ['', '<br>']:
-                                HouseTerm.objects.create(house=house, term=clean_term)
+                                new_terms.append(clean_term)
+                    house.set_terms(new_terms)
 
-                Activity.objects.create(
+                record_activity(
                     user=request.user,
                     activity_type='edited_house',
                     description=f"You edited the house: {house.title}",
@@ -555,8 +639,9 @@ def delete_house_image(request, image_id):
         house = image.house
         image.image.delete(save=False)  # Delete file from storage
         image.delete()  # Delete DB record
+        house.refresh_cover_image()
 
-        Activity.objects.create(
+        record_activity(
             user=request.user,
             activity_type='deleted_house',
             description=f"You delete an image of this house: {house.title}",
@@ -601,6 +686,13 @@ def contact_support(request, house_id):
     # Redirect back to the page user came from
     return redirect(request.META.get('HTTP_REFERER', '/'))
 
+@login_required
+def cache_stats(request):
+    """Listing card cache hit / miss counters (staff)"""
+    if not request.user.is_staff:
+        return redirect('dashboard')
+    return JsonResponse({'card_cache': card_cache_stats()})
+
 def privacy_policy(request):
     return render(request, 'legal/privacy_policy.html')
 
@@ -0,0 +1,107 @@
+"""
+Applying M-Pesa STK results to payments.
+
+Safaricom redelivers a callback it doesn't get a timely answer for, and two
+deliveries can arrive at the same time. apply_stk_callback() finds the payment
+through the checkout_request_id index, locks its row, and records the result
+as a PaymentTransaction whose dedupe_key is the CheckoutRequestID - so
+whichever delivery comes second sees the first one's transaction and changes
+nothing. The unique key backs this up where row locks aren't available.
+
+A result settled by payments.reconcile (request_type 'STK_QUERY') gives way to
+the real callback if that arrives later: the query answer has no receipt
+number, and a payment given up on may turn out to have been paid after all.
+The callback takes over the dedupe_key and is applied; a failure never undoes
+a payment that was already confirmed.
+"""
+import logging
+
+from django.db import IntegrityError, transaction
+
+from payments.models import Payment, PaymentTransaction
+from payments.notify import payment_changed
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = (404, {"ResultCode": 1, "ResultDesc": "Payment not found"})
+ALREADY_PROCESSED = (200, {"ResultCode": 0, "ResultDesc": "Already processed"})
+
+
+def apply_stk_callback(data, request_type='STK_PUSH'):
+    """
+    Apply a {'Body': {'stkCallback': ...}} result to its Payment exactly once.
+
+    Returns (http status, response body) to answer Safaricom with.
+    """
+    callback = data.get('Body', {}).get('stkCallback', {})
+    checkout_id = callback.get('CheckoutRequestID')
+    if not checkout_id:
+        return NOT_FOUND
+
+    try:
+        with transaction.atomic():
+            payment = Payment.objects.select_for_update().filter(checkout_request_id=checkout_id).first()
+            if payment is None:
+                return NOT_FOUND
+            settled = PaymentTransaction.objects.filter(dedupe_key=checkout_id).first()
+            if settled is not None:
+                if settled.request_type != 'STK_QUERY' or request_type == 'STK_QUERY':
+                    return ALREADY_PROCESSED
+                # settled by reconciliation, the callback itself is still welcome
+                settled.dedupe_key = f'{checkout_id}:query'
+                settled.save(update_fields=['dedupe_key'])
+            result = _apply(payment, callback, data, request_type)
+            # wake the browser waiting on this payment, once committed
+            payment_changed(payment.id)
+            return result
+    except IntegrityError:
+        # lost the race on dedupe_key, everything above was rolled back
+        return ALREADY_PROCESSED
+
+
+def _apply(payment, callback, data, request_type):
+    result_code = callback.get('ResultCode')
+
+    PaymentTransaction.objects.create(
+        payment=payment,
+        request_type=request_type,
+        request_data={},
+        response_data=data,
+        status_code=result_code if result_code is not None else -1,
+        dedupe_key=callback['CheckoutRequestID'],
+    )
+
+    if result_code == 0:
+        items = callback.get("CallbackMetadata", {}).get("Item", [])
+        metadata = {item["Name"]: item.get("Value") for item in items}
+
+        transaction_id = metadata.get("MpesaReceiptNumber")
+        payment.phone_number = metadata.get("PhoneNumber") or payment.phone_number
+        payment.amount = metadata.get("Amount") or payment.amount
+        payment.raw_response = data
+        if payment.status == 'paid':
+            # confirmed by reconciliation already, only the receipt was missing
+            payment.transaction_id = transaction_id or payment.transaction_id
+            payment.save()
+            return 200, {"ResultCode": 0, "ResultDesc": "Success"}
+        payment.mark_as_completed(transaction_id)
+
+        if payment.house:
+            payment.house.payment_status = "paid"
+            payment.house.is_active = True
+            payment.house.save()
+        return 200, {"ResultCode": 0, "ResultDesc": "Success"}
+
+    if payment.status == 'paid':
+        logger.warning("Ignoring failed callback for confirmed payment %s", payment.id)
+        return 200, {"ResultCode": 0, "ResultDesc": "Already processed"}
+
+    payment.status = 'failed'
+    payment.notes = callback.get('ResultDesc') or ''
+    payment.raw_response = data
+    payment.save()
+
+    if payment.house and payment.house.payment_status != 'paid':
+        payment.house.payment_status = 'unpaid'
+        payment.house.save()
+    return 200, {"ResultCode": 0, "ResultDesc": "Failed logged"}
@@ -0,0 +1,159 @@
+"""
+HTTP client for Safaricom's Daraja API.
+
+One DarajaClient per process keeps a pooled keep-alive session, so STK pushes
+reuse an open TLS connection instead of doing a fresh handshake each time.
+Every endpoint has its own (connect, read) timeout. Connection failures are
+retried for any call, since nothing reached Safaricom. 5xx answers and read
+timeouts are only retried for calls that are safe to repeat - never for the
+STK push itself, which would prompt the customer twice.
+
+Calls, errors, retries and latency are counted per endpoint, see stats().
+"""
+import base64
+import logging
+import threading
+import time
+
+import requests
+import urllib3
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = 20
+RETRIES = 2
+BACKOFF = 0.3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the 500 an STK query answers with while the customer hasn't responded yet - an answer, not an outage
+STILL_PROCESSING = '500.001.1001'
+
+# (connect, read) seconds
+TIMEOUTS = {
+    'oauth': (3.05, 10),
+    'stk_push': (3.05, 30),
+    'stk_query': (3.05, 15),
+}
+
+
+class DarajaError(Exception):
+    pass
+
+
+class DarajaClient:
+    def __init__(self, pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF):
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        # retries are all done by _request, so each call makes at most 1 + retries attempts
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def fetch_access_token(self):
+        """ (token, expires_in) from the OAuth endpoint """
+        auth = base64.b64encode(
+            f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}".encode()
+        ).decode()
+        response = self._request('oauth', 'GET', settings.MPESA_OAUTH_URL, idempotent=True,
+                                 headers={"Authorization": f"Basic {auth}"})
+        data = self._json(response)
+        if response.status_code != 200:
+            raise DarajaError(data.get("errorMessage", "Failed to obtain token"))
+        if not data.get("access_token"):
+            raise DarajaError("Access token missing in response")
+        return data["access_token"], data.get("expires_in")
+
+    def stk_push(self, payload, access_token):
+        """ (status code, json body) of an STK push request """
+        response = self._request('stk_push', 'POST', settings.MPESA_STK_PUSH_URL, idempotent=False,
+                                 json=payload, headers={"Authorization": f"Bearer {access_token}"})
+        return response.status_code, self._json(response)
+
+    def stk_query(self, payload, access_token):
+        """ (status code, json body) of an STK push status query - safe to repeat """
+        response = self._request('stk_query', 'POST', settings.MPESA_STK_QUERY_URL, idempotent=True,
+                                 json=payload, headers={"Authorization": f"Bearer {access_token}"})
+        return response.status_code, self._json(response)
+
+    def stats(self):
+        """ {endpoint: {'calls', 'errors', 'retries', 'avg_ms', 'max_ms'}} """
+        with self._lock:
+            return {
+                endpoint: {
+                    'calls': counts['calls'],
+                    'errors': counts['errors'],
+                    'retries': counts['retries'],
+                    'avg_ms': round(counts['total_ms'] / counts['calls'], 1) if counts['calls'] else None,
+                    'max_ms': round(counts['max_ms'], 1),
+                }
+                for endpoint, counts in self._stats.items()
+            }
+
+    def _request(self, endpoint, method, url, idempotent, **kwargs):
+        attempts = 1 + self.retries
+        for attempt in range(attempts):
+            if attempt:
+                self._count(endpoint, retries=1)
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=TIMEOUTS[endpoint], **kwargs)
+            except requests.RequestException as e:
+                self._count(endpoint, started, error=True)
+                if attempt + 1 < attempts and (idempotent or _never_sent(e)):
+                    continue
+                logger.error("Daraja %s failed: %s", endpoint, e)
+                raise DarajaError(f"{endpoint}: {e}") from e
+
+            failed = (response.status_code >= 500 or response.status_code in RETRY_STATUSES) \
+                and STILL_PROCESSING not in response.text
+            self._count(endpoint, started, error=failed)
+            if failed and idempotent and attempt + 1 < attempts:
+                continue
+            return response
+
+    def _json(self, response):
+        try:
+            return response.json()
+        except ValueError:
+            raise DarajaError(f"Unexpected response ({response.status_code}): {response.text[:200]}")
+
+    def _count(self, endpoint, started=None, error=False, retries=0):
+        with self._lock:
+            counts = self._stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            counts['retries'] += retries
+            if started is not None:
+                elapsed = (time.monotonic() - started) * 1000
+                counts['calls'] += 1
+                counts['errors'] += int(error)
+                counts['total_ms'] += elapsed
+                counts['max_ms'] = max(counts['max_ms'], elapsed)
+
+
+def _never_sent(error):
+    """ True if the connection couldn't even be opened, so Safaricom never saw the request """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # requests wraps urllib3's MaxRetryError, whose reason is the actual failure
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_daraja_client():
+    """ The process-wide client, so all Daraja traffic shares one connection pool """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DarajaClient()
+        return _client
@@ -0,0 +1,138 @@
+"""
+STK push dispatch off the request path.
+
+process_payment only creates the Payment (status 'processing') and returns;
+the push to Safaricom - token plus STK request, up to 40 seconds when Daraja is
+slow - runs on a small thread pool once the transaction commits. The outcome
+lands on the Payment the processing page waits on: 'pending' once the
+prompt is on the customer's phone, 'failed' (house back to unpaid) when it
+couldn't be sent.
+
+With settings.MPESA_DISPATCH_SYNC the push runs in the calling thread.
+
+The queue only lives in this process: a push still queued when the process
+restarts is lost. fail_stale_dispatches(), run by the scheduler, fails
+payments left 'processing' for MPESA_DISPATCH_STALE_MINUTES since they were
+queued (dispatched_at) so the house can be paid for again. They are not
+pushed again - the prompt may have reached the phone before the process went
+down. A push that does go out after its payment was failed or cancelled
+still records its checkout id, so the customer's payment is settled by the
+callback.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from payments.notify import payment_changed
+from payments.utils import initiate_mpesa_stk_push
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'MPESA_DISPATCH_WORKERS', 8),
+            thread_name_prefix='stk-dispatch',
+        )
+    return _pool
+
+
+def shutdown_pool():
+    """Wait for queued pushes to finish"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def send_stk_push(payment_id):
+    """Push the prompt for a 'processing' payment and record how it went"""
+    from payments.models import Payment
+
+    payment = Payment.objects.select_related('house').filter(id=payment_id, status='processing').first()
+    if payment is None:
+        # cancelled (or already sent) while it was queued
+        return None
+
+    result = initiate_mpesa_stk_push(payment.phone_number, str(payment.amount), payment.id, payment.house_id)
+
+    if result['success']:
+        ids = {'checkout_request_id': result['checkout_request_id'], 'merchant_request_id': result['merchant_request_id']}
+        # pending only if nobody cancelled or failed it meanwhile
+        if not Payment.objects.filter(id=payment.id, status='processing').update(status='pending', **ids):
+            # the prompt is on the phone all the same, the callback must be able to find the payment
+            Payment.objects.filter(id=payment.id).update(**ids)
+        payment_changed(payment.id)
+        return result
+
+    updated = Payment.objects.filter(id=payment.id, status='processing').update(
+        status='failed', notes=f"STK push failed: {result.get('error')}"
+    )
+    if updated:
+        payment_changed(payment.id)
+        if payment.house and payment.house.payment_status == 'pending':
+            payment.house.payment_status = 'unpaid'
+            payment.house.save()
+    return result
+
+
+def _run(payment_id):
+    try:
+        return send_stk_push(payment_id)
+    except Exception:
+        logger.exception("STK push dispatch failed for payment %s", payment_id)
+    finally:
+        # pool threads outlive the request, don't leave their connections open
+        connections.close_all()
+
+
+def dispatch_stk_push(payment_id):
+    if getattr(settings, 'MPESA_DISPATCH_SYNC', False):
+        return send_stk_push(payment_id)
+    return get_pool().submit(_run, payment_id)
+
+
+def schedule_stk_push(payment_id):
+    """Send the push once the surrounding transaction commits, off the request path"""
+    transaction.on_commit(lambda: dispatch_stk_push(payment_id))
+
+
+def fail_stale_dispatches(older_than_minutes=None):
+    """Fail payments whose push was queued but never sent, returns how many"""
+    from houses.models import House
+    from payments.models import Payment
+
+    if older_than_minutes is None:
+        older_than_minutes = settings.MPESA_DISPATCH_STALE_MINUTES
+    cutoff = timezone.now() - timedelta(minutes=older_than_minutes)
+
+    with transaction.atomic():
+        stale = list(
+            Payment.objects.select_for_update()
+            .filter(status='processing', dispatched_at__lt=cutoff)
+            .order_by()
+            .values_list('id', 'house_id')
+        )
+        if not stale:
+            return 0
+        now = timezone.now()
+        Payment.objects.filter(id__in=[payment_id for payment_id, _ in stale]).update(
+            status='failed', notes="STK push was never sent", updated_at=now
+        )
+        # pending -> unpaid doesn't touch the public feed or the map, no signals needed
+        House.objects.filter(id__in={house_id for _, house_id in stale if house_id}, payment_status='pending').update(
+            payment_status='unpaid', updated_at=now
+        )
+        for payment_id, _ in stale:
+            payment_changed(payment_id)
+
+    logger.warning("Failed %s payments whose STK push was never sent", len(stale))
+    return len(stale)
@@ -0,0 +1,86 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from houses.models import House
+from payments.models import Payment, PaymentTransaction
+from payments.views import mpesa_callback
+
+
+class Rollback(Exception):
+    pass
+
+
+def callback_body(index, result_code=0):
+    callback = {
+        'MerchantRequestID': f'bench-merchant-{index}',
+        'CheckoutRequestID': f'bench-checkout-{index}',
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 1.0},
+            {'Name': 'MpesaReceiptNumber', 'Value': f'BENCH{index:08d}'},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}
+    return json.dumps({'Body': {'stkCallback': callback}})
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay M-Pesa STK callbacks (each delivered --replays times, as Safaricom retries do) through "
+        "mpesa_callback among --payments payments, then roll everything back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=2000)
+        parser.add_argument('--callbacks', type=int, default=500)
+        parser.add_argument('--replays', type=int, default=3)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        user = User.objects.create_user('bench-callbacks')
+        house = House.objects.create(
+            title='Bench house', house_type='bedsitter', description='-', location='-',
+            rent=1, deposit=1, house_number='-', owner=user,
+        )
+        Payment.objects.bulk_create([
+            Payment(user=user, house=house, amount=1, payment_method='mpesa', status='pending',
+                    checkout_request_id=f'bench-checkout-{index}', merchant_request_id=f'bench-merchant-{index}')
+            for index in range(options['payments'])
+        ], batch_size=1000)
+
+        factory = RequestFactory()
+        bodies = [callback_body(index) for index in range(options['callbacks'])]
+        timings = []
+        for replay in range(options['replays']):
+            started = time.perf_counter()
+            for body in bodies:
+                response = mpesa_callback(factory.post('/payment/mpesa-callback/', body, content_type='application/json'))
+                if response.status_code != 200:
+                    self.stderr.write(f"callback answered {response.status_code}: {response.content[:200]}")
+            timings.append(time.perf_counter() - started)
+            label = 'first delivery' if replay == 0 else f'replay {replay}'
+            self.stdout.write(
+                f"{label:<15} {len(bodies) / timings[-1]:8.0f} callbacks/s   "
+                f"{timings[-1] / len(bodies) * 1000:6.2f} ms each"
+            )
+
+        applied = PaymentTransaction.objects.filter(dedupe_key__startswith='bench-checkout-').count()
+        paid = Payment.objects.filter(user=user, status='paid').count()
+        self.stdout.write(
+            f"{len(bodies) * options['replays']} deliveries -> {applied} transactions, {paid} payments paid "
+            f"({'applied once each' if applied == paid == len(bodies) else 'MISMATCH'})"
+        )
@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments.scheduler import EXPIRY_BATCH_SIZE, expire_old_payments
+
+
+class Command(BaseCommand):
+    help = "Expire payments older than 1.5 years and take their houses off the site, as the midnight job does"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=EXPIRY_BATCH_SIZE, help="Payments per transaction")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        expired, taken_down = expire_old_payments(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Expired {expired} payments, took down {taken_down} houses in {time.monotonic() - started:.1f}s"
+        ))
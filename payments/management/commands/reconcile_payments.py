@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from payments.reconcile import reconcile_pending_payments
+
+
+class Command(BaseCommand):
+    help = "Ask Daraja about payments still pending after MPESA_RECONCILE_AFTER_MINUTES and settle them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help="Minutes a payment must have been pending")
+        parser.add_argument('--workers', type=int, help="Concurrent STK queries")
+
+    def handle(self, *args, **options):
+        counts = reconcile_pending_payments(options['older_than'], options['workers'])
+        self.stdout.write(self.style.SUCCESS(
+            "Checked {checked}: {paid} paid, {failed} failed, {still_pending} still pending, {errors} errors".format(**counts)
+        ))
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0011_house_house_public_date_idx_and_more'),
+        ('payments', '0002_payment_expiry_date_alter_payment_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', '-created_at'], name='payment_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['payment_date'], name='payment_verified_date_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0019_term_position'),
+        ('payments', '0005_pending_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'processing')), fields=['created_at'], name='payment_processing_created_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:38
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_dispatched_at(apps, schema_editor):
+    # payments queued before there was a dispatch time count from their creation
+    Payment = apps.get_model('payments', 'Payment')
+    Payment.objects.filter(status='processing').update(dispatched_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('houses', '0019_term_position'),
+        ('payments', '0006_processing_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_processing_created_idx',
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_dispatched_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'processing')), fields=['dispatched_at'], name='payment_dispatched_idx'),
+        ),
+    ]
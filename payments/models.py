@@ -70,6 +70,8 @@ class Payment(models.Model):
     payment_date = models.DateTimeField(null=True, blank=True)
     expiry_date = models.DateTimeField(null=True, blank=True)
     verification_date = models.DateTimeField(null=True, blank=True)
+    # when the STK push was last queued (first send or resend), see payments.dispatch
+    dispatched_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -82,6 +84,19 @@ class Payment(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # payment history
+            models.Index(fields=['user', '-created_at'], name='payment_user_created_idx'),
+            # nightly expiry scan
+            models.Index(fields=['payment_date'], condition=models.Q(is_verified=True), name='payment_verified_date_idx'),
+            # M-Pesa callbacks find their payment by these
+            models.Index(fields=['checkout_request_id'], name='payment_checkout_idx'),
+            models.Index(fields=['merchant_request_id'], name='payment_merchant_idx'),
+            # reconciliation of payments whose callback never came
+            models.Index(fields=['created_at'], condition=models.Q(status='pending'), name='payment_pending_created_idx'),
+            # payments whose STK push was lost before it was sent
+            models.Index(fields=['dispatched_at'], condition=models.Q(status='processing'), name='payment_dispatched_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - KES {self.amount} - {self.get_status_display()}"
@@ -112,6 +127,8 @@ class PaymentTransaction(models.Model):
     request_data = models.JSONField()
     response_data = models.JSONField()
     status_code = models.IntegerField()
+    # one per callback (the CheckoutRequestID), so a redelivered callback can't be applied twice
+    dedupe_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
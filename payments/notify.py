@@ -0,0 +1,65 @@
+"""
+Wake-ups for browsers waiting on a payment.
+
+The processing page long-polls wait_payment_status, which holds the request
+until the payment's status changes. Whatever changes it - the M-Pesa callback,
+the STK dispatch, a cancel - calls payment_changed(), which wakes the requests
+waiting on that payment in this process once the transaction commits. Waiters
+in other worker processes don't hear it, so they also re-read the payment
+every RECHECK_SECONDS.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+
+RECHECK_SECONDS = 5
+
+
+class PaymentChannel:
+    def __init__(self):
+        self._condition = threading.Condition()
+        # payment id -> [version, number of listeners]
+        self._payments = {}
+
+    def notify(self, payment_id):
+        with self._condition:
+            entry = self._payments.get(payment_id)
+            if entry:
+                entry[0] += 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def listen(self, payment_id):
+        """ Listen before reading the payment, so a change in between isn't missed """
+        with self._condition:
+            entry = self._payments.setdefault(payment_id, [0, 0])
+            entry[1] += 1
+        try:
+            yield _Listener(self, entry)
+        finally:
+            with self._condition:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._payments[payment_id]
+
+
+class _Listener:
+    def __init__(self, channel, entry):
+        self.channel = channel
+        self.entry = entry
+        self.seen = entry[0]
+
+    def wait(self, timeout):
+        """ True if the payment was changed since the last wait, within timeout seconds """
+        with self.channel._condition:
+            changed = self.channel._condition.wait_for(lambda: self.entry[0] != self.seen, timeout)
+            self.seen = self.entry[0]
+        return changed
+
+
+channel = PaymentChannel()
+
+
+def payment_changed(payment_id):
+    transaction.on_commit(lambda: channel.notify(payment_id))
@@ -0,0 +1,116 @@
+"""
+Reconciliation of payments whose M-Pesa callback never came.
+
+Every payment still 'pending' MPESA_RECONCILE_AFTER_MINUTES after it was
+created is looked up with Daraja's STK push query. The queries run on a
+bounded thread pool (MPESA_RECONCILE_WORKERS); the answers are turned into
+the callback Safaricom would have sent and go through apply_stk_callback in
+this thread, so a late callback and the query can't both count.
+
+Payments Safaricom is still working on are left for the next run, until they
+are MPESA_RECONCILE_GIVE_UP_HOURS old: then they are failed like those Daraja
+turns down outright (e.g. an unknown CheckoutRequestID). A real callback
+arriving after any of this still wins, see payments.callbacks.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from payments.callbacks import apply_stk_callback
+from payments.models import Payment
+from payments.utils import get_mpesa_access_token, query_stk_status
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+
+# errorCodes about the request itself (400.002.02 "Invalid CheckoutRequestID"): asking again won't help
+FINAL_ERROR_PREFIX = '400.'
+# ResultCode recorded for payments failed without one from M-Pesa
+NO_RESULT_CODE = -1
+
+
+def as_callback(answer):
+    """ The stkCallback body for an STK query answer, None while it's undecided """
+    result_code = answer.get('ResultCode')
+    result_desc = answer.get('ResultDesc', '')
+    if result_code in (None, ''):
+        error_code = str(answer.get('errorCode', ''))
+        if not error_code.startswith(FINAL_ERROR_PREFIX):
+            # e.g. 500.001.1001, "The transaction is being processed", or an expired token
+            return None
+        result_code = NO_RESULT_CODE
+        result_desc = answer.get('errorMessage') or error_code
+    return {'Body': {'stkCallback': {
+        'MerchantRequestID': answer.get('MerchantRequestID'),
+        'CheckoutRequestID': answer.get('CheckoutRequestID'),
+        'ResultCode': int(result_code),
+        'ResultDesc': result_desc,
+    }}}
+
+
+def given_up(hours):
+    return {'Body': {'stkCallback': {
+        'ResultCode': NO_RESULT_CODE,
+        'ResultDesc': f"No result from M-Pesa after {hours} hours",
+    }}}
+
+
+def _query(checkout_request_id):
+    try:
+        return query_stk_status(checkout_request_id)
+    except Exception as e:
+        logger.warning("STK query for %s failed: %s", checkout_request_id, e)
+        return None
+
+
+def reconcile_pending_payments(older_than_minutes=None, workers=None, batch_size=BATCH_SIZE):
+    """ Query and settle stuck pending payments, returns counts of what happened """
+    if older_than_minutes is None:
+        older_than_minutes = settings.MPESA_RECONCILE_AFTER_MINUTES
+    workers = workers or settings.MPESA_RECONCILE_WORKERS
+    cutoff = timezone.now() - timedelta(minutes=older_than_minutes)
+    give_up_hours = settings.MPESA_RECONCILE_GIVE_UP_HOURS
+    give_up_before = timezone.now() - timedelta(hours=give_up_hours)
+
+    # a few thousand (checkout id, created) pairs at most, read through the partial index in one go
+    stuck = list(
+        Payment.objects.filter(status='pending', created_at__lt=cutoff)
+        .exclude(checkout_request_id='')
+        .order_by()
+        .values_list('checkout_request_id', 'created_at')
+    )
+    counts = {'checked': 0, 'paid': 0, 'failed': 0, 'still_pending': 0, 'errors': 0}
+    if not stuck:
+        return counts
+    started = time.monotonic()
+
+    # one token for the whole run, not a refresh race between the workers
+    try:
+        get_mpesa_access_token()
+    except Exception as e:
+        # the queries fail too, but payments past the give-up age are still settled
+        logger.warning("No Daraja token for reconciliation: %s", e)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stk-reconcile') as pool:
+        for start in range(0, len(stuck), batch_size):
+            batch = stuck[start:start + batch_size]
+            answers = pool.map(_query, [checkout_id for checkout_id, _ in batch])
+            for (checkout_id, created_at), answer in zip(batch, answers):
+                counts['checked'] += 1
+                callback = as_callback(answer) if answer is not None else None
+                if callback is None:
+                    if created_at >= give_up_before:
+                        counts['errors' if answer is None else 'still_pending'] += 1
+                        continue
+                    callback = given_up(give_up_hours)
+                callback['Body']['stkCallback']['CheckoutRequestID'] = checkout_id
+                apply_stk_callback(callback, request_type='STK_QUERY')
+                counts['paid' if callback['Body']['stkCallback']['ResultCode'] == 0 else 'failed'] += 1
+
+    logger.info("Reconciled pending payments in %.1fs: %s", time.monotonic() - started, counts)
+    return counts
@@ -1,30 +1,120 @@
 import datetime
+import logging
+import os
+import tempfile
+import time
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from apscheduler.schedulers.background import BackgroundScheduler
 from pytz import timezone as pytz_timezone
+from houses import mapgrid
+from houses.activity import compact_activity
+from houses.caching import bump_feed_version
+from houses.models import House
+from payments.dispatch import fail_stale_dispatches
 from payments.models import Payment
+from payments.reconcile import reconcile_pending_payments
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def expire_old_payments():
-    """ Expire payments older than 1.5 years. """
+logger = logging.getLogger(__name__)
+
+_lock_file = None
+
+EXPIRY_BATCH_SIZE = 500
+
+
+def expire_old_payments(batch_size=EXPIRY_BATCH_SIZE):
+    """
+    Expire payments older than 1.5 years and take their houses down, batch_size
+    payments per transaction. Returns (payments expired, houses taken down).
+    """
     cutoff_date = timezone.now() - datetime.timedelta(days=547) # 1.5 years
-    expired_payments = Payment.objects.filter(is_verified = True, payment_date__lte=cutoff_date)
+    started = time.monotonic()
+
+    expired = taken_down = 0
+    while True:
+        with transaction.atomic():
+            batch_expired, batch_taken_down = _expire_batch(cutoff_date, batch_size)
+        if not batch_expired:
+            break
+        expired += batch_expired
+        taken_down += batch_taken_down
+
+    if expired:
+        logger.info("Expired %s payments and took down %s houses in %.1fs",
+                    expired, taken_down, time.monotonic() - started)
+    return expired, taken_down
+
+
+def _expire_batch(cutoff_date, batch_size):
+    # expired payments drop out of payment_verified_date_idx, so every batch starts at its front
+    rows = list(
+        Payment.objects.select_for_update()
+        .filter(is_verified=True, payment_date__lte=cutoff_date)
+        .order_by()
+        .values_list('id', 'house_id')[:batch_size]
+    )
+    if not rows:
+        return 0, 0
+    now = timezone.now()
+    Payment.objects.filter(id__in=[payment_id for payment_id, _ in rows]).update(
+        status='unpaid', is_verified=False, updated_at=now
+    )
+
+    houses = House.objects.filter(id__in={house_id for _, house_id in rows if house_id})
+    # update() skips the House signals, so do their map grid and page cache work here
+    visible = list(houses.filter(is_active=True, payment_status='paid').order_by().values_list('geohash', 'latitude', 'longitude'))
+    taken_down = houses.exclude(is_active=False, payment_status='unpaid').update(
+        is_active=False, payment_status='unpaid', updated_at=now
+    )
+    mapgrid.remove([(geohash, float(latitude), float(longitude)) for geohash, latitude, longitude in visible if geohash])
+    if visible:
+        transaction.on_commit(bump_feed_version)
+    return len(rows), taken_down
+
+
+def _claim_scheduler():
+    """
+    True for the one process on this host that runs the jobs.
 
+    Every gunicorn worker loads the app and would otherwise run its own copy of
+    every job - N reconciliations querying Daraja at once. The first process to
+    flock SCHEDULER_LOCK_PATH keeps it until it exits, the others skip start().
+    """
+    global _lock_file
+    if fcntl is None:
+        return True
+    path = getattr(settings, 'SCHEDULER_LOCK_PATH', None) or os.path.join(
+        tempfile.gettempdir(), 'nyumbafinder-scheduler.lock'
+    )
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _lock_file = lock_file
+    return True
 
-    for payment in expired_payments:
-        payment.status = 'unpaid'
-        payment.is_verified = False
-        if payment.house:
-            payment.house.is_active = False
-            payment.house.payment_status = 'unpaid'
-            payment.house.save()
-        payment.save()
-        print(f"Expired payment {payment.id} for user {payment.user.username}")
 
 def start():
+    # with several hosts, SCHEDULER_ENABLED stays on for exactly one of them
+    if not getattr(settings, 'SCHEDULER_ENABLED', True) or not _claim_scheduler():
+        return
     scheduler = BackgroundScheduler()
     # run daily at midnight
     scheduler.add_job(expire_old_payments, 'cron', hour=0,minute=0, timezone=pytz_timezone('Africa/Nairobi'))
     # scheduler.add_job(expire_old_payments, 'interval', minutes=0.5, timezone=pytz_timezone('Africa/Nairobi'))
+    # roll up old activity once the payments have been dealt with
+    scheduler.add_job(compact_activity, 'cron', hour=1, minute=0, timezone=pytz_timezone('Africa/Nairobi'))
+    # settle pending payments whose M-Pesa callback never arrived
+    scheduler.add_job(reconcile_pending_payments, 'interval', minutes=10, max_instances=1, coalesce=True)
+    # fail payments whose queued STK push was lost to a restart
+    scheduler.add_job(fail_stale_dispatches, 'interval', minutes=5, max_instances=1, coalesce=True)
     scheduler.start()
 
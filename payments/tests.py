@@ -1,3 +1,560 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from urllib3.exceptions import NewConnectionError
+
+from houses import mapgrid
+from houses.caching import feed_version
+from houses.models import House, MapGridCell
+from payments import notify, utils
+from payments.management.commands.bench_mpesa_callbacks import callback_body
+from payments.daraja import DarajaClient, DarajaError
+from payments.dispatch import fail_stale_dispatches, send_stk_push
+from payments.models import Payment, PaymentTransaction
+from payments.reconcile import reconcile_pending_payments
+from payments import scheduler
+from payments.scheduler import expire_old_payments
+from payments.tokens import AccessTokenCache
+from payments.utils import fetch_mpesa_access_token
+
+
+class DarajaStub(BaseHTTPRequestHandler):
+    """ Local stand-in for the Daraja endpoints the app calls """
+    hits = {}
+    delay = 0
+    fail_oauth = False
+    # status codes the next STK pushes answer with, then 200
+    push_statuses = []
+    # CheckoutRequestID -> ResultCode the STK query reports (an errorCode if a string),
+    # unknown ones are still processing
+    query_results = {}
+    connections = set()
+
+    @classmethod
+    def reset(cls):
+        cls.hits = {}
+        cls.delay = 0
+        cls.fail_oauth = False
+        cls.push_statuses = []
+        cls.query_results = {}
+        cls.connections = set()
+
+    def do_GET(self):
+        number = self._count()
+        time.sleep(self.delay)
+        if self.path.startswith('/oauth'):
+            if self.fail_oauth:
+                return self._json(500, {'errorMessage': 'Internal Server Error'})
+            return self._json(200, {'access_token': f'token-{number}', 'expires_in': '3599'})
+        self._json(404, {'errorMessage': 'Not found'})
+
+    def do_POST(self):
+        number = self._count()
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path.startswith('/mpesa/stkpushquery'):
+            checkout_id = payload['CheckoutRequestID']
+            if checkout_id not in self.query_results:
+                return self._json(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+            if isinstance(self.query_results[checkout_id], str):
+                return self._json(400, {'errorCode': self.query_results[checkout_id], 'errorMessage': 'Bad Request - Invalid CheckoutRequestID'})
+            return self._json(200, {
+                'ResponseCode': '0',
+                'MerchantRequestID': f'merchant-{checkout_id}',
+                'CheckoutRequestID': checkout_id,
+                'ResultCode': str(self.query_results[checkout_id]),
+                'ResultDesc': 'Request cancelled by user' if self.query_results[checkout_id] else 'The service request is processed successfully.',
+            })
+        if self.path.startswith('/mpesa/stkpush'):
+            status = self.push_statuses.pop(0) if self.push_statuses else 200
+            if status != 200:
+                return self._json(status, {'errorMessage': 'Service unavailable'})
+            return self._json(200, {
+                'MerchantRequestID': f'merchant-{number}',
+                'CheckoutRequestID': f'ws_CO_{number}',
+                'ResponseCode': '0',
+                'CustomerMessage': f"Success. Request accepted for processing {payload['PhoneNumber']}",
+            })
+        self._json(404, {'errorMessage': 'Not found'})
+
+    def _count(self):
+        DarajaStub.connections.add(self.client_address)
+        path = self.path.split('?')[0]
+        DarajaStub.hits[path] = DarajaStub.hits.get(path, 0) + 1
+        return DarajaStub.hits[path]
+
+    protocol_version = 'HTTP/1.1'
+
+    def _json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DarajaStubTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), DarajaStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        DarajaStub.reset()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        settings = override_settings(
+            MPESA_OAUTH_URL=f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials',
+            MPESA_TOKEN_CACHE_PATH=f'{self.tmp}/token.json',
+            MPESA_STK_PUSH_URL=f'{self.base_url}/mpesa/stkpush/v1/processrequest',
+            MPESA_STK_QUERY_URL=f'{self.base_url}/mpesa/stkpushquery/v1/query',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # the token cache file lives in this test's temp dir
+        utils._token_cache = None
+        self.addCleanup(setattr, utils, '_token_cache', None)
+
+
+class AccessTokenCacheTests(DarajaStubTestCase):
+    def test_a_burst_fetches_one_token(self):
+        DarajaStub.delay = 0.2
+        cache = AccessTokenCache(fetch_mpesa_access_token)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(cache.get())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['token-1'] * 10)
+        self.assertEqual(DarajaStub.hits['/oauth/v1/generate'], 1)
+
+        # another worker process reads the same file
+        self.assertEqual(AccessTokenCache(fetch_mpesa_access_token).get(), 'token-1')
+        self.assertEqual(DarajaStub.hits['/oauth/v1/generate'], 1)
+
+    def test_refreshed_before_expiry(self):
+        now = [1000.0]
+        cache = AccessTokenCache(fetch_mpesa_access_token, clock=lambda: now[0])
+        self.assertEqual(cache.get(), 'token-1')
+        now[0] += 3000
+        self.assertEqual(cache.get(), 'token-1')
+        # inside the refresh margin
+        now[0] += 400
+        self.assertEqual(cache.get(), 'token-2')
+
+    def test_failed_refresh_keeps_a_token_that_still_works(self):
+        now = [1000.0]
+        cache = AccessTokenCache(fetch_mpesa_access_token, clock=lambda: now[0])
+        cache.get()
+        DarajaStub.fail_oauth = True
+        now[0] += 3500
+        self.assertEqual(cache.get(), 'token-1')
+        now[0] += 200
+        with self.assertRaises(Exception):
+            cache.get()
+
+
+class DarajaClientTests(DarajaStubTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_ = DarajaClient(backoff=0)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.assertEqual(self.client_.stk_push({'PhoneNumber': '254712345678'}, 'token')[0], 200)
+        self.assertEqual(len(DarajaStub.connections), 1)
+        self.assertEqual(self.client_.stats()['stk_push']['calls'], 5)
+
+    def test_stk_push_is_not_retried(self):
+        DarajaStub.push_statuses = [503]
+        status, data = self.client_.stk_push({'PhoneNumber': '254712345678'}, 'token')
+        self.assertEqual(status, 503)
+        self.assertEqual(DarajaStub.hits['/mpesa/stkpush/v1/processrequest'], 1)
+        self.assertEqual(self.client_.stats()['stk_push']['errors'], 1)
+
+    def test_token_fetch_is_retried(self):
+        DarajaStub.fail_oauth = True
+        with self.assertRaises(DarajaError):
+            self.client_.fetch_access_token()
+        self.assertEqual(DarajaStub.hits['/oauth/v1/generate'], 3)
+        stats = self.client_.stats()['oauth']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (3, 3, 2))
+
+    def test_refused_connections_are_tried_once_per_attempt(self):
+        attempts = []
+
+        def refuse(connection):
+            attempts.append(connection.host)
+            raise NewConnectionError(connection, 'Connection refused')
+
+        with mock.patch('urllib3.connection.HTTPConnection._new_conn', refuse):
+            with self.assertRaises(DarajaError):
+                self.client_.fetch_access_token()
+            self.assertEqual(len(attempts), 3)
+            # nothing reached Safaricom, so even the push may be tried again
+            with self.assertRaises(DarajaError):
+                self.client_.stk_push({'PhoneNumber': '254712345678'}, 'token')
+            self.assertEqual(len(attempts), 6)
+
+
+@override_settings(MPESA_DISPATCH_SYNC=True)
+class StkDispatchTests(DarajaStubTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.house = House.objects.create(
+            title='Cozy bedsitter', house_type='bedsitter', description='Near the stage', location='Rongai',
+            rent=8000, deposit=8000, house_number='A5', owner=self.owner,
+        )
+        self.client.force_login(self.owner)
+
+    def pay(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('process_payment', args=[self.house.id]), {'phone': '0712345678'})
+        return response, Payment.objects.get(), callbacks
+
+    def test_returns_before_the_push_is_sent(self):
+        response, payment, callbacks = self.pay()
+        self.assertRedirects(response, reverse('payment_pending', args=[payment.id]), fetch_redirect_response=False)
+        self.assertEqual(payment.status, 'processing')
+        self.assertEqual(DarajaStub.hits, {})
+        self.assertEqual(self.client.get(reverse('check_payment_status', args=[payment.id])).json()['status'], 'processing')
+
+        for callback in callbacks:
+            callback()
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.checkout_request_id), ('pending', 'ws_CO_1'))
+
+    def test_failed_push_fails_the_payment(self):
+        DarajaStub.push_statuses = [500]
+        _, payment, callbacks = self.pay()
+        for callback in callbacks:
+            callback()
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'failed')
+        self.assertEqual(House.objects.get(id=self.house.id).payment_status, 'unpaid')
+        status = self.client.get(reverse('check_payment_status', args=[payment.id])).json()
+        self.assertEqual(status['redirect_url'], reverse('payment_failed', args=[payment.id]))
+
+    def test_cancelled_before_sending_is_not_pushed(self):
+        _, payment, callbacks = self.pay()
+        self.client.get(reverse('cancel_payment', args=[payment.id]))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(Payment.objects.get().status, 'cancelled')
+        self.assertNotIn('/mpesa/stkpush/v1/processrequest', DarajaStub.hits)
+
+
+class ReconcilePaymentsTests(DarajaStubTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.payments = {}
+        for name in ('paid', 'cancelled', 'processing', 'fresh'):
+            house = House.objects.create(
+                title=f'House {name}', house_type='bedsitter', description='Near the stage', location='Rongai',
+                rent=8000, deposit=8000, house_number=name, owner=self.owner, payment_status='pending',
+            )
+            self.payments[name] = Payment.objects.create(
+                user=self.owner, house=house, amount=1, payment_method='mpesa', status='pending',
+                checkout_request_id=f'ws_CO_{name}',
+            )
+        stuck = timezone.now() - timedelta(minutes=30)
+        Payment.objects.exclude(checkout_request_id='ws_CO_fresh').update(created_at=stuck)
+        DarajaStub.query_results = {'ws_CO_paid': 0, 'ws_CO_cancelled': 1032, 'ws_CO_fresh': 0}
+
+    def status(self, name):
+        payment = Payment.objects.select_related('house').get(id=self.payments[name].id)
+        return payment.status, payment.house.payment_status
+
+    def test_stuck_payments_are_settled(self):
+        counts = reconcile_pending_payments(workers=4)
+
+        self.assertEqual(counts, {'checked': 3, 'paid': 1, 'failed': 1, 'still_pending': 1, 'errors': 0})
+        self.assertEqual(self.status('paid'), ('paid', 'paid'))
+        self.assertEqual(self.status('cancelled'), ('failed', 'unpaid'))
+        self.assertEqual(self.status('processing'), ('pending', 'pending'))
+        # too recent to ask about yet
+        self.assertEqual(self.status('fresh'), ('pending', 'pending'))
+        self.assertEqual(DarajaStub.hits['/mpesa/stkpushquery/v1/query'], 3)
+
+    def test_final_errors_and_old_payments_are_failed(self):
+        DarajaStub.query_results['ws_CO_cancelled'] = '400.002.02'
+        Payment.objects.filter(id=self.payments['processing'].id).update(created_at=timezone.now() - timedelta(hours=30))
+        counts = reconcile_pending_payments(workers=4)
+
+        self.assertEqual(counts, {'checked': 3, 'paid': 1, 'failed': 2, 'still_pending': 0, 'errors': 0})
+        self.assertEqual(self.status('cancelled'), ('failed', 'unpaid'))
+        self.assertEqual(self.status('processing'), ('failed', 'unpaid'))
+        self.assertIn('No result from M-Pesa', Payment.objects.get(id=self.payments['processing'].id).notes)
+
+    def callback(self, name, result_code=0):
+        body = {'CheckoutRequestID': f'ws_CO_{name}', 'ResultCode': result_code, 'ResultDesc': '-'}
+        if result_code == 0:
+            body['CallbackMetadata'] = {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': f'RCPT{name.upper()}'}]}
+        return self.client.post(reverse('mpesa_callback'), {'Body': {'stkCallback': body}}, content_type='application/json')
+
+    def test_late_callback_fills_in_the_receipt(self):
+        reconcile_pending_payments(workers=4)
+        self.assertEqual(self.callback('paid').json()['ResultDesc'], 'Success')
+        self.assertEqual(self.callback('paid').json()['ResultDesc'], 'Already processed')
+        self.assertEqual(self.callback('paid', 1032).json()['ResultDesc'], 'Already processed')
+
+        payment = Payment.objects.get(id=self.payments['paid'].id)
+        self.assertEqual((payment.status, payment.transaction_id), ('paid', 'RCPTPAID'))
+        self.assertEqual(
+            sorted(PaymentTransaction.objects.filter(payment=payment).values_list('request_type', flat=True)),
+            ['STK_PUSH', 'STK_QUERY'],
+        )
+
+    def test_late_success_revives_a_payment_given_up_on(self):
+        Payment.objects.filter(id=self.payments['processing'].id).update(created_at=timezone.now() - timedelta(hours=30))
+        reconcile_pending_payments(workers=4)
+        self.assertEqual(self.status('processing'), ('failed', 'unpaid'))
+
+        self.assertEqual(self.callback('processing').json()['ResultDesc'], 'Success')
+        self.assertEqual(self.status('processing'), ('paid', 'paid'))
+
+
+class ExpireOldPaymentsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        paid_on = {'old': timezone.now() - timedelta(days=600), 'older': timezone.now() - timedelta(days=700),
+                   'recent': timezone.now() - timedelta(days=30)}
+        self.houses = {}
+        for offset, (name, payment_date) in enumerate(paid_on.items()):
+            self.houses[name] = House.objects.create(
+                title=f'House {name}', house_type='bedsitter', description='Near the stage', location='Rongai',
+                rent=8000, deposit=8000, house_number=name, owner=self.owner, is_active=True, payment_status='paid',
+                latitude=f'-1.29{offset}000', longitude='36.822000',
+            )
+            Payment.objects.create(
+                user=self.owner, house=self.houses[name], amount=1, payment_method='mpesa', status='completed',
+                is_verified=True, payment_date=payment_date,
+            )
+
+    def grid(self):
+        return list(MapGridCell.objects.order_by('cell').values_list('cell', 'count'))
+
+    def test_expired_houses_leave_the_site(self):
+        version = feed_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(expire_old_payments(batch_size=1), (2, 2))
+
+        self.assertEqual(Payment.objects.filter(is_verified=True).get().house, self.houses['recent'])
+        self.assertEqual(Payment.objects.filter(status='unpaid', is_verified=False).count(), 2)
+        self.assertEqual(
+            set(House.objects.filter(is_active=True, payment_status='paid').values_list('title', flat=True)),
+            {'House recent'},
+        )
+        self.assertNotEqual(feed_version(), version)
+        # the grid was adjusted without the House signals, it must match a full rebuild
+        adjusted = self.grid()
+        self.assertEqual(adjusted[0], ('k', 1))
+        mapgrid.rebuild()
+        self.assertEqual(adjusted, self.grid())
+
+        self.assertEqual(expire_old_payments(), (0, 0))
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        for number in range(5):
+            house = House.objects.create(
+                title=f'Extra {number}', house_type='bedsitter', description='-', location='Mombasa', rent=1, deposit=1,
+                house_number=str(number), owner=self.owner, is_active=True, payment_status='paid',
+                latitude='-4.043500', longitude=f'39.66{number}000',
+            )
+            Payment.objects.create(user=self.owner, house=house, amount=1, payment_method='mpesa', status='completed',
+                                   is_verified=True, payment_date=timezone.now() - timedelta(days=800))
+        # one batch of select, two updates and the grid, then the empty select that ends it
+        with self.assertNumQueries(14):
+            self.assertEqual(expire_old_payments(), (7, 7))
+
+
+class StaleDispatchTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.payments = []
+        for minutes in (30, 1):
+            house = House.objects.create(
+                title='Cozy bedsitter', house_type='bedsitter', description='Near the stage', location='Rongai',
+                rent=8000, deposit=8000, house_number=str(minutes), owner=self.owner, payment_status='pending',
+            )
+            payment = Payment.objects.create(
+                user=self.owner, house=house, amount=1, payment_method='mpesa', status='processing',
+                dispatched_at=timezone.now() - timedelta(minutes=minutes),
+            )
+            Payment.objects.filter(id=payment.id).update(created_at=timezone.now() - timedelta(minutes=minutes))
+            self.payments.append(payment)
+
+    def test_lost_pushes_are_failed(self):
+        lost, queued = self.payments
+        self.assertEqual(fail_stale_dispatches(), 1)
+
+        lost.refresh_from_db()
+        self.assertEqual(lost.status, 'failed')
+        self.assertEqual(House.objects.get(id=lost.house_id).payment_status, 'unpaid')
+        self.assertEqual(Payment.objects.get(id=queued.id).status, 'processing')
+        self.assertEqual(House.objects.get(id=queued.house_id).payment_status, 'pending')
+        self.assertEqual(fail_stale_dispatches(), 0)
+
+    def test_resent_payment_counts_from_the_resend(self):
+        lost, _ = self.payments
+        fail_stale_dispatches()
+        self.client.force_login(self.owner)
+        with self.captureOnCommitCallbacks():
+            self.assertTrue(self.client.post(reverse('resend_payment_request', args=[lost.id])).json()['success'])
+
+        self.assertEqual(fail_stale_dispatches(), 0)
+        self.assertEqual(Payment.objects.get(id=lost.id).status, 'processing')
+
+    def test_only_open_payments_are_resent(self):
+        lost, queued = self.payments
+        self.client.force_login(self.owner)
+        for status in ['paid', 'cancelled']:
+            Payment.objects.filter(id=lost.id).update(status=status)
+            with self.captureOnCommitCallbacks() as callbacks:
+                data = self.client.post(reverse('resend_payment_request', args=[lost.id])).json()
+            self.assertFalse(data['success'])
+            self.assertEqual(Payment.objects.get(id=lost.id).status, status)
+            self.assertEqual(callbacks, [])
+        self.assertFalse(self.client.post(reverse('resend_payment_request', args=[queued.id])).json()['success'])
+
+    def test_push_sent_after_the_sweep_can_still_be_paid(self):
+        lost, _ = self.payments
+
+        def push_while_swept(*args):
+            fail_stale_dispatches()
+            return {'success': True, 'checkout_request_id': 'bench-checkout-3', 'merchant_request_id': 'bench-merchant-3'}
+
+        with mock.patch('payments.dispatch.initiate_mpesa_stk_push', side_effect=push_while_swept):
+            send_stk_push(lost.id)
+        lost.refresh_from_db()
+        self.assertEqual((lost.status, lost.checkout_request_id), ('failed', 'bench-checkout-3'))
+
+        self.client.post(reverse('mpesa_callback'), callback_body(3), content_type='application/json')
+        self.assertEqual(Payment.objects.get(id=lost.id).status, 'paid')
+        self.assertEqual(House.objects.get(id=lost.house_id).payment_status, 'paid')
+
+
+class SchedulerLockTests(TestCase):
+    def test_one_process_claims_the_jobs(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.addCleanup(setattr, scheduler, '_lock_file', scheduler._lock_file)
+        with override_settings(SCHEDULER_LOCK_PATH=f'{tmp}/scheduler.lock'):
+            self.assertTrue(scheduler._claim_scheduler())
+            claimed = scheduler._lock_file
+            # another worker, as far as flock is concerned
+            self.assertFalse(scheduler._claim_scheduler())
+            claimed.close()
+            self.assertTrue(scheduler._claim_scheduler())
+            scheduler._lock_file.close()
+
+
+class MpesaCallbackTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('landlord', password='pass')
+        self.house = House.objects.create(
+            title='Cozy bedsitter', house_type='bedsitter', description='Near the stage', location='Rongai',
+            rent=8000, deposit=8000, house_number='A5', owner=owner, payment_status='pending',
+        )
+        self.payment = Payment.objects.create(
+            user=owner, house=self.house, amount=1, payment_method='mpesa', status='pending',
+            checkout_request_id='bench-checkout-7', merchant_request_id='bench-merchant-7',
+        )
+
+    def deliver(self, index=7, result_code=0):
+        return self.client.post(reverse('mpesa_callback'), callback_body(index, result_code), content_type='application/json')
+
+    def test_redelivered_success_is_applied_once(self):
+        self.assertEqual(self.deliver().json()['ResultDesc'], 'Success')
+        self.assertEqual(self.deliver().json()['ResultDesc'], 'Already processed')
+
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.transaction_id), ('paid', 'BENCH00000007'))
+        self.assertEqual(PaymentTransaction.objects.filter(payment=self.payment).count(), 1)
+        house = House.objects.get(id=self.house.id)
+        self.assertEqual((house.payment_status, house.is_active), ('paid', True))
+
+    def test_failure_is_recorded_once(self):
+        self.assertEqual(self.deliver(result_code=1032).json()['ResultDesc'], 'Failed logged')
+        self.assertEqual(self.deliver(result_code=1032).json()['ResultDesc'], 'Already processed')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'failed')
+        self.assertEqual(House.objects.get(id=self.house.id).payment_status, 'unpaid')
+
+    def test_unknown_checkout(self):
+        self.assertEqual(self.deliver(index=8).status_code, 404)
+        self.assertFalse(PaymentTransaction.objects.exists())
+
+
+class PaymentChannelTests(TestCase):
+    def test_listener_wakes_on_notify(self):
+        channel = notify.PaymentChannel()
+        with channel.listen(5) as listener:
+            threading.Timer(0.05, channel.notify, [5]).start()
+            started = time.monotonic()
+            self.assertTrue(listener.wait(5))
+            self.assertLess(time.monotonic() - started, 1)
+            # other payments don't wake it
+            channel.notify(6)
+            self.assertFalse(listener.wait(0.05))
+        self.assertEqual(channel._payments, {})
+
+
+class WaitPaymentStatusTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('landlord', password='pass')
+        self.payment = Payment.objects.create(user=self.owner, amount=1, payment_method='mpesa', status='pending')
+        self.client.force_login(self.owner)
+        self.url = reverse('wait_payment_status', args=[self.payment.id])
+
+    def test_answers_at_once_when_the_status_moved_on(self):
+        Payment.objects.filter(id=self.payment.id).update(status='failed')
+        started = time.monotonic()
+        data = self.client.get(self.url, {'status': 'pending'}).json()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(data['redirect_url'], reverse('payment_failed', args=[self.payment.id]))
+
+    @override_settings(PAYMENT_LONG_POLL_SECONDS=0.3)
+    def test_held_until_the_deadline_without_polling(self):
+        started = time.monotonic()
+        with self.assertNumQueries(4):
+            # session, user, the payment and one recheck
+            data = self.client.get(self.url, {'status': 'pending'}).json()
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual((data['status'], data['redirect_url']), ('pending', None))
+
+    def test_callback_notifies_waiters(self):
+        self.payment.checkout_request_id = 'bench-checkout-1'
+        self.payment.save()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('mpesa_callback'), callback_body(1), content_type='application/json')
+        with notify.channel.listen(self.payment.id) as listener:
+            for callback in callbacks:
+                callback()
+            self.assertTrue(listener.wait(0))
@@ -0,0 +1,130 @@
+"""
+Daraja OAuth access token, cached.
+
+A token is good for about an hour, so there's no reason to fetch one per STK
+push. AccessTokenCache keeps it in memory and in a small JSON file that every
+gunicorn worker on the machine reads, and refreshes it REFRESH_MARGIN seconds
+before it runs out.
+
+Refreshes are single-flight: a thread lock inside the process and an flock on
+a lock file across processes, and whoever gets the lock second finds the fresh
+token in the file instead of asking Safaricom again. If the refresh itself
+fails, a token that hasn't actually expired yet is still handed out.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, the thread lock has to do there
+    fcntl = None
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+REFRESH_MARGIN = 5 * 60
+# when Daraja doesn't say
+DEFAULT_EXPIRES_IN = 3599
+
+
+def default_cache_path():
+    return getattr(settings, 'MPESA_TOKEN_CACHE_PATH', None) or os.path.join(
+        tempfile.gettempdir(), 'nyumbafinder-mpesa-token.json'
+    )
+
+
+class AccessTokenCache:
+    def __init__(self, fetch, path=None, refresh_margin=REFRESH_MARGIN, clock=time.time):
+        """ fetch() returns (token, expires_in seconds) straight from the OAuth endpoint """
+        self.fetch = fetch
+        self.path = path or default_cache_path()
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self._token = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        token = self._fresh(self._token) or self._fresh(self._read())
+        if token:
+            return token
+        with self._lock, self._file_lock():
+            # someone may have refreshed while we waited for the lock
+            cached = self._read()
+            token = self._fresh(cached)
+            if token:
+                return token
+            try:
+                token, expires_in = self.fetch()
+            except Exception:
+                if cached and cached['expires_at'] > self.clock():
+                    logger.warning("Access token refresh failed, using the current one until it expires")
+                    return cached['token']
+                raise
+            self._write({'token': token, 'expires_at': self.clock() + int(expires_in or DEFAULT_EXPIRES_IN)})
+            return token
+
+    def invalidate(self):
+        """ Forget the token, e.g. after Daraja rejected it """
+        with self._lock:
+            self._token = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _fresh(self, cached):
+        if cached and cached['expires_at'] - self.refresh_margin > self.clock():
+            self._token = cached
+            return cached['token']
+        return None
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            return cached if {'token', 'expires_at'} <= cached.keys() else None
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _write(self, cached):
+        self._token = cached
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.mpesa-token-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cached, f)
+            os.chmod(tmp, 0o600)
+            # readers never see a half written file
+            os.replace(tmp, self.path)
+        except OSError:
+            logger.exception("Could not write the access token cache %s", self.path)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _file_lock(self):
+        return _FileLock(self.path + '.lock')
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -9,6 +9,7 @@ urlpatterns = [
     # Payment status and management
     # path('payment/status/<int:payment_id>/', views.payment_status, name='payment_status'),
     path('payment/check/<int:payment_id>/', views.check_payment_status, name='check_payment_status'),
+    path('payment/wait/<int:payment_id>/', views.wait_payment_status, name='wait_payment_status'),
     path('payment/resend/<int:payment_id>/', views.resend_payment_request, name='resend_payment_request'),
     path('payment/cancel/<int:payment_id>/', views.cancel_payment, name='cancel_payment'),
     
@@ -27,5 +28,6 @@ urlpatterns = [
     
     # Admin/management
     path('payment/verify-payment/', views.verify_payment_manual, name='verify_payment_manual'),
+    path('payment/daraja-stats/', views.daraja_stats, name='daraja_stats'),
     # path('payment/refund/<int:payment_id>/', views.request_refund, name='request_refund'),
 ]
\ No newline at end of file
@@ -1,10 +1,12 @@
 # payments/utils.py
-import requests
 import base64
 from datetime import datetime
 from django.conf import settings
 import logging
 
+from payments.daraja import get_daraja_client
+from payments.tokens import AccessTokenCache
+
 logger = logging.getLogger(__name__)
 
 def format_phone(phone):
@@ -35,6 +37,14 @@ def format_phone(phone):
 
     raise ValueError(f"Invalid phone number format: {phone}")
 
+def stk_password():
+    """(timestamp, password) for an STK request."""
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    password = base64.b64encode(
+        f"{settings.MPESA_BUSINESS_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}".encode()
+    ).decode()
+    return timestamp, password
+
 def initiate_mpesa_stk_push(phone_number, amount, payment_id, house_id):
     """Send MPesa STK Push request."""
 
@@ -43,10 +53,7 @@ def initiate_mpesa_stk_push(phone_number, amount, payment_id, house_id):
         phone = format_phone(phone_number)
 
         # Timestamp + password
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        password = base64.b64encode(
-            f"{settings.MPESA_BUSINESS_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}".encode()
-        ).decode()
+        timestamp, password = stk_password()
 
         # TEST MODE: Always use amount = 1
         final_amount =  float(amount)
@@ -69,25 +76,9 @@ def initiate_mpesa_stk_push(phone_number, amount, payment_id, house_id):
 
         access_token = get_mpesa_access_token()
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-
-        response = requests.post(
-            settings.MPESA_STK_PUSH_URL,
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
+        status_code, data = get_daraja_client().stk_push(payload, access_token)
 
-        print(f" Responce in utils : {response} ")
-
-        data = response.json()
-
-        print(f" Data in utils : {data} ")
-
-        if response.status_code == 200 and "CheckoutRequestID" in data:
+        if status_code == 200 and "CheckoutRequestID" in data:
             logger.info(f"STK PUSH SUCCESS {payment_id}: {data}")
 
             return {
@@ -98,6 +89,10 @@ def initiate_mpesa_stk_push(phone_number, amount, payment_id, house_id):
                 "raw_response": data
             }
 
+        if status_code == 401:
+            # token revoked or expired early, the next push gets a new one
+            get_token_cache().invalidate()
+
         # API returned error (not HTTP error)
         logger.error(f"STK PUSH FAILURE {payment_id}: {data}")
         return {
@@ -110,29 +105,39 @@ def initiate_mpesa_stk_push(phone_number, amount, payment_id, house_id):
         logger.error(f"STK PUSH EXCEPTION {payment_id}: {str(e)}")
         return {"success": False, "error": str(e)}
 
-def get_mpesa_access_token():
-    """Get M-Pesa OAuth token."""
+def query_stk_status(checkout_request_id):
+    """Ask Daraja what became of an STK push, returns its JSON answer."""
+    timestamp, password = stk_password()
+    payload = {
+        "BusinessShortCode": settings.MPESA_BUSINESS_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id,
+    }
+    status_code, data = get_daraja_client().stk_query(payload, get_mpesa_access_token())
+    if status_code == 401:
+        get_token_cache().invalidate()
+    return data
+
+def fetch_mpesa_access_token():
+    """Ask Daraja for a new OAuth token, returns (token, expires_in)."""
     try:
-        auth = base64.b64encode(
-            f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}".encode()
-        ).decode()
-
-        headers = {"Authorization": f"Basic {auth}"}
+        return get_daraja_client().fetch_access_token()
+    except Exception as e:
+        logger.error(f"Access token exception: {str(e)}")
+        raise
 
-        response = requests.get(settings.MPESA_OAUTH_URL, headers=headers, timeout=10)
 
-        data = response.json()
+_token_cache = None
 
-        if response.status_code != 200:
-            logger.error(f"OAuth token failure: {data}")
-            raise Exception(data.get("errorMessage", "Failed to obtain token"))
 
-        token = data.get("access_token")
-        if not token:
-            raise Exception("Access token missing in response")
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = AccessTokenCache(fetch_mpesa_access_token)
+    return _token_cache
 
-        return token
 
-    except Exception as e:
-        logger.error(f"Access token exception: {str(e)}")
-        raise
\ No newline at end of file
+def get_mpesa_access_token():
+    """Get M-Pesa OAuth token, from the shared cache while it's fresh."""
+    return get_token_cache().get()
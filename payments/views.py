@@ -6,11 +6,28 @@ from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse, HttpResponse
 from django.urls import reverse
 import json
+import logging
+import time
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
 from houses.models import House
-from payments.models import Payment, PaymentTransaction
-from payments.utils import format_phone, initiate_mpesa_stk_push
+from payments import notify
+from payments.callbacks import apply_stk_callback
+from payments.daraja import get_daraja_client
+from payments.dispatch import schedule_stk_push
+from payments.models import Payment
+from payments.utils import format_phone
+
+logger = logging.getLogger(__name__)
+
+# what the processing page shows while it waits
+STATUS_MESSAGES = {
+    'processing': "Sending the payment request to your phone...",
+    'pending': "Waiting for you to enter your M-Pesa PIN...",
+    'failed': "The payment request could not be completed.",
+}
 
 @login_required
 def initiate_payment(request, house_id):
@@ -20,7 +37,7 @@ def initiate_payment(request, house_id):
     # Check if house already has active payment
     if house.payment_status == 'paid':
         messages.info(request, "This house been paid for and active.")
-        return redirect('house_detail', house_id=house.id)
+        return redirect('house_detail', id=house.id)
     
     return render(request, 'payments/initiate_payment.html', {'house': house,'amount': settings.AMOUNT_TO_PAY_PER_HOUSE})
 
@@ -44,43 +61,33 @@ def process_payment(request, house_id):
     
     amount = float(settings.AMOUNT_TO_PAY_PER_HOUSE)
 
-    # Create payment record
-    payment = Payment.objects.create(
-        user=request.user,
-        amount=amount,
-        payment_method=method,
-        phone_number=phone,
-        house=house,
-        status='pending'
-    )
-    
-    # Update house status
-    house.payment_status = 'pending'
-    house.save()
-    
-    # For M-Pesa STK Push
-    if method == 'mpesa':
-        result = initiate_mpesa_stk_push(phone, str(amount), payment.id, house.id)
-        
-        if result['success']:
-            # Save checkout request ID
-            payment.checkout_request_id = result.get('checkout_request_id')
-            payment.merchant_request_id = result.get('merchant_request_id')
-            payment.save()
-            
-            request.session['amount'] = amount
-            messages.success(request, "Payment request sent! Check your phone.")
-            return redirect('payment_pending', payment_id=payment.id)
-        else:
-            messages.error(request, f"Payment failed: {result.get('error')}")
-            payment.delete()
-            return redirect('initiate_payment', house_id=house_id)
-    
     # For other methods (implement as needed)
-    else:
+    if method != 'mpesa':
         messages.warning(request, "This payment method is coming soon.")
         return redirect('initiate_payment', house_id=house_id)
 
+    with transaction.atomic():
+        # Create payment record, the STK push goes out in the background
+        payment = Payment.objects.create(
+            user=request.user,
+            amount=amount,
+            payment_method=method,
+            phone_number=phone,
+            house=house,
+            status='processing',
+            dispatched_at=timezone.now(),
+        )
+
+        # Update house status
+        house.payment_status = 'pending'
+        house.save()
+
+        schedule_stk_push(payment.id)
+
+    request.session['amount'] = amount
+    messages.success(request, "Sending the payment request to your phone...")
+    return redirect('payment_pending', payment_id=payment.id)
+
 @login_required
 def payment_pending(request, payment_id):
     """Show pending payment page"""
@@ -118,79 +125,90 @@ def payment_failed(request, payment_id):
         'amount': settings.AMOUNT_TO_PAY_PER_HOUSE
     })
 
-@login_required
-def check_payment_status(request, payment_id):
-    """AJAX endpoint to check payment status"""
-    payment = get_object_or_404(Payment, id=payment_id, user=request.user)
-
-    print("DEBUG PAYMENT:")
-    print("  ID =", payment.id)
-    print("  status =", payment.status)
-    print("  is_verified =", payment.is_verified)
-    print("  payment_date =", payment.payment_date)
-    print("  house =", payment.house)
-    print("  raw_response =", payment.raw_response)
-
-    # print(f"status : {payment.status}  is_vefiried : {payment.is_verified} mpesa_code : {payment.mpesa_code}")
-    
-    # return JsonResponse({
-    #     'status': payment.status,
-    #     'is_verified': payment.is_verified,
-    #     'mpesa_code': payment.latest_mpesa_code(),
-    #     'redirect_url': reverse('payment_success', args=[payment_id]) if payment.status == 'paid' else None
-    # })
+def _status_response(payment):
     redirect_url = None
     if payment.status in ['paid', 'completed']:
-        redirect_url = reverse('payment_success', args=[payment_id])
+        redirect_url = reverse('payment_success', args=[payment.id])
     elif payment.status == 'failed':
-        redirect_url = reverse('payment_failed', args=[payment_id])
-
-    print(f"REDICT URL : {redirect_url}")
+        redirect_url = reverse('payment_failed', args=[payment.id])
 
     return JsonResponse({
         'status': payment.status,
         'is_verified': payment.is_verified,
+        'message': STATUS_MESSAGES.get(payment.status, ''),
         'redirect_url': redirect_url,
     })
 
+@login_required
+def check_payment_status(request, payment_id):
+    """AJAX endpoint to check payment status"""
+    payment = get_object_or_404(Payment.objects.only('id', 'user_id', 'status', 'is_verified'), id=payment_id, user=request.user)
+    return _status_response(payment)
+
+@login_required
+def wait_payment_status(request, payment_id):
+    """
+    Long poll: answers as soon as the payment's status differs from ?status=,
+    or after PAYMENT_LONG_POLL_SECONDS with the unchanged status.
+    """
+    known_status = request.GET.get('status')
+    deadline = time.monotonic() + settings.PAYMENT_LONG_POLL_SECONDS
+
+    with notify.channel.listen(payment_id) as listener:
+        payment = get_object_or_404(
+            Payment.objects.only('id', 'user_id', 'status', 'is_verified'), id=payment_id, user=request.user
+        )
+        while payment.status == known_status:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            listener.wait(min(notify.RECHECK_SECONDS, remaining))
+            payment.refresh_from_db(fields=['status', 'is_verified'])
+
+    return _status_response(payment)
+
+# a cancelled payment stays cancelled, a processing one is already on its way
+RESENDABLE_STATUSES = ['pending', 'failed', 'unpaid']
+
+
 @login_required
 def resend_payment_request(request, payment_id):
     """Resend payment request"""
     payment = get_object_or_404(Payment, id=payment_id, user=request.user)
     
-    if payment.status == 'paid':
-        return JsonResponse({'success': False, 'error': 'Payment already completed'})
-    
-    # Resend M-Pesa request
-    result = initiate_mpesa_stk_push(
-        payment.phone_number,
-        float(payment.amount),
-        payment.id,
-        payment.house.id
+    # one conditional write, so a callback completing it meanwhile can't be overwritten
+    resent = Payment.objects.filter(id=payment.id, status__in=RESENDABLE_STATUSES).update(
+        status='processing', dispatched_at=timezone.now()
     )
-    
-    if result['success']:
-        payment.checkout_request_id = result.get('checkout_request_id')
-        payment.merchant_request_id = result.get('merchant_request_id')
-        payment.save()
-        
-        return JsonResponse({'success': True, 'message': 'Payment request resent'})
-    else:
-        return JsonResponse({'success': False, 'error': result.get('error')})
+    if not resent:
+        payment.refresh_from_db(fields=['status'])
+        if payment.status in ['paid', 'completed']:
+            return JsonResponse({'success': False, 'error': 'Payment already completed'})
+        return JsonResponse({'success': False, 'error': 'This payment can no longer be resent'})
+
+    # Resend M-Pesa request, in the background like the first one
+    notify.payment_changed(payment.id)
+    if payment.house and payment.house.payment_status == 'unpaid':
+        payment.house.payment_status = 'pending'
+        payment.house.save()
+    schedule_stk_push(payment.id)
+
+    return JsonResponse({'success': True, 'message': 'Payment request resent'})
 
 @login_required
 def cancel_payment(request, payment_id):
     """Cancel pending payment"""
     payment = get_object_or_404(Payment, id=payment_id, user=request.user)
     
-    if payment.status == 'pending':
+    if payment.status in ['pending', 'processing']:
         payment.status = 'cancelled'
         payment.house.payment_status = 'unpaid'
         payment.house.save()
         payment.save()
+        notify.payment_changed(payment.id)
         
         messages.info(request, "Payment cancelled.")
-        return redirect('house_detail', house_id=payment.house.id)
+        return redirect('house_detail', id=payment.house.id)
     
     messages.warning(request, "Cannot cancel this payment.")
     return redirect('payment_pending', payment_id=payment_id)
@@ -232,66 +250,12 @@ def mpesa_callback(request):
 
     try:
         data = json.loads(request.body)
-        callback = data.get('Body', {}).get('stkCallback', {})
-
-        result_code = callback.get('ResultCode')
-        result_desc = callback.get('ResultDesc')
-        checkout_id = callback.get('CheckoutRequestID')
-
-        # Find payment
-        payment = Payment.objects.filter(checkout_request_id=checkout_id).first()
-        if not payment:
-            return JsonResponse({
-                "ResultCode": 1,
-                "ResultDesc": "Payment not found"
-            }, status=404)
-
-        if result_code == 0:
-            # Payment successful
-            items = callback.get("CallbackMetadata", {}).get("Item", [])
-            metadata = {item["Name"]: item.get("Value") for item in items}
-
-            transaction_id = metadata.get("MpesaReceiptNumber")
-            phone = metadata.get("PhoneNumber")
-            amount = metadata.get("Amount")
-
-            # Update payment
-            payment.transaction_id = transaction_id
-            payment.phone_number = phone or payment.phone_number
-            payment.amount = amount or payment.amount
-            payment.raw_response = data
-            payment.mark_as_completed(transaction_id)
-
-            # Update house
-            if payment.house:
-                payment.house.payment_status = "paid"
-                payment.house.is_active = True
-                payment.house.save()
-
-            PaymentTransaction.objects.create(
-                payment=payment,
-                request_type="STK_PUSH",
-                request_data={},  # any request data you want to log
-                response_data=data,  # full callback
-                status_code=result_code
-            )
-
-            return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
-
-        else:
-            # Payment failed
-            payment.status = 'failed'
-            payment.notes = result_desc
-            payment.save()
-
-            if payment.house:
-                payment.house.payment_status = 'unpaid'
-                payment.house.save()
-
-            return JsonResponse({"ResultCode": 0, "ResultDesc": "Failed logged"})
-
-    except Exception as e:
-        print(f"Callback error: {e}")
+        # indexed lookup, row lock and dedupe - a redelivered callback is applied once
+        status, body = apply_stk_callback(data)
+        return JsonResponse(body, status=status)
+
+    except Exception:
+        logger.exception("M-Pesa callback error")
         return JsonResponse({
             "ResultCode": 1,
             "ResultDesc": "Internal error"
@@ -337,3 +301,10 @@ def verify_payment_manual(request):
     return render(request, 'payments/admin_verify.html', {
         'pending_payments': pending_payments
     })
+
+@login_required
+def daraja_stats(request):
+    """Daraja call / error / latency counters for this worker (staff)"""
+    if not request.user.is_staff:
+        return redirect('dashboard')
+    return JsonResponse({'daraja': get_daraja_client().stats()})
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from reviews.stats import rebuild_review_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute review count, average rating and star histogram on every house"
+
+    def handle(self, *args, **options):
+        houses = rebuild_review_stats()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt review statistics for {houses} houses"))
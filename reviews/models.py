@@ -18,7 +18,19 @@ class Review(models.Model):
     def __str__(self):
         return f"{self.name} - {self.rating} - {self.house.title}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # what the house statistics counted this review as
+        if {'house_id', 'rating'}.issubset(field_names):
+            instance._loaded_rating = (instance.house_id, instance.rating)
+        return instance
+
     class Meta:
         verbose_name = "Review"
         verbose_name_plural = "Reviews"
         ordering = ['-created_at']
+        indexes = [
+            # reviews of one house newest first, for the detail page, load more and its ETag
+            models.Index(fields=['house', '-created_at', '-id'], name='review_house_created_idx'),
+        ]
@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from reviews.models import Review
+from reviews.stats import apply_review
+
+
+@receiver(post_save, sender=Review)
+def count_review(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    before = None if created else getattr(instance, '_loaded_rating', None)
+    after = (instance.house_id, instance.rating)
+    if before == after:
+        return
+    # an edited review (admin) is moved from its old rating to the new one
+    if before is not None:
+        apply_review(*before, -1)
+    apply_review(*after, 1)
+    instance._loaded_rating = after
+
+
+@receiver(post_delete, sender=Review)
+def uncount_review(sender, instance, **kwargs):
+    house_id, rating = getattr(instance, '_loaded_rating', None) or (instance.house_id, instance.rating)
+    apply_review(house_id, rating, -1)
@@ -0,0 +1,40 @@
+"""
+Review statistics stored on House (review_count, rating_sum, rating_N_count).
+
+Reviews adjust the counters in place with F() updates, so concurrent reviews
+can't lose each other's increments. rebuild_review_stats() recomputes every
+house from the reviews table.
+"""
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from houses.caching import bump_feed_version
+from houses.models import House
+
+
+def apply_review(house_id, rating, delta):
+    """ Count (delta=1) or uncount (delta=-1) one review on its house """
+    House.objects.filter(id=house_id).update(
+        review_count=F('review_count') + delta,
+        rating_sum=F('rating_sum') + delta * rating,
+        **{f'rating_{rating}_count': F(f'rating_{rating}_count') + delta}
+    )
+    # ratings are shown on the listing cards
+    bump_feed_version()
+
+
+def rebuild_review_stats():
+    """ Recompute the statistics of every house in one UPDATE, returns the number of houses """
+    from reviews.models import Review
+
+    def per_house(aggregate):
+        rows = Review.objects.filter(house=OuterRef('pk')).order_by().values('house').annotate(value=aggregate)
+        return Coalesce(Subquery(rows.values('value')), Value(0), output_field=IntegerField())
+
+    updated = House.objects.update(
+        review_count=per_house(Count('id')),
+        rating_sum=per_house(Sum('rating')),
+        **{f'rating_{stars}_count': per_house(Count('id', filter=Q(rating=stars))) for stars in range(1, 6)}
+    )
+    bump_feed_version()
+    return updated
@@ -1,3 +1,116 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from houses.models import House
+from reviews.models import Review
+
+
+class ReviewStatsTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('landlord', password='pass')
+        self.house = House.objects.create(
+            title='Cozy bedsitter', house_type='bedsitter', description='Near the stage', location='Rongai',
+            rent=8000, deposit=8000, house_number='A5', owner=owner, is_active=True, payment_status='paid',
+        )
+
+    def review(self, rating):
+        return Review.objects.create(house=self.house, name='Wanjiru', email='w@example.com', rating=rating, comment='Nice')
+
+    def stats(self):
+        self.house.refresh_from_db()
+        return self.house.review_count, self.house.average_rating, [count for _, count, _ in self.house.rating_histogram]
+
+    def test_reviews_update_the_house(self):
+        self.review(5)
+        self.review(4)
+        low = self.review(1)
+        self.assertEqual(self.stats(), (3, 3.3, [1, 1, 0, 0, 1]))
+
+        low.delete()
+        self.assertEqual(self.stats(), (2, 4.5, [1, 1, 0, 0, 0]))
+
+        # rating changed in the admin
+        review = Review.objects.get(rating=4)
+        review.rating = 2
+        review.save()
+        self.assertEqual(self.stats(), (2, 3.5, [1, 0, 0, 1, 0]))
+
+    def test_rebuild_command(self):
+        self.review(5)
+        self.review(3)
+        House.objects.update(review_count=0, rating_sum=0, rating_5_count=0, rating_3_count=0)
+        call_command('rebuild_review_stats', stdout=StringIO())
+        self.assertEqual(self.stats(), (2, 4.0, [1, 0, 1, 0, 0]))
+
+    def test_rebuild_refreshes_cached_pages(self):
+        cache.clear()
+        self.review(5)
+        House.objects.update(review_count=0, rating_sum=0, rating_5_count=0)
+        self.client.get(reverse('home'))
+        self.assertEqual(self.client.get(reverse('home'))['X-Page-Cache'], 'hit')
+
+        call_command('rebuild_review_stats', stdout=StringIO())
+        self.assertNotEqual(self.client.get(reverse('home'))['X-Page-Cache'], 'hit')
+
+    def test_detail_page_shows_rating_without_counting_reviews(self):
+        self.review(5)
+        self.review(4)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('house_detail', args=[self.house.id]))
+        self.assertContains(response, '(2 reviews)')
+        self.assertContains(response, '4.5')
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+
+
+class LoadMoreReviewsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create_user('landlord', password='pass')
+        self.house = House.objects.create(
+            title='Cozy bedsitter', house_type='bedsitter', description='Near the stage', location='Rongai',
+            rent=8000, deposit=8000, house_number='A5', owner=owner, is_active=True, payment_status='paid',
+        )
+        Review.objects.bulk_create([
+            Review(house=self.house, name=f'Reviewer {index}', email='r@example.com', rating=4, comment='Nice')
+            for index in range(25)
+        ])
+        self.url = reverse('load_more_reviews', args=[self.house.id])
+
+    def fetch(self, cursor=None, **headers):
+        params = {'cursor': cursor} if cursor else {}
+        return self.client.get(self.url, params, HTTP_X_REQUESTED_WITH='XMLHttpRequest', **headers)
+
+    def test_pages_follow_the_cursor_without_counting(self):
+        detail = self.client.get(reverse('house_detail', args=[self.house.id]))
+        cursor = detail.context['reviews'].next_cursor()
+
+        seen = [review.id for review in detail.context['reviews']]
+        while cursor:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.fetch(cursor).json()
+            self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+            seen += [review['id'] for review in data['reviews']]
+            cursor = data['next_cursor']
+            self.assertEqual(data['has_more'], cursor is not None)
+
+        self.assertEqual(seen, list(Review.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_etag_until_a_new_review(self):
+        first = self.fetch()
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        Review.objects.create(house=self.house, name='Late', email='l@example.com', rating=5, comment='Great')
+        fresh = self.fetch(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(fresh.json()['reviews'][0]['name'], 'Late')
 
-# Create your tests here.
+    def test_hidden_house(self):
+        House.objects.filter(id=self.house.id).update(is_active=False)
+        self.assertEqual(self.fetch().status_code, 404)
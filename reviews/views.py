@@ -1,38 +1,71 @@
-from django.http import JsonResponse
-from django.shortcuts import get_object_or_404, render
+import hashlib
+
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+from django.http import Http404, JsonResponse
+from django.shortcuts import render
+from django.views.decorators.http import condition
 
 from houses.models import House
+from houses.pagination import KeysetPaginator
+from reviews.models import Review
+
+REVIEWS_PER_PAGE = 10
+REVIEWS_CACHE_TIMEOUT = 60 * 10
 
 # Create your views here.
 
 
+def reviews_etag(request, id):
+    """
+    Changes whenever a review is added to or removed from the house: the newest
+    review plus the review count, and the requested cursor. None when the house
+    isn't public.
+    """
+    if not hasattr(request, '_reviews_etag'):
+        newest = Review.objects.filter(house=OuterRef('pk')).order_by('-created_at', '-id')
+        state = House.objects.filter(id=id, is_active=True, payment_status='paid').annotate(
+            newest_id=Subquery(newest.values('id')[:1]),
+        ).values_list('review_count', 'newest_id').first()
+        request._reviews_etag = None
+        if state is not None:
+            version = f"{id}:{state[0]}:{state[1]}:{request.GET.get('cursor', '')}"
+            request._reviews_etag = hashlib.md5(version.encode()).hexdigest()
+    return request._reviews_etag
+
+
+@condition(etag_func=reviews_etag)
 def load_more_reviews(request, id):  # Parameter name must be 'id'
-    print(f"load_more_reviews called for house id: {id}")
-    
-    if request.method == 'GET' and request.headers.get('x-requested-with') == 'XMLHttpRequest':
-        try:
-            house = get_object_or_404(House, id=id, listing_fee_paid=True)
-            offset = int(request.GET.get('offset', 0))
-            limit = 10
-
-            reviews = house.reviews.all().order_by('-created_at')[offset:offset + limit]
-            reviews_data = []
-
-            for review in reviews:
-                reviews_data.append({
+    """Next page of a house's reviews, by cursor on (created_at, id)"""
+    if request.method != 'GET' or request.headers.get('x-requested-with') != 'XMLHttpRequest':
+        return JsonResponse({'success': False, 'error': 'Invalid request'})
+
+    etag = reviews_etag(request, id)
+    if etag is None:
+        raise Http404("No such house")
+
+    # same page of the same reviews -> same JSON, whoever asks
+    cache_key = f"reviews:page:{etag}"
+    data = cache.get(cache_key)
+    if data is None:
+        reviews = Review.objects.filter(house_id=id)
+        page = KeysetPaginator(reviews, REVIEWS_PER_PAGE, '-created_at').page(request.GET.get('cursor'))
+
+        data = {
+            'success': True,
+            'reviews': [
+                {
                     'id': review.id,
                     'name': review.name,
                     'rating': review.rating,
                     'comment': review.comment,
                     'created_at': review.created_at.isoformat(),
-                })
-
-            return JsonResponse({
-                'success': True,
-                'reviews': reviews_data,
-                'has_more': house.reviews.count() > offset + limit
-            })
-        except Exception as e:
-            return JsonResponse({'success': False, 'error': str(e)})
-    
-    return JsonResponse({'success': False, 'error': 'Invalid request'})
\ No newline at end of file
+                }
+                for review in page
+            ],
+            'has_more': page.has_next(),
+            'next_cursor': page.next_cursor(),
+        }
+        cache.set(cache_key, data, REVIEWS_CACHE_TIMEOUT)
+
+    return JsonResponse(data)